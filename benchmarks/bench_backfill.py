@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+补拉基准：逐页串行拉取 vs 切片并发拉取（backfill_messages）。
+
+    python benchmarks/bench_backfill.py [--hours 24] [--messages 20000] [--workers 1,2,4,8]
+                                        [--latency 0.05] [--qps 0]
+
+用模拟客户端代替真实接口：消息均匀分布在整个窗口内，每次调用固定耗时 --latency 秒，
+--qps 大于 0 时按该速率限速（模拟飞书接口频控）。校验两种方式产出的消息顺序完全一致。
+并发拉取的耗时随 worker 数近似线性下降，直到触及限速。
+
+另测一个没有消息的同长窗口（安静的群、常驻模式的长间隔）：补拉应与串行一样只调用一次接口。
+"""
+from __future__ import annotations
+
+import argparse
+import bisect
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+
+class FakeClient:
+    def __init__(self, start: int, end: int, messages: int, latency: float, qps: float):
+        step = (end - start) / max(1, messages)
+        self.times = [int((start + i * step) * 1000) for i in range(messages)]
+        self.latency = latency
+        self.bucket = bot.TokenBucket(qps) if qps > 0 else None
+        self.calls = 0
+
+    def request(self, method: str, path: str, params: dict | None = None, **kwargs) -> dict:
+        if self.bucket:
+            self.bucket.acquire()
+        time.sleep(self.latency)
+        self.calls += 1
+        lo = bisect.bisect_left(self.times, int(params["start_time"]) * 1000)
+        hi = bisect.bisect_right(self.times, int(params["end_time"]) * 1000 + 999)
+        offset = lo + int(params.get("page_token") or 0)
+        stop = min(hi, offset + params["page_size"])
+        items = [{"message_id": f"om_{i}", "create_time": str(self.times[i])} for i in range(offset, stop)]
+        more = stop < hi
+        return {"code": 0, "data": {"items": items, "has_more": more,
+                                    "page_token": str(stop - lo) if more else ""}}
+
+
+def collect(pages) -> list[str]:
+    return [m["message_id"] for page in pages for m in page[0]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="补拉基准")
+    parser.add_argument("--hours", type=float, default=24)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--workers", default="1,2,4,8")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--qps", type=float, default=0, help="接口限速，0 为不限")
+    args = parser.parse_args()
+
+    bot.log.disabled = True
+    end = int(time.time())
+    start = end - int(args.hours * 3600)
+
+    def client(messages: int = args.messages):
+        return FakeClient(start, end, messages, args.latency, args.qps)
+
+    c = client()
+    t0 = time.perf_counter()
+    expected = collect(bot.fetch_messages(c, "oc_bench", str(start), str(end)))
+    base = time.perf_counter() - t0
+    assert len(expected) == args.messages
+    print(f"{'mode':<12} {'calls':>6} {'seconds':>8} {'speedup':>8}")
+    print(f"{'sequential':<12} {c.calls:>6} {base:>8.2f} {1:>7.1f}x")
+    for workers in (int(x) for x in args.workers.split(",")):
+        c = client()
+        t0 = time.perf_counter()
+        got = collect(bot.backfill_messages(c, "oc_bench", start, end, workers))
+        elapsed = time.perf_counter() - t0
+        assert got == expected, "补拉结果与串行拉取不一致"
+        print(f"{f'backfill x{workers}':<12} {c.calls:>6} {elapsed:>8.2f} {base / elapsed:>7.1f}x")
+
+    print("\n空窗口:")
+    c = client(0)
+    assert collect(bot.fetch_messages(c, "oc_bench", str(start), str(end))) == []
+    print(f"{'sequential':<12} {c.calls:>6}")
+    for workers in (int(x) for x in args.workers.split(",")):
+        c = client(0)
+        assert collect(bot.backfill_messages(c, "oc_bench", start, end, workers)) == []
+        print(f"{f'backfill x{workers}':<12} {c.calls:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+端到端基准：对本地模拟服务（tools/feishu_simulator.py）多次执行 run()。
+
+    python benchmarks/bench_e2e.py [--runs 5] [--chats 3] [--members 500] [--messages 200]
+                                   [--latency-ms 5] [--rate-429 0.01] [--rate-5xx 0] [--json]
+
+每次运行模拟服务都为每个群生成 --messages 条新消息。输出：
+runs/sec、每秒处理消息数、每条消息的接口调用数、发送条数、进程峰值 RSS。
+--json 输出一行 JSON，便于在 CI 中对比回归。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import resource
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import feishu_simulator  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description="端到端基准")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--chats", type=int, default=3)
+    parser.add_argument("--json", action="store_true", help="输出一行 JSON")
+    parser.add_argument("--verbose", action="store_true", help="保留 bot 日志")
+    feishu_simulator.add_config_args(parser)
+    args = parser.parse_args()
+
+    server, sim = feishu_simulator.make_server(feishu_simulator.config_from_args(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # bot 在导入时读取配置，先准备好环境变量
+    workdir = tempfile.mkdtemp(prefix="bench_e2e_")
+    os.environ.update({
+        "FEISHU_BASE_URL": f"http://127.0.0.1:{server.server_port}/open-apis",
+        "FEISHU_APP_ID": "cli_sim",
+        "FEISHU_APP_SECRET": "sim",
+        "ADMIN_OPEN_ID": "ou_sim_admin",
+        "CHAT_IDS": ",".join(f"oc_sim{i:03d}" for i in range(args.chats)),
+        "STATE_DB": os.path.join(workdir, "state.db"),
+        "STATE_FILE": os.path.join(workdir, "state.json"),
+        "CREDENTIAL_FILE": os.path.join(workdir, "credentials.json"),
+    })
+    import bot
+
+    if not args.verbose:
+        bot.log.setLevel(logging.WARNING)
+
+    durations = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        bot.run()
+        durations.append(time.perf_counter() - start)
+        time.sleep(1)  # 下一次运行使用新的时间窗口
+
+    stats = sim.snapshot()
+    elapsed = sum(durations)
+    listed = stats.get("messages_listed", 0)
+    result = {
+        "runs": args.runs,
+        "chats": args.chats,
+        "runs_per_sec": args.runs / elapsed,
+        "run_ms_p50": sorted(durations)[len(durations) // 2] * 1e3,
+        "messages": listed,
+        "messages_per_sec": listed / elapsed,
+        "api_calls": stats.get("api_calls", 0),
+        "api_calls_per_message": stats.get("api_calls", 0) / max(1, listed),
+        "messages_sent": stats.get("messages_sent", 0),
+        "injected_429": stats.get("injected_429", 0),
+        "injected_5xx": stats.get("injected_5xx", 0),
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    if args.json:
+        print(json.dumps(result))
+        return
+    for key, value in result.items():
+        print(f"{key:<24} {value:.2f}" if isinstance(value, float) else f"{key:<24} {value}")
+    print("\n接口调用:")
+    for key, value in sorted(stats.items()):
+        if " /" in key:
+            print(f"  {key:<48} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+成单卡片提取微基准：extract_amount（整卡序列化 + 正则）vs extract_deal（预编译规则）。
+
+    python benchmarks/bench_extract.py [--iterations 20000]
+
+extract_deal 同时提取了人名和产品，仍然比只取金额的 extract_amount 快；
+卡片越大（页脚、按钮、图片越多）差距越明显。
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+CARDS = {
+    "消息列表简化格式": {
+        "title": "恭喜张三2成单",
+        "elements": [
+            [{"tag": "text", "text": "客户：某某科技有限公司"}],
+            [{"tag": "text", "text": "成交金额：25,000元"}],
+            [{"tag": "text", "text": "产品：旗舰版"}],
+        ],
+    },
+    "卡片 1.0 + 页脚": {
+        "header": {"title": {"tag": "plain_text", "content": "恭喜李四成单"}, "template": "red"},
+        "elements": [
+            {"tag": "div", "text": {"tag": "lark_md", "content": "**客户**：某某教育（定金 500元 已付）"}},
+            {"tag": "div", "fields": [
+                {"is_short": True, "text": {"tag": "lark_md", "content": "**实付金额**：38000元"}},
+                {"is_short": True, "text": {"tag": "lark_md", "content": "**产品**：年度会员"}},
+            ]},
+            {"tag": "hr"},
+            {"tag": "img", "img_key": "img_v2_" + "x" * 40, "alt": {"tag": "plain_text", "content": ""}},
+            {"tag": "action", "actions": [
+                {"tag": "button", "text": {"tag": "plain_text", "content": "查看订单"},
+                 "url": "https://example.com/" + "o" * 80, "type": "primary"},
+            ]},
+            {"tag": "note", "elements": [{"tag": "plain_text", "content": "本月团队累计 1,200,000元"}]},
+        ],
+    },
+    "卡片 2.0": {
+        "schema": "2.0",
+        "config": {"update_multi": True},
+        "header": {"title": {"tag": "plain_text", "content": "恭喜王五成单"}},
+        "body": {"elements": [
+            {"tag": "column_set", "columns": [
+                {"tag": "column", "elements": [{"tag": "markdown", "content": "课程：训练营"}]},
+                {"tag": "column", "elements": [{"tag": "markdown", "content": "合同金额 9999 元"}]},
+            ]},
+            {"tag": "markdown", "content": "跟进记录：" + "沟通" * 60},
+        ]},
+    },
+}
+
+
+def bench(fn, card: dict, iterations: int) -> float:
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(card)
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="成单卡片提取微基准")
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'card':<16} {'extract_amount us':>18} {'extract_deal us':>16} {'speedup':>8}  result")
+    for name, card in CARDS.items():
+        legacy = bench(bot.extract_amount, card, args.iterations)
+        fast = bench(bot.extract_deal, card, args.iterations)
+        deal = bot.extract_deal(card)
+        print(f"{name:<16} {legacy:>18.2f} {fast:>16.2f} {legacy / fast:>7.1f}x  "
+              f"{bot.extract_amount(card)[1]:.0f} -> {deal.amount:.0f} ({deal.template})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+成单人名匹配基准：旧版线性扫描 vs NameMatcher 索引。
+
+    python benchmarks/bench_matcher.py [--sizes 100,1000,5000,20000] [--queries 2000]
+
+对每个成员规模生成随机中文姓名，查询词一半是成员名的子串/加尾号变体，
+一半是不存在的名字（最坏情况：旧版要扫完全部成员）。
+索引查询不含跨次运行的 memo 缓存，衡量的是冷查询成本。
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+SURNAMES = "王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁任沈姚卢姜崔钟谭陆汪范金石廖贾夏韦付方白邹孟熊秦邱江尹薛闫段雷侯龙史陶黎贺顾毛郝龚邵万钱严覃武戴莫孔向汤"
+GIVEN = "伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华玉萍红鹏飞辉宇浩然子涵欣怡梓轩一诺思远嘉豪雨桐晨阳佳琪俊杰"
+
+
+def legacy_match(raw_name: str, member_map: dict) -> tuple:
+    """改造前的 match_member，作为基准对照。"""
+    import re
+
+    clean_name = re.sub(r"\d+$", "", raw_name).strip()
+    if raw_name in member_map:
+        return clean_name, member_map[raw_name]
+    if clean_name in member_map:
+        return clean_name, member_map[clean_name]
+    for mname, oid in member_map.items():
+        if clean_name in mname or mname in clean_name:
+            return clean_name, oid
+    return clean_name, None
+
+
+def make_members(n: int, rng: random.Random) -> dict:
+    members = {}
+    while len(members) < n:
+        name = rng.choice(SURNAMES) + "".join(rng.choice(GIVEN) for _ in range(rng.choice((1, 2))))
+        members.setdefault(name, f"ou_{len(members):08d}")
+    return members
+
+
+def make_queries(members: dict, count: int, rng: random.Random) -> list[str]:
+    names = list(members)
+    queries = []
+    for i in range(count):
+        if i % 2:
+            queries.append("查无此人" + str(i))
+        else:
+            name = rng.choice(names)
+            queries.append(name[1:] if len(name) > 2 and i % 4 == 0 else name + str(rng.randint(1, 99)))
+    return queries
+
+
+def bench(fn, queries: list[str]) -> float:
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="match_member 基准")
+    parser.add_argument("--sizes", default="100,1000,5000,20000")
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'members':>8} {'legacy us/q':>12} {'indexed us/q':>13} {'build ms':>9} {'speedup':>8}")
+    for n in (int(x) for x in args.sizes.split(",")):
+        members = make_members(n, rng)
+        queries = make_queries(members, args.queries, rng)
+
+        legacy = bench(lambda q: legacy_match(q, members), queries)
+
+        directory = bot.MemberDirectory(members, time.time())
+        start = time.perf_counter()
+        directory.matcher()
+        build_ms = (time.perf_counter() - start) * 1e3
+
+        def indexed(q):
+            directory.memo.clear()
+            return bot.match_member(q, directory)
+
+        bot.log.disabled = True  # 歧义告警不计入耗时
+        fast = bench(indexed, queries)
+        bot.log.disabled = False
+        print(f"{n:>8} {legacy:>12.1f} {fast:>13.1f} {build_ms:>9.1f} {legacy / fast:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
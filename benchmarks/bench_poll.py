@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+轮询调度基准：固定间隔的 cron vs 自适应轮询（PollScheduler）。
+
+    python benchmarks/bench_poll.py [--days 20] [--deals 40] [--chatter 300] [--cron 1800] [--seed 1]
+
+按天模拟一个群：工作时间（09:00-19:00）里成单按若干"波次"成簇到达（早会、午后、下班前冲单），
+闲聊在 08:00-22:00 内均匀到达。成单的夸赞延迟 = 它之后第一次拉取的时间 - 成单时间。
+输出工作时间成单的延迟中位数 / P90 和每天的拉取轮数（每轮每群一次消息列表请求）。
+"""
+from __future__ import annotations
+
+import argparse
+import bisect
+import os
+import random
+import statistics
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+DAY = 86400
+# 成单高峰（小时）：早会后、午饭后、下班前
+WAVES = (10.0, 14.5, 17.5)
+
+
+def simulate_day(rng: random.Random, day_start: float, deals: int, chatter: int) -> tuple[list[float], list[float]]:
+    deal_times = []
+    for _ in range(deals):
+        if rng.random() < 0.7:
+            hour = rng.gauss(rng.choice(WAVES), 0.4)
+        else:
+            hour = rng.uniform(9, 19)
+        deal_times.append(day_start + min(19, max(9, hour)) * 3600)
+    chat_times = [day_start + rng.uniform(8, 22) * 3600 for _ in range(chatter)]
+    return sorted(deal_times), sorted(chat_times)
+
+
+def count_between(times: list[float], lo: float, hi: float) -> int:
+    return bisect.bisect_right(times, hi) - bisect.bisect_right(times, lo)
+
+
+def latencies(deal_times: list[float], polls: list[float]) -> list[float]:
+    return [polls[bisect.bisect_left(polls, t)] - t for t in deal_times if bisect.bisect_left(polls, t) < len(polls)]
+
+
+def cron_polls(start: float, end: float, interval: int) -> list[float]:
+    return [t for t in range(int(start) + interval, int(end) + interval, interval)]
+
+
+def adaptive_polls(start: float, end: float, deals: list[float], chats: list[float]) -> list[float]:
+    scheduler = bot.PollScheduler()
+    polls, last, now = [], start, start
+    while now <= end:
+        polls.append(now)
+        delay = scheduler.next_delay(now, count_between(deals, last, now), count_between(chats, last, now))
+        last, now = now, now + delay
+    return polls
+
+
+def main():
+    parser = argparse.ArgumentParser(description="轮询调度基准")
+    parser.add_argument("--days", type=int, default=20)
+    parser.add_argument("--deals", type=int, default=40, help="每天的成单数")
+    parser.add_argument("--chatter", type=int, default=300, help="每天的普通消息数")
+    parser.add_argument("--cron", type=int, default=1800, help="cron 间隔（秒）")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    # 从本地时间的零点开始，安静时段按本地时间判断
+    first = bot.datetime(2024, 3, 4).timestamp()
+    deals, chats = [], []
+    for d in range(args.days):
+        day_deals, day_chats = simulate_day(rng, first + d * DAY, args.deals, args.chatter)
+        deals += day_deals
+        chats += day_chats
+    end = first + args.days * DAY
+
+    print(f"{'mode':<14} {'polls/day':>10} {'p50 s':>8} {'p90 s':>8} {'max s':>8}")
+    for name, polls in (
+        (f"cron {args.cron}s", cron_polls(first, end, args.cron)),
+        ("adaptive", adaptive_polls(first, end, deals, chats)),
+    ):
+        lat = sorted(latencies(deals, polls))
+        print(f"{name:<14} {len(polls) / args.days:>10.1f} {statistics.median(lat):>8.0f} "
+              f"{lat[int(len(lat) * 0.9)]:>8.0f} {lat[-1]:>8.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+话术选择基准：旧版下标列表 vs 洗牌 seed + cursor。
+
+    python benchmarks/bench_praise.py [--people 200] [--picks 100000]
+
+旧版每次重建可用下标列表（O(n)），每人状态随已用条数增长；
+新版每次 O(1)，每人状态固定为 [话术池 key, seed, cursor]。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+ALL_PRAISE = bot.PRAISE_RELIE + bot.PRAISE_WULITOU + bot.PRAISE_FUKUA
+
+
+def legacy_pick(clean_name: str, amount: str, used: dict) -> str:
+    """改造前的 pick_praise（全部风格），作为基准对照。"""
+    pool = ALL_PRAISE
+    used_set = used.get(clean_name, [])
+    available = [i for i in range(len(pool)) if i not in used_set]
+    if not available:
+        used[clean_name] = []
+        available = list(range(len(pool)))
+    idx = random.choice(available)
+    used.setdefault(clean_name, []).append(idx)
+    return pool[idx].format(name=clean_name, amount=amount)
+
+
+def bench(fn, people: int, picks: int) -> tuple[float, int]:
+    used = {}
+    names = [f"伙伴{i}" for i in range(people)]
+    start = time.perf_counter()
+    for i in range(picks):
+        fn(names[i % people], "2.5万大单", used)
+    elapsed = (time.perf_counter() - start) / picks * 1e6
+    return elapsed, len(json.dumps(used, ensure_ascii=False).encode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="话术选择基准")
+    parser.add_argument("--people", type=int, default=200)
+    parser.add_argument("--picks", type=int, default=100000)
+    args = parser.parse_args()
+
+    legacy_us, legacy_bytes = bench(legacy_pick, args.people, args.picks)
+    deck_us, deck_bytes = bench(bot.pick_praise, args.people, args.picks)
+    print(f"{'':<8} {'us/pick':>8} {'state bytes':>12}")
+    print(f"{'legacy':<8} {legacy_us:>8.2f} {legacy_bytes:>12}")
+    print(f"{'deck':<8} {deck_us:>8.2f} {deck_bytes:>12}")
+
+
+if __name__ == "__main__":
+    main()
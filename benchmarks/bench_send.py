@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+出站发送基准：逐条串行发送 vs SendQueue 并发发送。
+
+    python benchmarks/bench_send.py [--deals 50] [--chats 1,5,10] [--workers 1,4,8] [--latency 0.08]
+
+用模拟客户端代替真实接口，每次发消息固定耗时 --latency 秒；
+SendQueue 仍按接收方限速（RECEIVER_SEND_RATE），并校验同一群内的发送顺序。
+单群时吞吐被 5 QPS 的群限速封顶（串行发送实际会触发飞书频控），
+多群时随 worker 数增长，直到接口整体限速。
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bot  # noqa: E402
+
+
+class FakeClient:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def request(self, method: str, path: str, **kwargs) -> dict:
+        time.sleep(self.latency)
+        with self._lock:
+            self.sent.append((kwargs["json"]["receive_id"], kwargs["json"]["content"]))
+        return {"code": 0}
+
+
+def make_jobs(deals: int, chats: int) -> list[tuple]:
+    return [(f"oc_{i % chats}", f"张三{i}", f"{i}元") for i in range(deals)]
+
+
+def serial(jobs: list, latency: float) -> float:
+    client = FakeClient(latency)
+    start = time.perf_counter()
+    for chat_id, name, text in jobs:
+        bot.send_praise(client, chat_id, name, None, text)
+    return time.perf_counter() - start
+
+
+def queued(jobs: list, latency: float, workers: int) -> float:
+    client = FakeClient(latency)
+    sender = bot.SendQueue(workers)
+    order = {}
+    start = time.perf_counter()
+    futures = []
+    for chat_id, name, text in jobs:
+        futures.append(sender.submit(chat_id, bot.PRIORITY_PRAISE, bot.send_praise,
+                                     client, chat_id, name, None, text))
+        order.setdefault(chat_id, []).append(name)
+    for f in futures:
+        f.result()
+    elapsed = time.perf_counter() - start
+    for chat_id, names in order.items():
+        sent = [content for receive_id, content in client.sent if receive_id == chat_id]
+        assert len(sent) == len(names), chat_id
+        assert all(f'"{name}伙伴 ' in content for name, content in zip(names, sent)), chat_id
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="出站发送基准")
+    parser.add_argument("--deals", type=int, default=50)
+    parser.add_argument("--chats", default="1,5,10")
+    parser.add_argument("--workers", default="1,4,8")
+    parser.add_argument("--latency", type=float, default=0.08)
+    args = parser.parse_args()
+
+    bot.log.disabled = True
+    print(f"{'chats':>6} {'workers':>8} {'serial s':>9} {'queued s':>9} {'msgs/s':>8} {'speedup':>8}")
+    for chats in (int(x) for x in args.chats.split(",")):
+        jobs = make_jobs(args.deals, chats)
+        base = serial(jobs, args.latency)
+        for workers in (int(x) for x in args.workers.split(",")):
+            t = queued(jobs, args.latency, workers)
+            print(f"{chats:>6} {workers:>8} {base:>9.2f} {t:>9.2f} {len(jobs) / t:>8.1f} {base / t:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
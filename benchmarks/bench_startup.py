@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+冷启动基准：HTTP_BACKEND=stdlib vs requests。
+
+    python benchmarks/bench_startup.py [--repeat 10] [--chats 2] [--messages 50]
+
+每次都起一个新的 python 进程，分别测量：
+- import：`import bot` 并创建传输层的耗时，以及此时 sys.modules 的模块数；
+- run：对本地模拟服务（tools/feishu_simulator.py）完整执行一次 `python bot.py run` 的墙钟时间。
+定时任务每次都是冷启动，这两项基本就是每次调度的固定开销。
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(ROOT, "tools"))
+
+import feishu_simulator  # noqa: E402
+
+IMPORT_PROBE = (
+    "import sys, time; start = time.perf_counter(); import bot; bot.make_transport(); "
+    "print(time.perf_counter() - start, len(sys.modules), 'requests' in sys.modules)"
+)
+
+
+def measure_import(env: dict) -> tuple[float, int, bool]:
+    out = subprocess.run([sys.executable, "-c", IMPORT_PROBE], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout.split()
+    return float(out[0]), int(out[1]), out[2] == "True"
+
+
+def measure_run(env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.join(ROOT, "bot.py"), "run"], cwd=ROOT, env=env,
+                   capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="冷启动基准")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--chats", type=int, default=2)
+    parser.add_argument("--json", action="store_true", help="输出一行 JSON")
+    feishu_simulator.add_config_args(parser)
+    parser.set_defaults(messages=50)
+    args = parser.parse_args()
+
+    server, _ = feishu_simulator.make_server(feishu_simulator.config_from_args(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    results = {}
+    for backend in ("stdlib", "requests"):
+        workdir = tempfile.mkdtemp(prefix=f"bench_startup_{backend}_")
+        env = dict(os.environ,
+                   HTTP_BACKEND=backend,
+                   FEISHU_BASE_URL=f"http://127.0.0.1:{server.server_port}/open-apis",
+                   FEISHU_APP_ID="cli_sim",
+                   FEISHU_APP_SECRET="sim",
+                   ADMIN_OPEN_ID="ou_sim_admin",
+                   CHAT_IDS=",".join(f"oc_sim{i:03d}" for i in range(args.chats)),
+                   STATE_DB=os.path.join(workdir, "state.db"),
+                   STATE_FILE=os.path.join(workdir, "state.json"),
+                   CREDENTIAL_FILE=os.path.join(workdir, "credentials.json"))
+        try:
+            imports = [measure_import(env) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError as e:
+            print(f"{backend}: import 失败\n{e.stderr}", file=sys.stderr)
+            continue
+        runs = []
+        for _ in range(args.repeat):
+            # 凭证缓存会让后续运行跳过 token 请求，每次都按真正的冷启动测
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(os.path.join(workdir, "credentials.json"))
+            runs.append(measure_run(env))
+            time.sleep(1)  # 下一次运行使用新的时间窗口
+        results[backend] = {
+            "import_ms_p50": statistics.median(t for t, _, _ in imports) * 1e3,
+            "modules": imports[0][1],
+            "requests_loaded": imports[0][2],
+            "run_ms_p50": statistics.median(runs) * 1e3,
+            "run_ms_min": min(runs) * 1e3,
+        }
+
+    if args.json:
+        print(json.dumps(results))
+        return
+    print(f"{'backend':<10} {'import ms':>10} {'modules':>8} {'run ms p50':>11} {'run ms min':>11}")
+    for backend, r in results.items():
+        print(f"{backend:<10} {r['import_ms_p50']:>10.1f} {r['modules']:>8} "
+              f"{r['run_ms_p50']:>11.1f} {r['run_ms_min']:>11.1f}")
+
+
+if __name__ == "__main__":
+    main()
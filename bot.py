@@ -2,29 +2,65 @@
 """
 飞书成单夸奖机器人 — 一次性执行脚本
 由 GitHub Actions 每 30 分钟触发一次。
-从 state.json 加载状态（包含上次检查时间），拉取该时间之后的群消息，
+从 state.db 加载状态（包含消息游标），拉取游标之后的群消息，
 检测成单卡片并发送夸奖，保存状态后退出。
 
-改进：使用 last_check_time 记录上次检查时间点，避免因 cron 延迟导致漏检。
+游标记录已处理到的最新消息 create_time 和该时刻附近见过的 message_id，
+下次从游标往前留一小段重叠开始拉取：cron 延迟、运行期间到达的消息都不会漏，
+重叠部分按 message_id 跳过，不会重复处理。
+
+常驻模式：`python bot.py serve` 启动 HTTP 服务接收飞书事件订阅
+（im.message.receive_v1），消息到达即处理，夸奖延迟从分钟级降到秒级。
+管理员在与机器人的单聊里按 "序号 内容" 回复 @消息汇总，下一轮（常驻模式下即时）转发到原消息下。
+
+无法接收事件时用 `python bot.py poll` 常驻轮询：有成单后缩短间隔、空闲时逐步拉长，
+安静时段少拉，每天的拉取轮数不超过 cron 的次数。
+
+多实例（LEASE_STORE）跨主机运行时，STATE_DB 必须和租约库放在同一个共享目录，
+否则群迁移到别的实例后会丢失断点和去重记录；启动时检查，不满足则拒绝运行。
+
+只依赖标准库即可运行（HTTP_BACKEND=stdlib）；只在用到的代码路径里才导入的模块
+（requests、http.server、gzip 等）都延迟导入，缩短定时任务的冷启动时间。
 """
 from __future__ import annotations
 
+import argparse
+import bisect
+import contextlib
+import hashlib
+import heapq
+import http.client
+import itertools
 import json
 import logging
+import math
 import os
+import queue
 import random
 import re
+import socket
+import sqlite3
+import string
+import threading
 import time
-from collections import defaultdict
-
-import requests
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import NamedTuple
+from urllib.parse import urlencode, urlsplit
 
 # ---------------------------------------------------------------------------
 # 配置
 # ---------------------------------------------------------------------------
-BASE_URL = "https://open.feishu.cn/open-apis"
+BASE_URL = os.environ.get("FEISHU_BASE_URL", "https://open.feishu.cn/open-apis")
 CHAT_ID = "oc_dddb60097be21816a6cdaafbc5d9da59"
 
+# 监控的群列表（逗号分隔），未配置时只监控 CHAT_ID
+CHAT_IDS = [c.strip() for c in (os.environ.get("CHAT_IDS") or CHAT_ID).split(",") if c.strip()]
+
+# 并发处理群的线程数
+CHAT_WORKERS = int(os.environ.get("CHAT_WORKERS", "8"))
+
 # 从环境变量读取密钥（GitHub Secrets 注入）
 APP_ID = os.environ.get("FEISHU_APP_ID", "")
 APP_SECRET = os.environ.get("FEISHU_APP_SECRET", "")
@@ -32,14 +68,182 @@ APP_SECRET = os.environ.get("FEISHU_APP_SECRET", "")
 # 管理员 open_id（接收 @机器人 消息汇总）
 ADMIN_OPEN_ID = os.environ.get("ADMIN_OPEN_ID", "ou_ab0e0fbb7083b3d10a7229627bbd467f")
 
+# 管理员在单聊里按"序号 内容"回复 @消息汇总，机器人转发到原消息下；汇总里的序号在这么久内有效
+MENTION_TTL_SECONDS = int(os.environ.get("MENTION_TTL_SECONDS", str(3 * 24 * 60 * 60)))
+
+# 管理员与机器人单聊的 chat_id；为空时从发送 @消息汇总的响应里获取
+ADMIN_CHAT_ID = os.environ.get("ADMIN_CHAT_ID", "")
+
 # 首次运行或状态丢失时的默认回溯时间（6小时）
 DEFAULT_LOOKBACK_SECONDS = 6 * 60 * 60
 
 # 最大回溯时间（24小时），防止拉取太多历史消息
 MAX_LOOKBACK_SECONDS = 24 * 60 * 60
 
+# 补拉：窗口超过两个时间片时切片并发拉取（停机后追赶），按 create_time 顺序合并后再检测
+BACKFILL_SLICE_SECONDS = int(os.environ.get("BACKFILL_SLICE_SECONDS", str(30 * 60)))
+BACKFILL_WORKERS = int(os.environ.get("BACKFILL_WORKERS", "4"))
+
+# 游标重叠窗口：从最新消息时间往前多拉这么久，兜住晚到（服务端可见延迟）的消息
+CURSOR_OVERLAP_SECONDS = int(os.environ.get("CURSOR_OVERLAP_SECONDS", "60"))
+
+STATE_DB = os.environ.get("STATE_DB", "state.db")
+
+# 旧版 JSON 状态文件，首次使用 STATE_DB 时自动迁移
 STATE_FILE = os.environ.get("STATE_FILE", "state.json")
 
+# 去重窗口：比最大回溯时间多留 1 小时余量，更早的消息不会再被拉到，可以淘汰
+DEDUP_WINDOW_SECONDS = MAX_LOOKBACK_SECONDS + 60 * 60
+
+# 去重记录条数上限，超出时淘汰最旧的
+DEDUP_MAX_ENTRIES = 50000
+
+# 事件订阅（常驻模式）：在飞书开发者后台「事件订阅」页获取
+EVENT_VERIFICATION_TOKEN = os.environ.get("FEISHU_VERIFICATION_TOKEN", "")
+EVENT_ENCRYPT_KEY = os.environ.get("FEISHU_ENCRYPT_KEY", "")
+# 两者都未配置时无法校验事件来源，serve 拒绝启动
+# 签名请求的 X-Lark-Request-Timestamp 与本机时间相差超过这么久即拒绝，防止重放
+EVENT_MAX_SKEW_SECONDS = int(os.environ.get("EVENT_MAX_SKEW_SECONDS", "300"))
+SERVE_HOST = os.environ.get("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.environ.get("SERVE_PORT", "8000"))
+EVENT_PATH = "/feishu/events"
+
+# 飞书未在 3 秒内收到 200 会重推同一事件，按 event_id 去重
+EVENT_DEDUP_SIZE = 2000
+
+# 轮询模式（`python bot.py poll`）：有成单 / @消息后按最短间隔拉取，之后按倍数退避到最长间隔。
+# 成单往往扎堆出现，默认值按 benchmarks/bench_poll.py 的模拟选取
+POLL_MIN_INTERVAL = int(os.environ.get("POLL_MIN_INTERVAL", str(10 * 60)))
+POLL_MAX_INTERVAL = int(os.environ.get("POLL_MAX_INTERVAL", str(30 * 60)))
+POLL_BACKOFF = float(os.environ.get("POLL_BACKOFF", "1.5"))
+
+# 安静时段（本地时间，可跨零点，为空不启用）：期间每 POLL_QUIET_INTERVAL 拉取一次，时段结束时补拉
+POLL_QUIET_HOURS = os.environ.get("POLL_QUIET_HOURS", "21:00-08:00")
+POLL_QUIET_INTERVAL = int(os.environ.get("POLL_QUIET_INTERVAL", str(4 * 60 * 60)))
+
+# 每天最多拉取的轮数（每轮每群一次列表请求），按全天均匀累积额度，安静时段省下的留给白天；0 不限。
+# 默认与 */30 的 cron 相同，接口调用总量不增加
+POLL_DAILY_BUDGET = int(os.environ.get("POLL_DAILY_BUDGET", "48"))
+
+# 成员进群/退群事件，用于增量更新成员目录
+MEMBER_EVENT_TYPES = {
+    "im.chat.member.user.added_v1",
+    "im.chat.member.user.deleted_v1",
+    "im.chat.member.user.withdrawn_v1",
+}
+
+# 凭证缓存（tenant token 及其过期时间、机器人身份），跨次运行复用
+CREDENTIAL_FILE = os.environ.get("CREDENTIAL_FILE", "credentials.json")
+
+# 为 0 时凭证缓存只存机器人身份，不落盘 token（缓存文件会被他人读到时，如 Actions cache）
+CACHE_TOKEN = os.environ.get("CACHE_TOKEN", "1") != "0"
+
+# token 有效期约 2 小时，到期前这么久即视为过期并刷新
+TOKEN_REFRESH_MARGIN = 10 * 60
+
+# token 失效错误码，遇到时刷新 token 并重试一次
+INVALID_TOKEN_CODES = {99991663, 99991668}
+
+# HTTP 客户端：超时（连接, 读取）秒、重试次数与退避参数
+HTTP_TIMEOUT = (5, 15)
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 20.0
+HTTP_POOL_SIZE = 16
+
+# HTTP 实现：requests / stdlib（http.client，无第三方依赖）/ auto（装了 requests 就用）
+HTTP_BACKEND = os.environ.get("HTTP_BACKEND", "auto")
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+# 飞书频控错误码（HTTP 400/429 + code 99991400）
+RATE_LIMIT_CODES = {99991400}
+
+# 各接口的客户端限速（次/秒），低于飞书频控上限，避免月底集中成单时被限流
+ENDPOINT_RATE_LIMITS = {
+    "POST /auth/v3/tenant_access_token/internal": 5,
+    "GET /bot/v3/info": 5,
+    "GET /im/v1/chats/:id/members": 20,
+    "GET /im/v1/messages": 20,
+    "POST /im/v1/messages": 20,
+    "POST /im/v1/messages/:id/reply": 20,
+}
+DEFAULT_RATE_LIMIT = 10
+
+# 出站消息并发发送的 worker 数；全局 QPS 仍受上面发消息接口的令牌桶约束
+SEND_WORKERS = int(os.environ.get("SEND_WORKERS", "4"))
+
+# 飞书对同一群 / 同一用户发消息限 5 QPS
+RECEIVER_SEND_RATE = 5
+
+# 发送优先级：数值小的先发，管理员 @消息汇总排在夸奖前面
+PRIORITY_SUMMARY = 0
+PRIORITY_PRAISE = 1
+
+# 发送意图（outbox）连续失败这么多次后放弃，避免永久性错误每次运行都重试
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", "5"))
+
+# 飞书只在 1 小时内按 uuid 去重：创建超过这么久的意图可能已经送达，重发会重复，记录后放弃
+OUTBOX_RESEND_WINDOW = int(os.environ.get("OUTBOX_RESEND_WINDOW", str(50 * 60)))
+
+# 常驻模式下每隔这么久重发一次 outbox 里未确认送达的意图
+OUTBOX_RETRY_INTERVAL = int(os.environ.get("OUTBOX_RETRY_INTERVAL", "60"))
+
+# 一批成单合并后的夸奖条数达到该值时，整批合成一条汇总消息（0 关闭）
+DIGEST_THRESHOLD = int(os.environ.get("DIGEST_THRESHOLD", "5"))
+
+# 同一批里同一人的多张成单卡片合并成一条夸奖
+MERGE_SAME_PERSON = os.environ.get("MERGE_SAME_PERSON", "1") != "0"
+
+# 常驻模式下的攒批窗口（秒）：窗口内到达的成单一起合并发送，0 表示逐条即时发送
+COALESCE_WINDOW = float(os.environ.get("COALESCE_WINDOW", "5"))
+
+# 排行榜排期（JSON 列表），默认不发。每项：
+#   {"period": "day", "at": "09:00"}                 每天 9 点发昨日榜
+#   {"period": "week", "weekday": 1, "at": "09:30"}  每周一发上周榜（weekday 1-7 = 周一到周日）
+#   {"period": "month", "day": 1, "at": "10:00"}     每月 1 日发上月榜（day 取 1-28）
+# 加 "current": true 则发当前周期，如 {"period": "day", "at": "21:00", "current": true} 发今日榜
+LEADERBOARD_SCHEDULE = json.loads(os.environ.get("LEADERBOARD_SCHEDULE") or "[]")
+LEADERBOARD_TOP = int(os.environ.get("LEADERBOARD_TOP", "10"))
+
+# 错过排期时间超过这么久（如 cron 停摆）就不再补发
+LEADERBOARD_GRACE = 6 * 60 * 60
+
+# 按日统计只保留最近这么多天，周 / 月统计长期保留
+STATS_KEEP_DAYS = 90
+
+# 群成员缓存有效期（秒），过期才全量拉取；常驻模式下靠进群/退群事件增量更新
+MEMBER_CACHE_TTL = int(os.environ.get("MEMBER_CACHE_TTL", str(6 * 60 * 60)))
+
+# 成单人匹配不到时，缓存至少这么旧才触发一次补刷新，避免反复全量拉取
+MEMBER_MISS_REFRESH_AGE = 5 * 60
+
+# 非空时把 run 的全部接口请求/响应追加录制到该文件（gzip JSONL），供 `bot.py replay` 离线回放
+CASSETTE_RECORD = os.environ.get("CASSETTE_RECORD", "")
+
+# 录制时脱敏的字段（请求体与响应体中任意层级）
+REDACT_KEYS = {"app_secret", "tenant_access_token", "app_access_token", "encrypt_key", "token"}
+
+# 每次运行结束写入的指标汇总 JSON；为空时只输出到日志
+METRICS_FILE = os.environ.get("METRICS_FILE", "")
+
+# 延迟直方图的桶上界（秒），覆盖接口耗时到轮询模式下的成单→夸奖延迟
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600)
+
+# 多实例协调：租约存储，形如 sqlite:/shared/leases.db；为空时单实例运行，处理全部群。
+# 群被哪个实例处理会随实例增减迁移，跨主机运行时 STATE_DB 也必须放在同一个共享目录
+# （如 STATE_DB=/shared/state.db），否则接手的实例看不到断点、去重记录和 outbox，会重复夸奖；
+# 启动时检查，不满足则拒绝运行
+LEASE_STORE = os.environ.get("LEASE_STORE", "")
+
+# 本实例标识，默认 主机名-进程号
+INSTANCE_ID = os.environ.get("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+
+# 租约有效期，运行期间每 1/3 有效期续约一次；实例崩溃后最多这么久群就会被接管
+LEASE_TTL_SECONDS = int(os.environ.get("LEASE_TTL_SECONDS", "120"))
+
+# 登记心跳后等待这么久再读取存活实例，同一时刻启动的多个实例能看到彼此、一起分片
+LEASE_JOIN_WAIT = float(os.environ.get("LEASE_JOIN_WAIT", "0"))
+
 # ---------------------------------------------------------------------------
 # 日志
 # ---------------------------------------------------------------------------
@@ -49,6 +253,139 @@ logging.basicConfig(
 )
 log = logging.getLogger(__name__)
 
+# ---------------------------------------------------------------------------
+# 指标
+# ---------------------------------------------------------------------------
+class Histogram:
+    """固定桶直方图，分位数按桶上界估算。"""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最后一个是 +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 4),
+            "avg": round(self.sum / self.count, 4) if self.count else 0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": round(self.max, 4),
+        }
+
+
+class Metrics:
+    """进程内的计数器与直方图，按 (名称, 标签) 区分。
+
+    每次运行输出 JSON 汇总；常驻模式下由 /metrics 以 Prometheus 文本格式暴露。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = defaultdict(float)  # {(name, labels): value}
+        self.histograms = {}  # {(name, labels): Histogram}
+
+    @staticmethod
+    def _key(name: str, labels: dict) -> tuple:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self.counters[self._key(name, labels)] += value
+
+    def observe(self, name: str, value: float, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = Histogram()
+            hist.observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """统计一个阶段的耗时，记入 stage_seconds{stage=...}。"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=stage)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    @staticmethod
+    def _label_text(labels: tuple) -> str:
+        return ",".join(f"{k}={v}" for k, v in labels)
+
+    def summary(self) -> dict:
+        with self._lock:
+            counters = {}
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.setdefault(name, {})[self._label_text(labels) or "_"] = value
+            histograms = {}
+            for (name, labels), hist in sorted(self.histograms.items()):
+                histograms.setdefault(name, {})[self._label_text(labels) or "_"] = hist.summary()
+        return {"counters": counters, "histograms": histograms}
+
+    def prometheus(self) -> str:
+        def fmt(labels, extra=()):
+            pairs = [f'{k}="{v}"' for k, v in (*labels, *extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        lines = []
+        with self._lock:
+            for name in sorted({n for n, _ in self.counters}):
+                lines.append(f"# TYPE feishu_praise_{name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        lines.append(f"feishu_praise_{name}{fmt(labels)} {value:g}")
+            for name in sorted({n for n, _ in self.histograms}):
+                lines.append(f"# TYPE feishu_praise_{name} histogram")
+                for (n, labels), hist in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip((*hist.buckets, "+Inf"), hist.counts):
+                        cumulative += count
+                        lines.append(f"feishu_praise_{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                    lines.append(f"feishu_praise_{name}_sum{fmt(labels)} {hist.sum:g}")
+                    lines.append(f"feishu_praise_{name}_count{fmt(labels)} {hist.count}")
+        return "\n".join(lines) + "\n"
+
+    def write_summary(self, path: str = METRICS_FILE):
+        summary = self.summary()
+        if not path:
+            log.info("运行指标: %s", json.dumps(summary, ensure_ascii=False))
+            return
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        log.info("运行指标已写入 %s", path)
+
+
+metrics = Metrics()
+
 # ---------------------------------------------------------------------------
 # 话术模板（共 90 条）
 # ---------------------------------------------------------------------------
@@ -156,520 +493,3604 @@ PRAISE_FUKUA = [
     "🤯 OH MY GOD！{name}！{amount}！买它！不对，签它！总之就是绝了！",
 ]
 
-# 浮夸蠢萌专属期截止日期（2026-03-03），此期间只用 PRAISE_FUKUA
-FUKUA_ONLY_UNTIL = "2026-03-03"
+# 内置话术包，id 保持稳定（轮换状态按话术包组合记录）
+BUILTIN_PRAISE_PACKS = {
+    "relie": PRAISE_RELIE,
+    "wulitou": PRAISE_WULITOU,
+    "fukua": PRAISE_FUKUA,
+}
 
-ALL_PRAISE = PRAISE_RELIE + PRAISE_WULITOU + PRAISE_FUKUA  # 90 条
+# 外部话术包目录：<id>.json，内容为 {"templates": [...]} 或模板列表，被排期引用时才加载
+PRAISE_PACK_DIR = os.environ.get("PRAISE_PACK_DIR", "praise_packs")
+
+# 话术包排期：取第一个命中日期的窗口，from 含当天、until 不含，均为 ISO 日期
+PRAISE_SCHEDULE = json.loads(os.environ.get("PRAISE_SCHEDULE") or "null") or [
+    {"until": "2026-03-03", "packs": ["fukua"]},  # 浮夸蠢萌专属期
+    {"packs": ["relie", "wulitou", "fukua"]},
+]
 
 
 # ---------------------------------------------------------------------------
-# 辅助函数
+# HTTP 客户端
 # ---------------------------------------------------------------------------
-def get_tenant_token() -> str:
-    """获取飞书 tenant_access_token。"""
-    resp = requests.post(
-        f"{BASE_URL}/auth/v3/tenant_access_token/internal",
-        json={"app_id": APP_ID, "app_secret": APP_SECRET},
-    )
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        raise RuntimeError(f"获取 token 失败: {data}")
-    token = data["tenant_access_token"]
-    log.info("获取 tenant_access_token 成功")
-    return token
+class TokenBucket:
+    """线程安全的令牌桶，acquire() 阻塞直到拿到令牌。"""
 
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
 
-def auth_headers(token: str) -> dict:
-    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+    def pause(self, seconds: float):
+        """服务端要求等待时，暂停发放令牌。"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0.0
 
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now >= self._paused_until:
+                    start = max(self._last, self._paused_until)
+                    self._tokens = min(self.capacity, self._tokens + (now - start) * self.rate)
+                    self._last = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    wait = (1 - self._tokens) / self.rate
+                else:
+                    wait = self._paused_until - now
+            time.sleep(wait)
 
-def fetch_members(token: str) -> dict:
-    """获取群成员列表，返回 {name: open_id}。"""
-    members = {}
-    url = f"{BASE_URL}/im/v1/chats/{CHAT_ID}/members"
-    params = {"member_id_type": "open_id", "page_size": 100}
-    resp = requests.get(url, headers=auth_headers(token), params=params)
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        log.error("获取群成员失败: %s", data)
-        return members
-    for item in data.get("data", {}).get("items", []):
-        name = item.get("name", "")
-        open_id = item.get("member_id", "")
-        if name and open_id:
-            members[name] = open_id
-    log.info("获取群成员 %d 人", len(members))
-    return members
 
+def endpoint_key(method: str, path: str) -> str:
+    """把路径中的 chat_id / message_id 归一化，得到限速分组键。"""
+    path = re.sub(r"/(oc|om|ou)_[0-9a-zA-Z]+", "/:id", path)
+    return f"{method} {path}"
 
-def fetch_messages(token: str, start_time: str) -> list:
-    """拉取指定时间之后的群消息。"""
-    url = f"{BASE_URL}/im/v1/messages"
-    end_time = str(int(time.time()))
-    params = {
-        "container_id_type": "chat",
-        "container_id": CHAT_ID,
-        "start_time": start_time,
-        "end_time": end_time,
-        "sort_type": "ByCreateTimeAsc",
-        "page_size": 50,
-    }
-    all_messages = []
-    page_token = None
-    while True:
-        if page_token:
-            params["page_token"] = page_token
-        resp = requests.get(url, headers=auth_headers(token), params=params)
-        resp.raise_for_status()
-        data = resp.json()
-        if data.get("code") != 0:
-            log.error("拉取消息失败: %s", data)
-            break
-        items = data.get("data", {}).get("items", [])
-        all_messages.extend(items)
-        if not data.get("data", {}).get("has_more"):
-            break
-        page_token = data["data"].get("page_token")
-    log.info("拉取到 %d 条消息", len(all_messages))
-    return all_messages
 
+def retry_after_seconds(resp) -> float | None:
+    """从 Retry-After 或飞书的 x-ogw-ratelimit-reset 头读取等待秒数。"""
+    for header in ("Retry-After", "x-ogw-ratelimit-reset"):
+        value = resp.headers.get(header)
+        if value:
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                pass
+    return None
 
-def match_member(raw_name: str, member_map: dict) -> tuple:
-    """
-    三层匹配：精确原名 → 精确去尾号名 → 模糊包含。
-    返回 (clean_name, open_id or None)。
+
+class CredentialCache:
+    """tenant token 与机器人身份的持久化缓存。
+
+    token 到期前 TOKEN_REFRESH_MARGIN 秒内才重新获取；机器人 open_id 不变，
+    获取一次后一直复用。常驻模式下由后台线程在到期前主动刷新。
+    CACHE_TOKEN=0 时 token 只留在内存里，每次运行获取一次。
     """
-    clean_name = re.sub(r"\d+$", "", raw_name).strip()
-    # 1) 精确匹配原名
-    if raw_name in member_map:
-        return clean_name, member_map[raw_name]
-    # 2) 精确匹配去尾号名
-    if clean_name in member_map:
-        return clean_name, member_map[clean_name]
-    # 3) 模糊包含
-    for mname, oid in member_map.items():
-        if clean_name in mname or mname in clean_name:
-            return clean_name, oid
-    return clean_name, None
 
+    def __init__(self, client: FeishuClient, path: str = CREDENTIAL_FILE):
+        self.client = client
+        self.path = path
+        self._lock = threading.Lock()
+        self._token = ""
+        self._expire_at = 0
+        self._bot = {}
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if CACHE_TOKEN:
+                    self._token = data.get("token", "")
+                    self._expire_at = int(data.get("expire_at", 0))
+                self._bot = data.get("bot", {})
+            except (json.JSONDecodeError, IOError, ValueError) as e:
+                log.warning("加载凭证缓存失败，重新获取: %s", e)
 
-def extract_amount(content_obj: dict) -> tuple[str, float]:
-    """从卡片内容中提取金额。
+    def _valid(self) -> bool:
+        return bool(self._token) and time.time() < self._expire_at - TOKEN_REFRESH_MARGIN
 
-    Returns:
-        (显示文本, 数值金额)
-        - 金额 >= 20000: ("X元大单", 数值)
-        - 金额 < 20000: ("X元", 数值)
-        - 未找到金额: ("这一单", 0)
-    """
-    full_text = json.dumps(content_obj, ensure_ascii=False)
-    m = re.search(r"(\d[\d,]*\.?\d*)\s*元", full_text)
-    if not m:
-        return "这一单", 0
+    def _save(self):
+        tmp = self.path + ".tmp"
+        try:
+            with open(os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                data = {"token": self._token, "expire_at": self._expire_at} if CACHE_TOKEN else {}
+                json.dump({**data, "bot": self._bot}, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log.warning("保存凭证缓存失败: %s", e)
 
-    raw = m.group(1).replace(",", "")
-    try:
-        value = float(raw)
-    except ValueError:
-        return "这一单", 0
+    def token(self) -> str:
+        with self._lock:
+            if not self._valid():
+                self._refresh_locked()
+            return self._token
 
-    # 格式化显示金额
-    if value >= 10000:
-        wan = value / 10000
-        if wan == int(wan):
-            display = f"{int(wan)}万"
-        else:
-            display = f"{wan:.1f}万"
-    else:
-        display = f"{int(value)}"
+    def refresh(self):
+        with self._lock:
+            self._refresh_locked()
 
-    # 超过2万才叫"大单"
-    if value >= 20000:
-        return f"{display}大单", value
-    return display, value
+    def _refresh_locked(self):
+        with metrics.timer("token"):
+            self._token, expire = get_tenant_token(self.client)
+        self._expire_at = int(time.time()) + expire
+        self._save()
 
+    def invalidate(self, token: str):
+        """标记 token 失效；并发请求中只有第一个会触发刷新。"""
+        with self._lock:
+            if self._token == token:
+                self._expire_at = 0
 
-def pick_praise(clean_name: str, amount: str, used: dict) -> str:
-    """为指定人选一条不重复的话术。
+    def bot_info(self) -> dict:
+        if not self._bot.get("open_id"):
+            bot = get_bot_info(self.client)
+            if bot.get("open_id"):
+                with self._lock:
+                    self._bot = bot
+                    self._save()
+        return self._bot
 
-    在 FUKUA_ONLY_UNTIL 日期之前，只使用浮夸蠢萌风格；
-    之后恢复全部风格随机。
-    """
-    from datetime import date
+    def start_background_refresh(self):
+        """常驻模式：到期前主动刷新，请求路径上不再阻塞等待 token。"""
+        def loop():
+            while True:
+                wait = self._expire_at - TOKEN_REFRESH_MARGIN - time.time()
+                time.sleep(max(wait, 30))
+                if time.time() >= self._expire_at - TOKEN_REFRESH_MARGIN:
+                    try:
+                        self.refresh()
+                    except Exception:
+                        log.exception("后台刷新 token 失败，稍后重试")
 
-    today = date.today().isoformat()
-    if today < FUKUA_ONLY_UNTIL:
-        pool = PRAISE_FUKUA
-    else:
-        pool = ALL_PRAISE
-
-    total = len(pool)
-    used_set = used.get(clean_name, [])
-    available = [i for i in range(total) if i not in used_set]
-    if not available:
-        used[clean_name] = []
-        available = list(range(total))
-    idx = random.choice(available)
-    used.setdefault(clean_name, []).append(idx)
-    template = pool[idx]
-    return template.format(name=clean_name, amount=amount)
+        threading.Thread(target=loop, daemon=True).start()
 
 
-def get_bot_info(token: str) -> dict:
-    """获取机器人自身信息，返回 {open_id, app_name}。"""
-    resp = requests.get(
-        f"{BASE_URL}/bot/v3/info",
-        headers=auth_headers(token),
-    )
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        log.error("获取机器人信息失败: %s", data)
-        return {}
-    bot = data.get("bot", {})
-    log.info("机器人信息: %s (open_id=%s)", bot.get("app_name"), bot.get("open_id"))
-    return bot
+class TransportError(OSError):
+    """网络层错误（连接失败、超时、连接中断），请求可能已发出。"""
 
 
-def detect_at_bot_messages(
-    messages: list, bot_open_id: str, processed_ids: set, member_map: dict
-) -> list[dict]:
-    """检测 @机器人 的消息。
+class ConnectTimeoutError(TransportError):
+    """连接阶段超时，请求一定没有发出。"""
 
-    Returns:
-        list of {msg_id, sender_name, sender_id, content, create_time}
-    """
-    at_messages = []
 
-    for msg in messages:
-        msg_id = msg.get("message_id", "")
-        if msg_id in processed_ids:
-            continue
+class HTTPStatusError(RuntimeError):
+    """重试后仍是 4xx/5xx 响应。"""
 
-        msg_type = msg.get("msg_type", "")
-        sender = msg.get("sender", {})
-        sender_type = sender.get("sender_type", "")
+    def __init__(self, message: str, response):
+        super().__init__(message)
+        self.response = response
 
-        # 只处理用户发送的消息
-        if sender_type != "user":
-            continue
 
-        # 检查消息内容中是否 @了机器人
+class Headers(dict):
+    """键不区分大小写的响应头。"""
+
+    def __init__(self, items=()):
+        super().__init__((k.lower(), v) for k, v in dict(items).items())
+
+    def get(self, key: str, default=None):
+        return super().get(key.lower(), default)
+
+
+class SimpleResponse:
+    """标准库传输与回放共用的响应，提供 FeishuClient 用到的 status_code / headers / text / json()。"""
+
+    def __init__(self, status: int, headers, text: str):
+        self.status_code = status
+        self.headers = Headers(headers)
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RequestsTransport:
+    """requests.Session + 连接池；异常转换为 TransportError。"""
+
+    def __init__(self):
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self._requests = requests
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def request(self, method: str, url: str, **kwargs):
+        requests = self._requests
         try:
-            content_str = msg.get("body", {}).get("content", "{}")
-            content = json.loads(content_str)
-        except json.JSONDecodeError:
-            continue
+            return self.session.request(method, url, **kwargs)
+        except requests.ConnectTimeout as e:
+            raise ConnectTimeoutError(str(e)) from e
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise TransportError(str(e)) from e
 
-        # 检测 @机器人
-        has_at_bot = False
-        text_content = ""
-
-        if msg_type == "text":
-            # 文本消息格式: {"text": "@_user_1 xxx", "mentions": [{"key": "@_user_1", "id": {"open_id": "xxx"}}]}
-            text_content = content.get("text", "")
-            mentions = content.get("mentions", [])
-            for mention in mentions:
-                mention_id = mention.get("id", {})
-                if isinstance(mention_id, dict):
-                    if mention_id.get("open_id") == bot_open_id:
-                        has_at_bot = True
-                        break
-                elif mention_id == bot_open_id:
-                    has_at_bot = True
-                    break
+    def close(self):
+        self.session.close()
 
-        elif msg_type == "post":
-            # 富文本消息，遍历内容查找 at 标签
-            def extract_post_content(post_content):
-                texts = []
-                at_bot = False
-                for lang_content in post_content.values():
-                    for line in lang_content.get("content", []):
-                        for elem in line:
-                            if elem.get("tag") == "text":
-                                texts.append(elem.get("text", ""))
-                            elif elem.get("tag") == "at":
-                                if elem.get("user_id") == bot_open_id:
-                                    at_bot = True
-                return " ".join(texts), at_bot
-
-            text_content, has_at_bot = extract_post_content(content)
-
-        if not has_at_bot:
-            continue
 
-        # 清理 @标记，提取纯文本
-        clean_text = re.sub(r"@_user_\d+\s*", "", text_content).strip()
+class StdlibTransport:
+    """基于 http.client 的传输层，无第三方依赖。
 
-        # 获取发送者信息
-        sender_id = sender.get("id", "")
-        sender_name = "未知用户"
-        # 从 member_map 反查名字
-        for name, oid in member_map.items():
-            if oid == sender_id:
-                sender_name = name
-                break
+    keep-alive 连接用完放回空闲池，多线程共用；冷启动的定时任务通常全程只用一条连接。
+    复用的空闲连接若已被服务端关闭，换新连接重发一次（请求未被处理）。
+    """
 
-        # 获取消息时间
-        create_time = msg.get("create_time", "")
-        if create_time:
+    def __init__(self):
+        self._idle = []  # [(scheme, netloc, HTTPConnection)]
+        self._lock = threading.Lock()
+
+    def _checkout(self, scheme: str, netloc: str, connect_timeout: float):
+        with self._lock:
+            for i in range(len(self._idle) - 1, -1, -1):
+                if self._idle[i][:2] == (scheme, netloc):
+                    return self._idle.pop(i)[2], True
+        cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return cls(netloc, timeout=connect_timeout), False
+
+    def _checkin(self, scheme: str, netloc: str, conn):
+        with self._lock:
+            if len(self._idle) < HTTP_POOL_SIZE:
+                self._idle.append((scheme, netloc, conn))
+                return
+        conn.close()
+
+    def request(self, method: str, url: str, *, headers: dict | None = None, params: dict | None = None,
+                json: dict | None = None, timeout=HTTP_TIMEOUT) -> SimpleResponse:
+        parts = urlsplit(url)
+        target = parts.path + ("?" + urlencode(params) if params else "")
+        send_headers = {"Accept": "application/json", "Accept-Encoding": "identity", **(headers or {})}
+        body = None
+        if json is not None:
+            body = _json_dumps(json).encode("utf-8")
+            send_headers["Content-Type"] = "application/json; charset=utf-8"
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+
+        while True:
+            conn, reused = self._checkout(parts.scheme, parts.netloc, connect_timeout)
             try:
-                ts = int(create_time) // 1000 if len(create_time) > 10 else int(create_time)
-                time_str = time.strftime("%H:%M", time.localtime(ts))
-            except (ValueError, OSError):
-                time_str = "未知时间"
-        else:
-            time_str = "未知时间"
+                if conn.sock is None:
+                    try:
+                        conn.connect()
+                    except TimeoutError as e:
+                        raise ConnectTimeoutError(f"连接超时: {parts.netloc}") from e
+                conn.sock.settimeout(read_timeout)
+                conn.request(method, target, body=body, headers=send_headers)
+                resp = conn.getresponse()
+                data = resp.read()
+            except ConnectTimeoutError:
+                conn.close()
+                raise
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError) as e:
+                conn.close()
+                if reused:
+                    continue
+                raise TransportError(str(e)) from e
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                raise TransportError(str(e)) from e
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(parts.scheme, parts.netloc, conn)
+            return SimpleResponse(resp.status, resp.getheaders(), data.decode("utf-8", "replace"))
 
-        at_messages.append({
-            "msg_id": msg_id,
-            "sender_name": sender_name,
-            "sender_id": sender_id,
-            "content": clean_text if clean_text else "(无文字内容)",
-            "time": time_str,
-        })
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for _, _, conn in idle:
+            conn.close()
 
-        log.info("检测到 @机器人 消息: %s 说: %s", sender_name, clean_text[:50])
 
-    return at_messages
+_json_dumps = json.dumps  # StdlibTransport.request 的 json 参数遮蔽了模块名
 
 
-def send_at_summary(token: str, at_messages: list[dict]):
-    """发送 @消息汇总给管理员。"""
-    if not at_messages:
-        return
+def make_transport():
+    """按 HTTP_BACKEND 创建传输层；auto 时装了 requests 就用 requests。"""
+    if HTTP_BACKEND == "requests":
+        return RequestsTransport()
+    if HTTP_BACKEND == "auto":
+        try:
+            return RequestsTransport()
+        except ImportError:
+            pass
+    return StdlibTransport()
 
-    if not ADMIN_OPEN_ID:
-        log.warning("未配置 ADMIN_OPEN_ID，无法发送 @消息汇总")
-        return
 
-    # 构建汇总消息
-    lines = [f"📬 收到 {len(at_messages)} 条 @消息：\n"]
-    for i, msg in enumerate(at_messages, 1):
-        lines.append(f"{i}. 【{msg['time']}】{msg['sender_name']}：")
-        lines.append(f"   {msg['content']}\n")
+class FeishuClient:
+    """所有飞书接口调用的唯一入口。
 
-    lines.append("\n💡 请回复对应序号+内容来回复用户")
-    lines.append("例如：1 好的，收到！")
+    - 共享传输层（requests 或 http.client，见 HTTP_BACKEND），复用 keep-alive 连接
+    - 默认超时 HTTP_TIMEOUT
+    - 429/5xx/网络错误按指数退避 + 随机抖动重试，优先遵循服务端给出的等待时间
+    - 按接口分组的令牌桶限速
+    - token 失效时刷新并重试一次
+    """
 
-    text = "\n".join(lines)
+    def __init__(self, credential_file: str = CREDENTIAL_FILE, session=None):
+        # session 可替换为 RecordingSession / ReplaySession
+        self.session = session or make_transport()
+        self.creds = CredentialCache(self, credential_file)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self.sender = SendQueue()
 
-    # 发送私聊消息给管理员
-    url = f"{BASE_URL}/im/v1/messages"
-    params = {"receive_id_type": "open_id"}
-    body = {
-        "receive_id": ADMIN_OPEN_ID,
-        "msg_type": "text",
-        "content": json.dumps({"text": text}, ensure_ascii=False),
-    }
+    def bucket(self, key: str) -> TokenBucket:
+        with self._buckets_lock:
+            if key not in self._buckets:
+                self._buckets[key] = TokenBucket(ENDPOINT_RATE_LIMITS.get(key, DEFAULT_RATE_LIMIT))
+            return self._buckets[key]
 
-    resp = requests.post(url, headers=auth_headers(token), params=params, json=body)
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        log.error("发送 @消息汇总失败: %s", data)
-    else:
-        log.info("@消息汇总已发送给管理员，共 %d 条", len(at_messages))
+    def request(self, method: str, path: str, *, auth: bool = True, **kwargs) -> dict:
+        """调用接口并返回响应 JSON；重试耗尽后抛出最后一次的异常。"""
+        kwargs.setdefault("timeout", HTTP_TIMEOUT)
+        key = endpoint_key(method, path)
+        bucket = self.bucket(key)
+        # 发消息接口本身不是幂等的：只在确定未被处理时（频控、连接失败）重试；
+        # 带 uuid 的请求由服务端在 1 小时内去重，可以和 GET 一样放心重试
+        body = kwargs.get("json")
+        idempotent = method == "GET" or not auth or bool(isinstance(body, dict) and body.get("uuid"))
+        token_retried = False
+        attempt = 0
+        while True:
+            bucket.acquire()
+            token = self.creds.token() if auth else ""
+            headers = auth_headers(token) if auth else None
+            start = time.perf_counter()
+            try:
+                resp = self.session.request(method, BASE_URL + path, headers=headers, **kwargs)
+            except TransportError as e:
+                metrics.inc("api_calls_total", endpoint=key, status="error")
+                retryable = idempotent or isinstance(e, ConnectTimeoutError)
+                if not retryable or attempt >= HTTP_MAX_RETRIES:
+                    raise
+                metrics.inc("api_retries_total", endpoint=key, reason="network")
+                wait = self._backoff(attempt)
+                log.warning("%s %s 网络错误 (%s)，%.1f 秒后重试", method, path, e, wait)
+                time.sleep(wait)
+                attempt += 1
+                continue
 
+            metrics.observe("api_latency_seconds", time.perf_counter() - start, endpoint=key)
+            metrics.inc("api_calls_total", endpoint=key, status=resp.status_code)
+            try:
+                data = resp.json()
+            except ValueError:
+                data = None
+            code = data.get("code") if isinstance(data, dict) else None
 
-def send_praise(token: str, clean_name: str, open_id: str | None, praise_text: str):
-    """发送夸奖消息到群聊。"""
-    url = f"{BASE_URL}/im/v1/messages"
-    params = {"receive_id_type": "chat_id"}
+            if auth and code in INVALID_TOKEN_CODES and not token_retried:
+                log.warning("token 已失效 (code=%s)，刷新后重试", code)
+                metrics.inc("api_retries_total", endpoint=key, reason="token")
+                self.creds.invalidate(token)
+                token_retried = True
+                continue
 
-    if open_id:
-        # 富文本 @mention
-        msg_content = {
-            "zh_cn": {
-                "title": "",
-                "content": [
-                    [
-                        {"tag": "at", "user_id": open_id},
-                        {"tag": "text", "text": "伙伴 "},
-                    ],
-                    [
-                        {"tag": "text", "text": praise_text},
-                    ],
-                ],
-            }
-        }
-        body = {
-            "receive_id": CHAT_ID,
-            "msg_type": "post",
-            "content": json.dumps(msg_content, ensure_ascii=False),
-        }
-    else:
-        # 纯文本回退
-        body = {
-            "receive_id": CHAT_ID,
-            "msg_type": "text",
-            "content": json.dumps(
-                {"text": f"{clean_name}伙伴 {praise_text}"}, ensure_ascii=False
-            ),
-        }
+            rate_limited = resp.status_code == 429 or code in RATE_LIMIT_CODES
+            if rate_limited or (idempotent and resp.status_code in RETRYABLE_STATUS):
+                if attempt < HTTP_MAX_RETRIES:
+                    wait = retry_after_seconds(resp)
+                    if wait is None:
+                        wait = self._backoff(attempt)
+                    if rate_limited:
+                        bucket.pause(wait)
+                    metrics.inc("api_retries_total", endpoint=key,
+                                reason="rate_limit" if rate_limited else "server")
+                    log.warning("%s %s 返回 %s (code=%s)，%.1f 秒后重试",
+                                method, path, resp.status_code, code, wait)
+                    time.sleep(wait)
+                    attempt += 1
+                    continue
 
-    resp = requests.post(url, headers=auth_headers(token), params=params, json=body)
-    resp.raise_for_status()
-    data = resp.json()
-    if data.get("code") != 0:
-        log.error("发送消息失败: %s", data)
-    else:
-        log.info("夸奖已发送: %s -> %s", clean_name, praise_text[:40])
+            if resp.status_code >= 400:
+                raise HTTPStatusError(f"{method} {path} 返回 {resp.status_code}: {resp.text[:200]}", resp)
+            return data if data is not None else {}
 
+    def close(self):
+        self.session.close()
 
-# ---------------------------------------------------------------------------
-# 状态管理
-# ---------------------------------------------------------------------------
-def load_state() -> dict:
-    """从 state.json 加载状态。"""
-    if os.path.exists(STATE_FILE):
-        try:
-            with open(STATE_FILE, "r", encoding="utf-8") as f:
-                state = json.load(f)
-            log.info("加载状态: %d 条已处理消息, %d 人话术记录, last_check_time=%s",
-                     len(state.get("processed_ids", [])),
-                     len(state.get("used_praise", {})),
-                     state.get("last_check_time", "未设置"))
-            return state
-        except (json.JSONDecodeError, IOError) as e:
-            log.warning("加载 state.json 失败，使用空状态: %s", e)
-    return {"processed_ids": [], "used_praise": {}, "members": {}, "last_check_time": None}
-
-
-def save_state(state: dict):
-    """保存状态到 state.json。"""
-    # 限制已处理消息 ID 数量
-    ids = state.get("processed_ids", [])
-    if len(ids) > 1000:
-        state["processed_ids"] = ids[-500:]
-    with open(STATE_FILE, "w", encoding="utf-8") as f:
-        json.dump(state, f, ensure_ascii=False, indent=2)
-    log.info("状态已保存")
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # full jitter：在 [0, base * 2^attempt] 内随机
+        return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+class SendQueue:
+    """出站消息队列，由有界 worker 池并发发送。
+
+    - 每个接收方（群 / 管理员）一条队列，同一时间只有一条在途消息，保证顺序
+    - 接收方各自按 RECEIVER_SEND_RATE 限速，整体由接口令牌桶限速
+    - 就绪的接收方按队首消息优先级出队，管理员汇总先于夸奖发送
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS):
+        self.workers = max(1, workers)
+        self._cond = threading.Condition()
+        self._lanes = {}  # {receive_id: deque[(priority, fn, args, future)]}，在途或就绪的接收方
+        self._ready = []  # [(priority, seq, receive_id)]，小顶堆
+        self._seq = itertools.count()
+        self._buckets = {}
+        self._threads = []
+
+    def submit(self, receive_id: str, priority: int, fn, *args) -> Future:
+        """入队 fn(*args)，返回 Future；同一 receive_id 的任务按提交顺序执行。"""
+        future = Future()
+        with self._cond:
+            if not self._threads:
+                for i in range(self.workers):
+                    t = threading.Thread(target=self._work, name=f"sender-{i}", daemon=True)
+                    t.start()
+                    self._threads.append(t)
+            lane = self._lanes.get(receive_id)
+            if lane is None:
+                lane = self._lanes[receive_id] = deque()
+                self._buckets.setdefault(receive_id, TokenBucket(RECEIVER_SEND_RATE))
+                heapq.heappush(self._ready, (priority, next(self._seq), receive_id))
+                self._cond.notify()
+            lane.append((priority, fn, args, future))
+        return future
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while not self._ready:
+                    self._cond.wait()
+                _, _, receive_id = heapq.heappop(self._ready)
+                _, fn, args, future = self._lanes[receive_id].popleft()
+                bucket = self._buckets[receive_id]
+            if future.set_running_or_notify_cancel():
+                try:
+                    bucket.acquire()
+                    with metrics.timer("send"):
+                        result = fn(*args)
+                    future.set_result(result)
+                except BaseException as e:
+                    future.set_exception(e)
+            with self._cond:
+                lane = self._lanes[receive_id]
+                if lane:
+                    heapq.heappush(self._ready, (lane[0][0], next(self._seq), receive_id))
+                    self._cond.notify()
+                else:
+                    del self._lanes[receive_id]
 
 
 # ---------------------------------------------------------------------------
-# 主逻辑
+# 录制与回放
 # ---------------------------------------------------------------------------
-def run():
-    if not APP_ID or not APP_SECRET:
-        log.error("缺少环境变量 FEISHU_APP_ID 或 FEISHU_APP_SECRET")
-        return
+def redact(obj):
+    """递归替换 REDACT_KEYS 中字段的值。"""
+    if isinstance(obj, dict):
+        return {k: "***" if k in REDACT_KEYS else redact(v) for k, v in obj.items()}
+    if isinstance(obj, list):
+        return [redact(v) for v in obj]
+    return obj
 
-    # 1. 加载状态
-    state = load_state()
-    processed_ids = set(state.get("processed_ids", []))
-    used_praise = state.get("used_praise", {})  # {clean_name: [idx, ...]}
-    member_map = state.get("members", {})
-    last_check_time = state.get("last_check_time")
-
-    # 2. 获取 token 和机器人信息
-    token = get_tenant_token()
-    bot_info = get_bot_info(token)
-    bot_open_id = bot_info.get("open_id", "")
-
-    # 3. 刷新群成员（每次都刷新，因为是每 30 分钟才执行一次）
-    member_map = fetch_members(token)
-    if not member_map:
-        log.warning("群成员为空，使用缓存")
-        member_map = state.get("members", {})
-
-    # 4. 计算消息拉取起始时间
-    now = int(time.time())
-    if last_check_time:
-        # 从上次检查时间开始，但不超过最大回溯时间
-        start_ts = max(last_check_time, now - MAX_LOOKBACK_SECONDS)
-        log.info("从上次检查时间开始: %s (距今 %.1f 分钟)",
-                 time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_ts)),
-                 (now - start_ts) / 60)
-    else:
-        # 首次运行，使用默认回溯时间
-        start_ts = now - DEFAULT_LOOKBACK_SECONDS
-        log.info("首次运行，回溯 %.1f 小时", DEFAULT_LOOKBACK_SECONDS / 3600)
-
-    messages = fetch_messages(token, str(start_ts))
-
-    # 5. 检测 @机器人 的消息并汇总发送给管理员
-    at_messages = []
-    if bot_open_id:
-        at_messages = detect_at_bot_messages(messages, bot_open_id, processed_ids, member_map)
-        if at_messages:
-            send_at_summary(token, at_messages)
-            # 记录已处理的 @消息
-            for msg in at_messages:
-                if msg["msg_id"] not in processed_ids:
-                    processed_ids.add(msg["msg_id"])
-    else:
-        log.warning("无法获取机器人 open_id，跳过 @消息检测")
 
-    # 6. 检测成单卡片并发送夸奖
-    new_praise_processed = []
-    for msg in messages:
-        msg_id = msg.get("message_id", "")
-        if msg_id in processed_ids:
-            continue
+def strip_base_url(url: str) -> str:
+    return url[len(BASE_URL):] if url.startswith(BASE_URL) else url
 
-        msg_type = msg.get("msg_type", "")
-        sender_type = msg.get("sender", {}).get("sender_type", "")
 
-        if msg_type != "interactive" or sender_type != "app":
-            continue
+def interaction_key(method: str, path: str, params: dict | None, body: dict | None, base: float = 0) -> tuple:
+    """回放时匹配请求的键，同键的请求按录制顺序返回。
 
-        # 解析卡片内容
-        try:
-            content = json.loads(msg.get("body", {}).get("content", "{}"))
-        except json.JSONDecodeError:
-            continue
+    消息列表的 start_time / end_time 换算成相对 run 记录时间 base 的偏移（秒）：并发补拉的
+    各分片只靠时间窗区分，不计入的话会互相取走对方的响应；其余随时间变化的参数不计入。
+    """
+    params, body = params or {}, body or {}
+    window = ()
+    if path == "/im/v1/messages" and method == "GET":
+        window = tuple(int(params[k]) - int(base) if str(params.get(k, "")).isdigit() else None
+                       for k in ("start_time", "end_time"))
+    return (method, path, params.get("container_id", ""), params.get("page_token", ""),
+            body.get("receive_id", "")) + window
 
-        # 从 header.title 或顶层 title 取标题
-        title = ""
-        if "header" in content:
-            title_obj = content["header"].get("title", {})
-            if isinstance(title_obj, dict):
-                title = title_obj.get("content", "")
-            elif isinstance(title_obj, str):
-                title = title_obj
-        if not title:
-            title = content.get("title", "")
-        if not title and isinstance(content.get("header"), dict):
-            title = content["header"].get("title", "")
-            if isinstance(title, dict):
-                title = title.get("content", "")
-
-        # 匹配 "恭喜XXX成单"
-        m = re.search(r"恭喜(.+?)成单", title)
-        if not m:
-            continue
 
-        raw_name = m.group(1).strip()
-        clean_name, open_id = match_member(raw_name, member_map)
-        amount_text, amount_value = extract_amount(content)
+def _window_distance(a: tuple, b: tuple) -> float:
+    """两个消息列表键的时间窗偏移之差，键的其余部分不同时为无穷大。"""
+    if a[:5] != b[:5] or len(a) != len(b):
+        return math.inf
+    return sum(abs(x - y) if x is not None and y is not None else (0 if x == y else math.inf)
+               for x, y in zip(a[5:], b[5:]))
+
 
-        log.info("检测到成单: %s (raw=%s), 金额=%s (%.0f元), open_id=%s",
-                 clean_name, raw_name, amount_text, amount_value, open_id)
+class RecordingSession:
+    """包装传输层，把每次请求与响应（脱敏后）追加写入 cassette。
 
-        # 选话术并发送
-        praise_text = pick_praise(clean_name, amount_text, used_praise)
-        send_praise(token, clean_name, open_id, praise_text)
+    每个 RecordingSession 对应一次 run，开头写一条 run 记录（时间、群列表）。
+    """
 
-        new_praise_processed.append(msg_id)
+    def __init__(self, session, path: str, chat_ids: list[str]):
+        import gzip
 
-    # 7. 保存状态（记录本次检查时间）
-    all_processed = list(processed_ids) + new_praise_processed
-    state = {
-        "processed_ids": all_processed,
-        "used_praise": used_praise,
-        "members": member_map,
-        "last_check_time": now,  # 记录本次检查时间，下次从这里开始
-    }
-    save_state(state)
+        self.session = session
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, "at", encoding="utf-8")
+        self._write({"type": "run", "t": time.time(), "chat_ids": chat_ids})
+
+    def _write(self, record: dict):
+        with self._lock:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def request(self, method: str, url: str, **kwargs):
+        start = time.time()
+        resp = self.session.request(method, url, **kwargs)
+        try:
+            body = json.dumps(redact(resp.json()), ensure_ascii=False)
+        except ValueError:
+            body = resp.text
+        self._write({
+            "type": "http",
+            "t": start,
+            "elapsed": time.time() - start,
+            "method": method,
+            "path": strip_base_url(url),
+            "params": kwargs.get("params"),
+            "json": redact(kwargs.get("json")),
+            "status": resp.status_code,
+            "headers": {k: v for k, v in resp.headers.items()
+                        if k.lower() in ("retry-after", "x-ogw-ratelimit-reset")},
+            "body": body,
+        })
+        return resp
 
-    log.info("本次执行完毕: 成单 %d 条, @消息 %d 条, 下次从 %s 开始检查",
-             len(new_praise_processed), len(at_messages),
-             time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(now)))
+    def close(self):
+        with self._lock:
+            self._file.close()
+        self.session.close()
 
 
-if __name__ == "__main__":
-    run()
+class ReplaySession:
+    """按 interaction_key 返回录制的响应，不访问网络。
+
+    每个响应把虚拟时钟推进到录制时的完成时间；没有录制到的请求（如已缓存的 token）
+    返回一个空的成功响应并计数。
+    """
+
+    def __init__(self, clock: VirtualClock):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._queues = {}
+        self.base = 0
+        self.requests = 0
+        self.misses = 0
+
+    def load(self, interactions: list[dict], base: float = 0):
+        """载入一次 run 的请求记录；base 为该 run 记录的时间，消息列表的时间窗相对它匹配。"""
+        with self._lock:
+            self.base = base
+            self._queues = defaultdict(deque)
+            for rec in interactions:
+                key = interaction_key(rec["method"], rec["path"], rec.get("params"), rec.get("json"), base)
+                self._queues[key].append(rec)
+
+    def _pop(self, key: tuple) -> dict | None:
+        queue_ = self._queues.get(key)
+        if queue_:
+            return queue_.popleft()
+        # 回放时虚拟时钟与录制时可能差一两秒，时间窗取偏移最接近的录制
+        best = min((k for k, q in self._queues.items() if q),
+                   key=lambda k: _window_distance(key, k), default=None)
+        if best is None or _window_distance(key, best) > 5:
+            return None
+        return self._queues[best].popleft()
+
+    def request(self, method: str, url: str, **kwargs):
+        path = strip_base_url(url)
+        with self._lock:
+            key = interaction_key(method, path, kwargs.get("params"), kwargs.get("json"), self.base)
+            self.requests += 1
+            rec = self._pop(key)
+            if rec is None:
+                self.misses += 1
+        if rec is None:
+            metrics.inc("replay_misses_total", endpoint=endpoint_key(method, path))
+            if path == "/auth/v3/tenant_access_token/internal":
+                return SimpleResponse(200, {}, '{"code": 0, "tenant_access_token": "replay", "expire": 7200}')
+            return SimpleResponse(200, {}, '{"code": 0, "data": {}}')
+        self.clock.advance_to(rec["t"] + rec.get("elapsed", 0))
+        return SimpleResponse(rec["status"], rec.get("headers") or {}, rec["body"])
+
+    def close(self):
+        pass
+
+
+class VirtualClock:
+    """回放用的虚拟时钟，替换模块里的 time：sleep 只推进时间不真正等待。
+
+    perf_counter 等其余函数仍用真实时钟，指标里的耗时是真实的处理耗时。
+    """
+
+    def __init__(self, real, start: float):
+        self._real = real
+        self._lock = threading.Lock()
+        self.now = start
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        with self._lock:
+            # 时间戳在 1.7e9 附近时精度约 2e-7 秒，太短的等待加上去不变，令牌桶会原地空转
+            self.now = max(self.now + max(0.0, seconds), math.nextafter(self.now, math.inf))
+
+    def advance_to(self, t: float):
+        with self._lock:
+            self.now = max(self.now, t)
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+
+def load_cassette(path: str) -> list[tuple[dict, list[dict]]]:
+    """读取 cassette，按 run 记录分段：[(run 记录, [请求记录])]。"""
+    import gzip
+
+    runs = []
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            if rec["type"] == "run":
+                runs.append((rec, []))
+            elif runs:
+                runs[-1][1].append(rec)
+    return runs
+
+
+def replay(path: str, workdir: str | None = None):
+    """在虚拟时钟下按录制顺序逐次回放 run()，状态写在临时目录，不访问网络。"""
+    global CHAT_IDS, time
+    import tempfile
+
+    runs = load_cassette(path)
+    if not runs:
+        log.error("cassette 为空: %s", path)
+        return
+    workdir = workdir or tempfile.mkdtemp(prefix="replay_")
+    real_time = time
+    clock = VirtualClock(real_time, runs[0][0]["t"])
+    session = ReplaySession(clock)
+    metrics.reset()
+    start = real_time.perf_counter()
+    time = clock
+    try:
+        client = FeishuClient(os.path.join(workdir, "credentials.json"), session=session)
+        for marker, interactions in runs:
+            clock.advance_to(marker["t"])
+            CHAT_IDS = marker.get("chat_ids") or CHAT_IDS
+            session.load(interactions, marker["t"])
+            run(client, StateStore(os.path.join(workdir, "state.db"), legacy_path=""))
+    finally:
+        time = real_time
+    elapsed = time.perf_counter() - start
+    log.info("回放完成: %d 次运行, %d 个请求 (未录制 %d), 虚拟时间跨度 %.1f 小时, 耗时 %.2f 秒, 状态目录 %s",
+             len(runs), session.requests, session.misses,
+             (clock.now - runs[0][0]["t"]) / 3600, elapsed, workdir)
+    metrics.write_summary()
+
+
+# ---------------------------------------------------------------------------
+# 辅助函数
+# ---------------------------------------------------------------------------
+def get_tenant_token(client: FeishuClient) -> tuple[str, int]:
+    """获取飞书 tenant_access_token，返回 (token, 有效秒数)。"""
+    data = client.request(
+        "POST",
+        "/auth/v3/tenant_access_token/internal",
+        auth=False,
+        json={"app_id": APP_ID, "app_secret": APP_SECRET},
+    )
+    if data.get("code") != 0:
+        raise RuntimeError(f"获取 token 失败: {data}")
+    token = data["tenant_access_token"]
+    log.info("获取 tenant_access_token 成功")
+    return token, int(data.get("expire", 7200))
+
+
+def auth_headers(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+
+
+def fetch_members(client: FeishuClient, chat_id: str) -> dict | None:
+    """分页获取全部群成员，返回 {name: open_id}；接口失败返回 None。"""
+    members = {}
+    params = {"member_id_type": "open_id", "page_size": 100}
+    while True:
+        data = client.request("GET", f"/im/v1/chats/{chat_id}/members", params=params)
+        if data.get("code") != 0:
+            log.error("获取群成员失败: %s", data)
+            return None
+        page = data.get("data", {})
+        for item in page.get("items", []):
+            name = item.get("name", "")
+            open_id = item.get("member_id", "")
+            if name and open_id:
+                members[name] = open_id
+        if not page.get("has_more") or not page.get("page_token"):
+            break
+        params["page_token"] = page["page_token"]
+    log.info("[%s] 获取群成员 %d 人", chat_id, len(members))
+    return members
+
+
+class MemberDirectory:
+    """群成员目录：name→open_id 与 open_id→name 双向索引，查找均为 O(1)。
+
+    随 ChatState 持久化，超过 MEMBER_CACHE_TTL 才重新全量拉取。
+    """
+
+    def __init__(self, by_name: dict | None = None, fetched_at: float = 0, memo: dict | None = None):
+        self.by_name = {}
+        self.by_id = {}
+        self.fetched_at = fetched_at
+        # 待保存的成员行变化 {open_id: name or None(删除)}；全量刷新后整体重写
+        self._row_changes = {}
+        self._rewrite = False
+        for name, open_id in (by_name or {}).items():
+            self.add(name, open_id)
+        # 模糊匹配缓存 {raw_name: open_id}，成员变化时清空
+        self.memo = memo or {}
+        self._matcher = None
+
+    @classmethod
+    def from_dict(cls, data: dict) -> MemberDirectory:
+        """从旧版 state.json 迁移。"""
+        # 更早的版本直接存 {name: open_id}，视为已过期
+        if "items" not in data:
+            return cls(data, 0)
+        return cls(data["items"], data.get("fetched_at", 0), data.get("memo"))
+
+    def pending(self) -> tuple[dict, bool]:
+        """自上次保存以来的 (成员行变化, 是否需要整体重写)。"""
+        return self._row_changes, self._rewrite
+
+    def mark_saved(self):
+        self._row_changes = {}
+        self._rewrite = False
+
+    def matcher(self) -> NameMatcher:
+        if self._matcher is None:
+            self._matcher = NameMatcher(self.by_name)
+        return self._matcher
+
+    def _changed(self):
+        self._matcher = None
+        self.memo = {}
+
+    def __len__(self) -> int:
+        return len(self.by_name)
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def stale(self) -> bool:
+        return not self.by_name or self.age() > MEMBER_CACHE_TTL
+
+    def add(self, name: str, open_id: str):
+        if self.by_name.get(name) == open_id:
+            return
+        self._changed()
+        old_name = self.by_id.get(open_id)
+        if old_name is not None and self.by_name.get(old_name) == open_id:
+            del self.by_name[old_name]
+        self.by_name[name] = open_id
+        self.by_id[open_id] = name
+        self._row_changes[open_id] = name
+
+    def remove(self, open_id: str):
+        name = self.by_id.pop(open_id, None)
+        if name is not None:
+            self._row_changes[open_id] = None
+        if name is not None and self.by_name.get(name) == open_id:
+            del self.by_name[name]
+            self._changed()
+
+    def name_of(self, open_id: str, default: str = "未知用户") -> str:
+        return self.by_id.get(open_id, default)
+
+    def refresh(self, client: FeishuClient, chat_id: str) -> bool:
+        """全量刷新，失败或结果为空时保留缓存。"""
+        with metrics.timer("members"):
+            members = fetch_members(client, chat_id)
+        if not members:
+            log.warning("[%s] 群成员为空，使用缓存", chat_id)
+            return False
+        self.fetched_at = time.time()
+        if members == self.by_name:
+            return True
+        self.by_name, self.by_id = {}, {}
+        for name, open_id in members.items():
+            self.add(name, open_id)
+        self._changed()
+        self._row_changes = {}
+        self._rewrite = True
+        return True
+
+
+class FeishuAPIError(RuntimeError):
+    """接口返回 code != 0。"""
+
+
+def fetch_messages(
+    client: FeishuClient, chat_id: str, start_time: str, end_time: str, page_token: str | None = None
+):
+    """逐页拉取 [start_time, end_time] 内的群消息。
+
+    生成器，每拿到一页就产出 (items, next_page_token)，最后一页的 next_page_token 为 None；
+    调用方处理完一页即可保存 next_page_token，中断后从该页续拉。
+    """
+    params = {
+        "container_id_type": "chat",
+        "container_id": chat_id,
+        "start_time": start_time,
+        "end_time": end_time,
+        "sort_type": "ByCreateTimeAsc",
+        "page_size": 50,
+    }
+    total = 0
+    while True:
+        if page_token:
+            params["page_token"] = page_token
+        with metrics.timer("fetch_page"):
+            data = client.request("GET", "/im/v1/messages", params=params)
+        if data.get("code") != 0:
+            raise FeishuAPIError(f"拉取消息失败: {data}")
+        page = data.get("data", {})
+        items = page.get("items", [])
+        total += len(items)
+        metrics.inc("pages_total")
+        metrics.inc("messages_total", len(items))
+        page_token = page.get("page_token") if page.get("has_more") else None
+        yield items, page_token
+        if not page_token:
+            break
+    log.info("[%s] 拉取到 %d 条消息", chat_id, total)
+
+
+def backfill_messages(
+    client: FeishuClient, chat_id: str, start_ts: int, end_ts: int, workers: int = BACKFILL_WORKERS
+):
+    """把 [start_ts, end_ts] 切成 BACKFILL_SLICE_SECONDS 的时间片并发拉取，按时间顺序逐页产出。
+
+    生成器，产出 (items, resume_ts)：中断后从 resume_ts 重新拉取即可续上（片内没有可用的
+    page_token，只能从片头重来），最后一页的 resume_ts 为 None。
+    最多 2 * workers 个时间片在途，内存不随窗口长度增长。相邻片共用边界秒，边界上的重复消息按 id 去掉。
+
+    先按整个窗口拉第一页：窗口里消息不满一页（安静的群、常驻模式的长间隔）时一次请求就结束，
+    只有确实要追赶时才从第一页最后一条消息的时间起切片。
+    """
+    first = fetch_messages(client, chat_id, str(start_ts), str(end_ts))
+    items, page_token = next(first)
+    first.close()
+    if not page_token:
+        yield items, None
+        return
+    start_ts = max(start_ts, message_ts(items[-1])) if items else start_ts
+    yield items, start_ts
+    boundary_ids = {m.get("message_id") for m in items if message_ts(m) >= start_ts}
+
+    bounds = list(range(start_ts, end_ts, BACKFILL_SLICE_SECONDS)) + [end_ts]
+    slices = list(zip(bounds, bounds[1:]))
+
+    def fetch_slice(window: tuple[int, int]) -> list:
+        return [items for items, _ in fetch_messages(client, chat_id, str(window[0]), str(window[1]))]
+
+    log.info("[%s] 补拉 %.1f 小时: %d 个时间片, %d 线程", chat_id,
+             (end_ts - start_ts) / 3600, len(slices), workers)
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        inflight = deque()
+        todo = iter(slices)
+        for window in itertools.islice(todo, 2 * workers):
+            inflight.append((window, pool.submit(fetch_slice, window)))
+        while inflight:
+            (slice_start, slice_end), future = inflight.popleft()
+            for window in itertools.islice(todo, 1):
+                inflight.append((window, pool.submit(fetch_slice, window)))
+            pages = future.result()
+            next_ids = set()
+            for i, items in enumerate(pages):
+                if boundary_ids:
+                    items = [m for m in items if m.get("message_id") not in boundary_ids]
+                next_ids.update(m.get("message_id") for m in items if message_ts(m) >= slice_end)
+                if i < len(pages) - 1:
+                    yield items, slice_start
+                else:
+                    yield items, slice_end if inflight else None
+            boundary_ids = next_ids
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+class NameMatcher:
+    """成员名索引，用于成单卡片人名的模糊匹配。
+
+    - 包含查询词的成员名：取查询词各二元组倒排表的交集，只校验少量候选
+    - 被查询词包含的成员名：枚举查询词的子串直接查字典
+    候选按 (长度接近程度, 是否前缀) 打分，并列第一时视为歧义，不猜。
+    """
+
+    def __init__(self, by_name: dict):
+        self.by_name = by_name
+        self.grams = defaultdict(set)
+        for name in by_name:
+            for g in self._bigrams(name):
+                self.grams[g].add(name)
+
+    @staticmethod
+    def _bigrams(text: str) -> set:
+        return {text[i:i + 2] for i in range(len(text) - 1)}
+
+    def candidates(self, query: str) -> set:
+        # 被查询词包含的成员名
+        found = {
+            query[i:j]
+            for i in range(len(query))
+            for j in range(i + 1, len(query) + 1)
+            if query[i:j] in self.by_name
+        }
+        # 包含查询词的成员名
+        grams = self._bigrams(query)
+        if grams:
+            postings = sorted((self.grams.get(g, set()) for g in grams), key=len)
+            pool = set.intersection(*postings) if postings[0] else set()
+        else:
+            # 单字查询没有二元组可用，退化为扫描
+            pool = self.by_name.keys()
+        found.update(name for name in pool if query in name)
+        return found
+
+    def match(self, query: str) -> tuple[str | None, list[str]]:
+        """返回 (唯一最佳成员名 or None, 并列最佳的候选列表)。"""
+        scored = []
+        for name in self.candidates(query):
+            closeness = min(len(name), len(query)) / max(len(name), len(query))
+            scored.append(((closeness, name.startswith(query) or query.startswith(name)), name))
+        if not scored:
+            return None, []
+        best = max(score for score, _ in scored)
+        top = sorted(name for score, name in scored if score == best)
+        return (top[0] if len(top) == 1 else None), top
+
+
+def match_member(raw_name: str, directory: MemberDirectory) -> tuple:
+    """
+    三层匹配：精确原名 → 精确去尾号名 → 索引模糊匹配。
+    模糊匹配结果会记入 directory 的缓存，跨次运行复用。
+    返回 (clean_name, open_id or None)。
+    """
+    clean_name = re.sub(r"\d+$", "", raw_name).strip()
+    by_name = directory.by_name
+    # 1) 精确匹配原名
+    if raw_name in by_name:
+        return clean_name, by_name[raw_name]
+    # 2) 精确匹配去尾号名
+    if clean_name in by_name:
+        return clean_name, by_name[clean_name]
+    # 3) 模糊匹配（先查缓存）
+    if raw_name in directory.memo:
+        return clean_name, directory.memo[raw_name]
+    if not clean_name:
+        return clean_name, None
+    name, tied = directory.matcher().match(clean_name)
+    if name is None:
+        if tied:
+            log.warning("成单人 %s 匹配到多个成员 %s，不 @ 任何人", raw_name, tied[:5])
+        return clean_name, None
+    directory.memo[raw_name] = by_name[name]
+    return clean_name, by_name[name]
+
+
+def format_money(value: float) -> str:
+    """金额数值转 "X" / "X万"。"""
+    if value >= 10000:
+        wan = value / 10000
+        if wan == int(wan):
+            return f"{int(wan)}万"
+        return f"{wan:.1f}万"
+    return f"{int(value)}"
+
+
+def format_amount(value: float) -> str:
+    """金额数值转显示文本。
+
+    - 金额 >= 20000: "X万大单"
+    - 金额 < 20000: "X" / "X万"
+    - 未找到金额（0）: "这一单"
+    """
+    if not value:
+        return "这一单"
+
+    # 格式化显示金额
+    display = format_money(value)
+
+    # 超过2万才叫"大单"
+    if value >= 20000:
+        return f"{display}大单"
+    return display
+
+
+def extract_amount(content_obj: dict) -> tuple[str, float]:
+    """从卡片内容中提取金额（整张卡片序列化后正则搜索）。
+
+    未注册模板的兜底逻辑，已知模板走 extract_deal。
+    Returns:
+        (显示文本, 数值金额)，未找到金额: ("这一单", 0)
+    """
+    full_text = json.dumps(content_obj, ensure_ascii=False)
+    m = re.search(r"(\d[\d,]*\.?\d*)\s*元", full_text)
+    if not m:
+        return "这一单", 0
+
+    raw = m.group(1).replace(",", "")
+    try:
+        value = float(raw)
+    except ValueError:
+        return "这一单", 0
+    return format_amount(value), value
+
+
+# ---------------------------------------------------------------------------
+# 成单卡片提取
+# ---------------------------------------------------------------------------
+class DealRecord(NamedTuple):
+    """从成单卡片提取的结构化信息。"""
+
+    raw_name: str
+    amount: float  # 未找到金额为 0
+    product: str
+    template: str  # 命中的提取规则
+
+
+def card_title(content: dict) -> str:
+    """从 header.title（对象或字符串）或顶层 title 取卡片标题。"""
+    header = content.get("header")
+    if isinstance(header, dict):
+        title = header.get("title")
+        if isinstance(title, dict):
+            title = title.get("content")
+        if isinstance(title, str) and title:
+            return title
+    title = content.get("title", "")
+    return title if isinstance(title, str) else ""
+
+
+class CardRules:
+    """一类卡片模板的预编译提取规则。
+
+    只遍历标题和正文元素（含多语言的 i18n_elements）里的文本节点，跳过 note（页脚）等无关元素；
+    金额优先取带金额标签（金额/成交/实付...）的文本，其次取第一处 "X元"，
+    正文里没有时再看标题，最后回退到整张卡片搜索（extract_amount）。
+    """
+
+    def __init__(
+        self,
+        key: str,
+        roots: tuple = (("elements",), ("i18n_elements",)),
+        title: str = r"恭喜(.+?)成单",
+        amount: str = r"(\d[\d,]*\.?\d*)\s*元",
+        product: str = r"(?:产品|课程|套餐)\s*[:：]\s*([^\s，,；;]+)",
+        amount_labels: tuple = ("金额", "成交", "实付", "合同"),
+        skip_tags: tuple = ("note", "img", "hr", "action", "button"),
+    ):
+        self.key = key
+        self.roots = roots
+        self.title_re = re.compile(title)
+        self.amount_re = re.compile(amount)
+        self.product_re = re.compile(product)
+        self.amount_labels = amount_labels
+        self.skip_tags = frozenset(skip_tags)
+
+    def texts(self, content: dict):
+        """按文档顺序产出正文文本节点。"""
+        stack = []
+        for root in reversed(self.roots):
+            node = content
+            for key in root:
+                node = node.get(key) if isinstance(node, dict) else None
+            if isinstance(node, dict) and "tag" not in node:
+                # i18n_elements：{语言: [元素]}
+                stack.extend(reversed(list(node.values())))
+            elif node:
+                stack.append(node)
+        while stack:
+            node = stack.pop()
+            if isinstance(node, list):
+                stack.extend(reversed(node))
+            elif isinstance(node, dict):
+                if node.get("tag") in self.skip_tags:
+                    continue
+                text = node.get("text")
+                if isinstance(text, dict):
+                    text = text.get("content")
+                if isinstance(text, str) and text:
+                    yield text
+                if isinstance(node.get("content"), str) and node["content"]:
+                    yield node["content"]
+                for child in ("fields", "columns", "elements"):
+                    if child in node:
+                        stack.append(node[child])
+
+    def extract(self, content: dict) -> DealRecord | None:
+        m = self.title_re.search(card_title(content))
+        if not m:
+            return None
+
+        amount, labeled, product = None, None, ""
+        for text in self.texts(content):
+            if labeled is None and any(label in text for label in self.amount_labels):
+                am = self.amount_re.search(text)
+                if am:
+                    labeled = am.group(1)
+            if amount is None:
+                am = self.amount_re.search(text)
+                if am:
+                    amount = am.group(1)
+            if not product:
+                pm = self.product_re.search(text)
+                if pm:
+                    product = pm.group(1)
+            if labeled is not None and product:
+                break
+
+        raw = labeled or amount
+        if raw is None:
+            am = self.amount_re.search(card_title(content))
+            raw = am.group(1) if am else None
+        if raw is None:
+            _, value = extract_amount(content)
+        else:
+            try:
+                value = float(raw.replace(",", ""))
+            except ValueError:
+                value = 0
+        return DealRecord(m.group(1).strip(), value, product, self.key)
+
+
+# 提取规则注册表：键为模板 ID（"template:<id>"）或卡片 schema 版本
+DEAL_EXTRACTORS = {
+    "1.0": CardRules("1.0"),
+    "2.0": CardRules("2.0", roots=(("body", "elements"), ("i18n_elements",))),
+}
+
+
+def register_deal_extractor(key: str, rules: CardRules):
+    """为新的卡片模板注册提取规则，如 register_deal_extractor("template:AAq...", CardRules(...))。"""
+    DEAL_EXTRACTORS[key] = rules
+
+
+def card_template_key(content: dict) -> str:
+    """卡片对应的规则键：模板卡片用模板 ID，其余按 schema 版本。"""
+    if content.get("type") == "template":
+        return "template:" + str(content.get("data", {}).get("template_id", ""))
+    if content.get("schema") == "2.0":
+        return "2.0"
+    return "1.0"
+
+
+def extract_deal(content: dict) -> DealRecord | None:
+    """提取成单信息；不是成单卡片返回 None。
+
+    未注册的模板回退到旧逻辑（card_title + extract_amount）。
+    """
+    rules = DEAL_EXTRACTORS.get(card_template_key(content))
+    if rules is not None:
+        return rules.extract(content)
+
+    m = re.search(r"恭喜(.+?)成单", card_title(content))
+    if not m:
+        return None
+    _, value = extract_amount(content)
+    return DealRecord(m.group(1).strip(), value, "", "fallback")
+
+
+class PraisePack:
+    """一组话术模板，加载时校验：只允许 {name} 和 {amount} 两个字段，且必须含 {name}。"""
+
+    FIELDS = {"name", "amount"}
+
+    def __init__(self, pack_id: str, templates: list[str]):
+        if not templates:
+            raise ValueError(f"话术包 {pack_id} 为空")
+        for text in templates:
+            fields = set()
+            try:
+                for _, field, spec, conversion in string.Formatter().parse(text):
+                    if field is None:
+                        continue
+                    if field not in self.FIELDS or spec or conversion:
+                        raise ValueError(f"不支持的字段 {{{field}}}")
+                    fields.add(field)
+            except ValueError as e:
+                raise ValueError(f"话术包 {pack_id} 模板无效: {text!r}: {e}") from None
+            if "name" not in fields:
+                raise ValueError(f"话术包 {pack_id} 模板缺少 {{name}}: {text!r}")
+        self.pack_id = pack_id
+        self.templates = list(templates)
+
+
+class PraisePool:
+    """排期窗口内生效的若干话术包，按 (seed, cursor) 给出一副洗过的牌。
+
+    洗牌用仿射置换 i -> (a * i + b) mod n（a 与 n 互素），由 seed 决定 a、b，
+    每人只需存 seed 和 cursor，选一条 O(1)，一轮 n 条内不重复。
+    """
+
+    def __init__(self, packs: list[PraisePack]):
+        self.key = "+".join(p.pack_id for p in packs)
+        self.templates = [t for p in packs for t in p.templates]
+        n = len(self.templates)
+        self.multipliers = [a for a in range(1, n) if math.gcd(a, n) == 1] or [1]
+
+    def __len__(self) -> int:
+        return len(self.templates)
+
+    def new_seed(self) -> int:
+        return random.randrange(len(self.templates) * len(self.multipliers))
+
+    def template(self, seed: int, cursor: int) -> str:
+        n = len(self.templates)
+        a = self.multipliers[(seed // n) % len(self.multipliers)]
+        return self.templates[(a * cursor + seed) % n]
+
+
+_praise_packs = {}  # 已加载 {pack_id: PraisePack}
+_praise_pools = {}  # {(pack_id, ...): PraisePool}
+_praise_lock = threading.Lock()
+
+
+def register_praise_pack(pack: PraisePack):
+    """注册（或覆盖）一个话术包。"""
+    with _praise_lock:
+        _praise_packs[pack.pack_id] = pack
+        _praise_pools.clear()
+
+
+def load_praise_pack(pack_id: str) -> PraisePack:
+    """按 id 取话术包：内置包或 PRAISE_PACK_DIR/<id>.json，首次使用时加载并校验。"""
+    pack = _praise_packs.get(pack_id)
+    if pack is not None:
+        return pack
+    if pack_id in BUILTIN_PRAISE_PACKS:
+        pack = PraisePack(pack_id, BUILTIN_PRAISE_PACKS[pack_id])
+    else:
+        path = os.path.join(PRAISE_PACK_DIR, f"{pack_id}.json")
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        templates = data.get("templates", []) if isinstance(data, dict) else data
+        pack = PraisePack(pack_id, templates)
+        log.info("已加载话术包 %s: %d 条", pack_id, len(pack.templates))
+    with _praise_lock:
+        return _praise_packs.setdefault(pack_id, pack)
+
+
+def active_praise_pool(today: str | None = None) -> PraisePool:
+    """按 PRAISE_SCHEDULE 取当天生效的话术池；加载失败的包跳过，全部失败时用内置包。"""
+    today = today or time.strftime("%Y-%m-%d", time.localtime(time.time()))
+    pack_ids = tuple(BUILTIN_PRAISE_PACKS)
+    for window in PRAISE_SCHEDULE:
+        if window.get("from", "") <= today < window.get("until", "9999-12-31"):
+            pack_ids = tuple(window["packs"])
+            break
+
+    pool = _praise_pools.get(pack_ids)
+    if pool is not None:
+        return pool
+    packs = []
+    for pack_id in pack_ids:
+        try:
+            packs.append(load_praise_pack(pack_id))
+        except (OSError, ValueError) as e:
+            log.error("话术包 %s 不可用，跳过: %s", pack_id, e)
+    if not packs:
+        packs = [load_praise_pack(pack_id) for pack_id in BUILTIN_PRAISE_PACKS]
+    pool = PraisePool(packs)
+    with _praise_lock:
+        return _praise_pools.setdefault(pack_ids, pool)
+
+
+def pick_praise(clean_name: str, amount: str, used: dict) -> str:
+    """为指定人选一条话术，一轮内不重复。
+
+    used[clean_name] 记录这个人的牌：[话术池 key, seed, cursor]；
+    一轮抽完或排期切换了话术池时重新洗牌。
+    """
+    pool = active_praise_pool()
+    deck = used.get(clean_name)
+    if not (isinstance(deck, list) and len(deck) == 3 and deck[0] == pool.key
+            and deck[2] < len(pool)):
+        # 新人、一轮已抽完、话术池变化或旧版的下标列表
+        deck = [pool.key, pool.new_seed(), 0]
+    template = pool.template(deck[1], deck[2])
+    used[clean_name] = [deck[0], deck[1], deck[2] + 1]
+    return template.format(name=clean_name, amount=amount)
+
+
+def get_bot_info(client: FeishuClient) -> dict:
+    """获取机器人自身信息，返回 {open_id, app_name}。"""
+    data = client.request("GET", "/bot/v3/info")
+    if data.get("code") != 0:
+        log.error("获取机器人信息失败: %s", data)
+        return {}
+    bot = data.get("bot", {})
+    log.info("机器人信息: %s (open_id=%s)", bot.get("app_name"), bot.get("open_id"))
+    return bot
+
+
+def detect_at_bot_message(pm: ParsedMessage, bot_open_id: str, directory: MemberDirectory) -> dict | None:
+    """检测一条用户消息是否 @机器人。
+
+    Returns:
+        {msg_id, create_ts, sender_name, sender_id, content, time}，未 @机器人 返回 None
+    """
+    content = pm.content
+    has_at_bot = False
+    text_content = ""
+
+    if pm.msg_type == "text":
+        # 文本消息格式: {"text": "@_user_1 xxx", "mentions": [{"key": "@_user_1", "id": {"open_id": "xxx"}}]}
+        text_content = content.get("text", "")
+        # 拉取接口与事件推送的 mentions 都在消息顶层
+        mentions = content.get("mentions") or pm.raw.get("mentions") or []
+        for mention in mentions:
+            mention_id = mention.get("id", {})
+            if isinstance(mention_id, dict):
+                mention_id = mention_id.get("open_id")
+            if mention_id == bot_open_id:
+                has_at_bot = True
+                break
+
+    elif pm.msg_type == "post":
+        # 富文本消息，遍历内容查找 at 标签；
+        # 事件推送按语言分组 {"zh_cn": {...}}，拉取接口直接是 {"title", "content"}
+        texts = []
+        blocks = [content] if isinstance(content.get("content"), list) else content.values()
+        for lang_content in blocks:
+            if not isinstance(lang_content, dict):
+                continue
+            for line in lang_content.get("content", []):
+                for elem in line:
+                    if elem.get("tag") == "text":
+                        texts.append(elem.get("text", ""))
+                    elif elem.get("tag") == "at" and elem.get("user_id") == bot_open_id:
+                        has_at_bot = True
+        text_content = " ".join(texts)
+
+    if not has_at_bot:
+        return None
+
+    # 清理 @标记，提取纯文本
+    clean_text = re.sub(r"@_user_\d+\s*", "", text_content).strip()
+
+    # 获取发送者信息
+    sender_name = directory.name_of(pm.sender_id)
+
+    # 获取消息时间
+    create_time = pm.raw.get("create_time", "")
+    if create_time:
+        try:
+            ts = int(create_time) // 1000 if len(create_time) > 10 else int(create_time)
+            time_str = time.strftime("%H:%M", time.localtime(ts))
+        except (ValueError, OSError):
+            time_str = "未知时间"
+    else:
+        time_str = "未知时间"
+
+    log.info("检测到 @机器人 消息: %s 说: %s", sender_name, clean_text[:50])
+    return {
+        "msg_id": pm.msg_id,
+        "create_ts": message_ts(pm.raw),
+        "sender_name": sender_name,
+        "sender_id": pm.sender_id,
+        "content": clean_text if clean_text else "(无文字内容)",
+        "time": time_str,
+    }
+
+
+def post_message(client: FeishuClient, receive_id_type: str, body: dict, uuid: str | None = None) -> dict:
+    """发送一条消息。带 uuid 时飞书对一小时内相同 uuid 的请求只发一次。"""
+    if uuid:
+        body = {**body, "uuid": uuid}
+    return client.request("POST", "/im/v1/messages", params={"receive_id_type": receive_id_type}, json=body)
+
+
+def reply_message(client: FeishuClient, msg_id: str, text: str, uuid: str | None = None) -> dict:
+    """在原消息下回复一条文本消息。"""
+    body = {"msg_type": "text", "content": json.dumps({"text": text}, ensure_ascii=False)}
+    if uuid:
+        body["uuid"] = uuid
+    return client.request("POST", f"/im/v1/messages/{msg_id}/reply", json=body)
+
+
+def at_summary_message(at_messages: list[dict], seqs: list[int] | None = None) -> dict:
+    """@消息汇总（私聊管理员）的消息体。
+
+    seqs 为 MentionIndex 分配的全局序号，管理员按序号回复会转发到原消息下；为空时按 1..N 编号。
+    """
+    seqs = seqs or range(1, len(at_messages) + 1)
+    lines = [f"📬 收到 {len(at_messages)} 条 @消息：\n"]
+    for seq, msg in zip(seqs, at_messages):
+        lines.append(f"{seq}. 【{msg['time']}】{msg['sender_name']}：")
+        lines.append(f"   {msg['content']}\n")
+
+    lines.append("\n💡 请回复对应序号+内容来回复用户，可一行一条批量回复")
+    lines.append(f"例如：{seqs[0]} 好的，收到！")
+
+    return {
+        "receive_id": ADMIN_OPEN_ID,
+        "msg_type": "text",
+        "content": json.dumps({"text": "\n".join(lines)}, ensure_ascii=False),
+    }
+
+
+def praise_message(chat_id: str, clean_name: str, open_id: str | None, praise_text: str) -> dict:
+    """夸奖消息体：有 open_id 时富文本 @ 本人，否则纯文本。"""
+    if open_id:
+        msg_content = {
+            "zh_cn": {
+                "title": "",
+                "content": [
+                    [
+                        {"tag": "at", "user_id": open_id},
+                        {"tag": "text", "text": "伙伴 "},
+                    ],
+                    [
+                        {"tag": "text", "text": praise_text},
+                    ],
+                ],
+            }
+        }
+        return {
+            "receive_id": chat_id,
+            "msg_type": "post",
+            "content": json.dumps(msg_content, ensure_ascii=False),
+        }
+    # 纯文本回退
+    return {
+        "receive_id": chat_id,
+        "msg_type": "text",
+        "content": json.dumps({"text": f"{clean_name}伙伴 {praise_text}"}, ensure_ascii=False),
+    }
+
+
+def digest_message(chat_id: str, rows: list[tuple]) -> dict:
+    """一批夸奖合成的富文本消息体，rows 为 [(clean_name, open_id, praise_text)]。"""
+    content = []
+    for clean_name, open_id, praise_text in rows:
+        if open_id:
+            content.append([{"tag": "at", "user_id": open_id}, {"tag": "text", "text": f" {praise_text}"}])
+        else:
+            content.append([{"tag": "text", "text": f"{clean_name}伙伴 {praise_text}"}])
+    msg_content = {"zh_cn": {"title": f"🎉 捷报频传：{len(rows)} 位伙伴成单", "content": content}}
+    return {
+        "receive_id": chat_id,
+        "msg_type": "post",
+        "content": json.dumps(msg_content, ensure_ascii=False),
+    }
+
+
+def send_at_summary(client: FeishuClient, at_messages: list[dict]):
+    """发送 @消息汇总给管理员。"""
+    if not at_messages:
+        return
+
+    if not ADMIN_OPEN_ID:
+        log.warning("未配置 ADMIN_OPEN_ID，无法发送 @消息汇总")
+        return
+
+    data = post_message(client, "open_id", at_summary_message(at_messages))
+    if data.get("code") != 0:
+        log.error("发送 @消息汇总失败: %s", data)
+    else:
+        log.info("@消息汇总已发送给管理员，共 %d 条", len(at_messages))
+
+
+def send_praise(
+    client: FeishuClient, chat_id: str, clean_name: str, open_id: str | None, praise_text: str
+):
+    """发送夸奖消息到群聊。"""
+    data = post_message(client, "chat_id", praise_message(chat_id, clean_name, open_id, praise_text))
+    if data.get("code") != 0:
+        log.error("发送消息失败: %s", data)
+    else:
+        log.info("[%s] 夸奖已发送: %s -> %s", chat_id, clean_name, praise_text[:40])
+
+
+def send_digest(client: FeishuClient, chat_id: str, rows: list[tuple]):
+    """把一批夸奖合成一条富文本消息发送，rows 为 [(clean_name, open_id, praise_text)]。"""
+    data = post_message(client, "chat_id", digest_message(chat_id, rows))
+    if data.get("code") != 0:
+        log.error("发送成单汇总失败: %s", data)
+    else:
+        log.info("[%s] 成单汇总已发送: %d 人", chat_id, len(rows))
+
+
+class OutboxIntent(NamedTuple):
+    """一条待发送消息：先写入 outbox 再发送，发送确认后删除。"""
+
+    key: str  # 幂等键，同时作为飞书的 uuid 去重参数
+    kind: str  # praise / digest / at_summary
+    receive_id_type: str
+    body: dict
+    note: str  # 发送成功时的日志
+    ids: list  # 触发这条消息的源消息 [(msg_id, create_ts)]
+    hits: list  # 送达后计入成单统计的 [(person, name, amount, ts)]
+    priority: int
+    created_at: float
+
+
+def make_intent(chat_id: str, kind: str, receive_id_type: str, body: dict, note: str, ids: list,
+                hits: list = (), priority: int = PRIORITY_PRAISE) -> OutboxIntent:
+    """幂等键由群、类型和源消息 id 决定，同一批源消息重试时键不变。"""
+    source = ",".join(sorted(msg_id for msg_id, _ in ids))
+    key = hashlib.sha1(f"{chat_id}:{kind}:{source}".encode("utf-8")).hexdigest()[:32]
+    return OutboxIntent(key, kind, receive_id_type, body, note, [list(i) for i in ids],
+                        [list(h) for h in hits], priority, time.time())
+
+
+def deliver_intent(client: FeishuClient, intent: OutboxIntent) -> dict:
+    """发送一条 outbox 消息；接口异常或返回 code != 0 时抛出，意图留在 outbox 里等待重试。"""
+    data = post_message(client, intent.receive_id_type, intent.body, intent.key)
+    if data.get("code") != 0:
+        log.error("发送消息失败 (%s): %s", intent.kind, data)
+        raise FeishuAPIError(f"发送消息失败 ({intent.kind}): {data}")
+    log.info("%s", intent.note)
+    return data
+
+
+# ---------------------------------------------------------------------------
+# 状态管理
+# ---------------------------------------------------------------------------
+class DedupStore:
+    """按消息 create_time 排序的已处理消息集合。
+
+    成员判断 O(1)；早于 DEDUP_WINDOW_SECONDS 的记录按时间顺序淘汰（小顶堆），
+    因此无论群里消息多少，内存与状态大小都有上界。
+    记录自上次保存以来新增/淘汰的条目，保存时只写这些变化。
+    """
+
+    def __init__(self):
+        self._ts = {}  # {msg_id: create_time 秒}
+        self._heap = []  # [(create_time, msg_id)]，可能含已覆盖的旧条目
+        self._added = {}  # 待保存的新增 {msg_id: ts}
+        self._dropped = set()  # 待保存的淘汰 msg_id
+
+    @classmethod
+    def from_dict(cls, data) -> DedupStore:
+        """从旧版 state.json 迁移：id 列表（无时间戳）或 {ids, t} 差分格式。"""
+        store = cls()
+        if isinstance(data, list):
+            # 旧版状态只有 id 列表，没有时间戳：按加载时间记，一个窗口后自然淘汰
+            now = int(time.time())
+            for msg_id in data:
+                store.add(msg_id, now)
+            return store
+        ts = 0
+        for msg_id, delta in zip(data.get("ids", []), data.get("t", [])):
+            ts += delta
+            store.add(msg_id, ts)
+        return store
+
+    def pending(self) -> tuple[dict, set]:
+        """自上次保存以来的 (新增 {msg_id: ts}, 淘汰 msg_id 集合)。"""
+        return self._added, self._dropped
+
+    def mark_saved(self):
+        self._added = {}
+        self._dropped = set()
+
+    def __contains__(self, msg_id: str) -> bool:
+        return msg_id in self._ts
+
+    def __len__(self) -> int:
+        return len(self._ts)
+
+    def add(self, msg_id: str, ts: int | None = None):
+        ts = int(ts or time.time())
+        if self._ts.get(msg_id) == ts:
+            return
+        self._ts[msg_id] = ts
+        heapq.heappush(self._heap, (ts, msg_id))
+        self._added[msg_id] = ts
+        self._dropped.discard(msg_id)
+
+    def evict(self, now: float | None = None):
+        """淘汰窗口外及超出条数上限的最旧记录。"""
+        cutoff = (now or time.time()) - DEDUP_WINDOW_SECONDS
+        heap, ts_map = self._heap, self._ts
+        while heap and (heap[0][0] < cutoff or len(ts_map) > DEDUP_MAX_ENTRIES):
+            ts, msg_id = heapq.heappop(heap)
+            if ts_map.get(msg_id) == ts:
+                del ts_map[msg_id]
+                self._added.pop(msg_id, None)
+                self._dropped.add(msg_id)
+        # 旧条目太多时重建堆
+        if len(heap) > 2 * len(ts_map) + 64:
+            self._heap = [(ts, msg_id) for msg_id, ts in ts_map.items()]
+            heapq.heapify(self._heap)
+
+
+class Outbox:
+    """尚未确认送达的发送意图（OutboxIntent），随群状态一起落盘。
+
+    检测到成单 / @消息时先写入意图（同一事务里源消息记为已处理）再发送，送达后删除；
+    发送前后崩溃、超时或发送失败的意图在下次运行按原幂等键重发，飞书按 uuid 去重，
+    不会重复夸奖。连续失败 OUTBOX_MAX_ATTEMPTS 次、或创建超过 OUTBOX_RESEND_WINDOW 的意图放弃。
+    """
+
+    def __init__(self):
+        self.intents = {}  # {key: OutboxIntent}
+        self.attempts = {}  # {key: 已失败次数}
+        self._dirty = set()  # 待保存的新增 / 失败次数变化
+        self._removed = set()  # 待保存的删除（送达或放弃）
+
+    def __len__(self) -> int:
+        return len(self.intents)
+
+    def __iter__(self):
+        return iter(sorted(self.intents.values(), key=lambda i: i.created_at))
+
+    def add(self, intent: OutboxIntent, attempts: int = 0):
+        self.intents[intent.key] = intent
+        self.attempts[intent.key] = attempts
+        self._dirty.add(intent.key)
+        self._removed.discard(intent.key)
+
+    def delivered(self, key: str):
+        self._remove(key)
+
+    def failed(self, key: str):
+        if key not in self.intents:
+            return
+        self.attempts[key] += 1
+        if self.attempts[key] >= OUTBOX_MAX_ATTEMPTS:
+            intent = self.intents[key]
+            log.error("消息发送连续失败 %d 次，放弃: %s %s", self.attempts[key], intent.kind, key)
+            metrics.inc("outbox_dropped_total", kind=intent.kind)
+            self._remove(key)
+        else:
+            self._dirty.add(key)
+
+    def drop_expired(self, cutoff: float) -> int:
+        """放弃 cutoff 之前创建的意图（已超出 uuid 去重窗口），返回放弃条数。"""
+        expired = [i for i in self.intents.values() if i.created_at < cutoff]
+        for intent in expired:
+            log.error("消息超出去重窗口仍未确认送达，放弃重发（可能已送达）: %s %s", intent.kind, intent.note)
+            metrics.inc("outbox_expired_total", kind=intent.kind)
+            self._remove(intent.key)
+        return len(expired)
+
+    def _remove(self, key: str):
+        self.intents.pop(key, None)
+        self.attempts.pop(key, None)
+        self._dirty.discard(key)
+        self._removed.add(key)
+
+    def pending(self) -> tuple[list, set]:
+        """自上次保存以来的 ([(intent, 失败次数)] 新增或更新, 删除的 key)。"""
+        return [(self.intents[k], self.attempts[k]) for k in self._dirty], self._removed
+
+    def mark_saved(self):
+        self._dirty = set()
+        self._removed = set()
+
+
+class DealStats:
+    """成单统计的增量累加：日 / 周 / 月 × 人的单数、金额、最大单，以及连续开单天数。
+
+    内存里只有尚未保存的增量和每人一条连续天数记录，保存时累加到数据库；
+    团队合计记在 person = TEAM 的行上。排行榜直接按周期查表，成本 O(人数)。
+    """
+
+    TEAM = "*"
+
+    def __init__(self):
+        self.pending = {}  # {(period, person): [name, count, total, max]}
+        self.streaks = {}  # {person: [name, last_day, streak, best]}
+        self.streaks_dirty = set()
+
+    @staticmethod
+    def periods(ts: float) -> tuple[str, str, str]:
+        t = time.localtime(ts)
+        return (time.strftime("d:%Y-%m-%d", t), time.strftime("w:%G-W%V", t),
+                time.strftime("m:%Y-%m", t))
+
+    def record(self, person: str, name: str, amount: float, ts: float):
+        for period in self.periods(ts):
+            for key, label in ((person, name), (self.TEAM, "")):
+                row = self.pending.get((period, key))
+                if row is None:
+                    row = self.pending[(period, key)] = [label, 0, 0.0, 0.0]
+                row[1] += 1
+                row[2] += amount
+                row[3] = max(row[3], amount)
+
+        day = date.fromtimestamp(ts)
+        streak = self.streaks.get(person)
+        if streak is None:
+            streak = self.streaks[person] = [name, "", 0, 0]
+        last = date.fromisoformat(streak[1]) if streak[1] else None
+        if last is not None and day <= last:
+            return
+        streak[0] = name
+        streak[2] = streak[2] + 1 if last is not None and day - last == timedelta(days=1) else 1
+        streak[1] = day.isoformat()
+        streak[3] = max(streak[3], streak[2])
+        self.streaks_dirty.add(person)
+
+    def mark_saved(self):
+        self.pending = {}
+        self.streaks_dirty = set()
+
+
+class MessageCursor:
+    """消息高水位游标：见过的最新 create_time（毫秒），以及重叠窗口内见过的 message_id。
+
+    下次从 ts - CURSOR_OVERLAP_SECONDS 开始拉取，重叠部分里 id 已见过的消息直接跳过，
+    同一毫秒的多条消息也按 id 区分；窗口内晚到的新消息照常处理。
+    """
+
+    def __init__(self, ts: int = 0, recent: dict | None = None):
+        self.ts = ts
+        self.recent = recent or {}  # {msg_id: create_time 毫秒}，只保留重叠窗口内的
+
+    @classmethod
+    def from_dict(cls, data: dict | None) -> MessageCursor | None:
+        if not data:
+            return None
+        return cls(data["ts"], dict(data.get("recent", {})))
+
+    def to_dict(self) -> dict:
+        return {"ts": self.ts, "recent": self.recent}
+
+    def copy(self) -> MessageCursor:
+        return MessageCursor(self.ts, dict(self.recent))
+
+    def start_time(self) -> int:
+        """下次拉取的起始时间（秒）。"""
+        return (self.ts // 1000) - CURSOR_OVERLAP_SECONDS
+
+    def seen(self, msg: dict) -> bool:
+        return msg.get("message_id", "") in self.recent
+
+    def advance(self, messages: list):
+        """把已处理的消息并入游标，并丢掉落出重叠窗口的 id。"""
+        for msg in messages:
+            try:
+                ts = int(msg.get("create_time", "0"))
+            except ValueError:
+                continue
+            if ts >= self.ts - CURSOR_OVERLAP_SECONDS * 1000:
+                self.recent[msg.get("message_id", "")] = ts
+            self.ts = max(self.ts, ts)
+        floor = self.ts - CURSOR_OVERLAP_SECONDS * 1000
+        if any(ts < floor for ts in self.recent.values()):
+            self.recent = {k: ts for k, ts in self.recent.items() if ts >= floor}
+
+
+class ChatState:
+    """单个群的状态：已处理消息、话术轮换、成员目录、消息游标、拉取断点、成单统计、待发送消息。"""
+
+    def __init__(self, data: dict | None = None):
+        data = data or {}
+        self.processed_ids = DedupStore.from_dict(data.get("processed_ids", []))
+        self.used_praise = data.get("used_praise", {})  # {clean_name: [话术池 key, seed, cursor]}
+        self.directory = MemberDirectory.from_dict(data.get("members", {}))
+        # 上次拉取窗口的结束时间；没有游标（群里还没有消息、旧版状态）时从这里开始
+        self.last_check_time = data.get("last_check_time")
+        self.cursor = MessageCursor.from_dict(data.get("cursor"))
+        # 未拉完的窗口：{start_time, end_time, page_token, last_ts, cursor}，拉完后清空
+        self.checkpoint = data.get("checkpoint")
+        # 待保存的话术轮换记录
+        self.praise_dirty = set(self.used_praise)
+        self.stats = DealStats()
+        self.outbox = Outbox()
+
+    def mark_saved(self):
+        self.processed_ids.mark_saved()
+        self.directory.mark_saved()
+        self.praise_dirty = set()
+        self.stats.mark_saved()
+        self.outbox.mark_saved()
+
+
+class StateStore:
+    """SQLite 状态存储。
+
+    游标、去重记录、话术轮换、成员缓存各占一张表；每次保存只写变化的行，
+    并在一个事务内提交，进程中途崩溃不会留下写了一半的状态。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cursors (
+            chat_id TEXT PRIMARY KEY,
+            last_check_time INTEGER,
+            checkpoint TEXT,
+            cursor TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dedup (
+            chat_id TEXT NOT NULL,
+            msg_id TEXT NOT NULL,
+            ts INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, msg_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS praise (
+            chat_id TEXT NOT NULL,
+            person TEXT NOT NULL,
+            used TEXT NOT NULL,
+            PRIMARY KEY (chat_id, person)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS members (
+            chat_id TEXT NOT NULL,
+            open_id TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (chat_id, open_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS member_meta (
+            chat_id TEXT PRIMARY KEY,
+            fetched_at REAL NOT NULL,
+            memo TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS deal_stats (
+            chat_id TEXT NOT NULL,
+            period TEXT NOT NULL,
+            person TEXT NOT NULL,
+            name TEXT NOT NULL,
+            deals INTEGER NOT NULL,
+            total REAL NOT NULL,
+            max_deal REAL NOT NULL,
+            PRIMARY KEY (chat_id, period, person)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS deal_streaks (
+            chat_id TEXT NOT NULL,
+            person TEXT NOT NULL,
+            name TEXT NOT NULL,
+            last_day TEXT NOT NULL,
+            streak INTEGER NOT NULL,
+            best INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, person)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS outbox (
+            chat_id TEXT NOT NULL,
+            key TEXT NOT NULL,
+            intent TEXT NOT NULL,
+            attempts INTEGER NOT NULL,
+            PRIMARY KEY (chat_id, key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS kv (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS mentions (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id TEXT NOT NULL,
+            msg_id TEXT NOT NULL,
+            sender_id TEXT NOT NULL,
+            sender_name TEXT NOT NULL,
+            content TEXT NOT NULL,
+            created_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str = STATE_DB, legacy_path: str = STATE_FILE):
+        self.path = path
+        self.legacy_path = legacy_path  # 旧版 state.json，为空不迁移
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript(self.SCHEMA)
+            self._upgrade_schema()
+
+    def _upgrade_schema(self):
+        """给旧版数据库补上后来新增的列。"""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(cursors)")}
+        if "cursor" not in columns:
+            self.conn.execute("ALTER TABLE cursors ADD COLUMN cursor TEXT")
+
+    def close(self):
+        with self._lock:
+            # 合并 WAL，单个 .db 文件即是完整状态（便于 Actions 缓存）
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.close()
+
+    def load(self, chat_ids: list[str] | None = None) -> dict:
+        """加载群的状态，返回 {chat_id: ChatState}；chat_ids 为空时加载全部。"""
+        states = self._migrate_json()
+        if states is None:
+            states = {}
+            rows = self.conn.execute("SELECT chat_id, last_check_time, checkpoint, cursor FROM cursors")
+            for chat_id, last_check_time, checkpoint, cursor in rows:
+                if chat_ids is not None and chat_id not in chat_ids:
+                    continue
+                cs = states[chat_id] = ChatState()
+                cs.last_check_time = last_check_time
+                cs.checkpoint = json.loads(checkpoint) if checkpoint else None
+                cs.cursor = MessageCursor.from_dict(json.loads(cursor) if cursor else None)
+            for chat_id in CHAT_IDS if chat_ids is None else chat_ids:
+                states.setdefault(chat_id, ChatState())
+            self._load_tables(states)
+        elif chat_ids is not None:
+            states = {chat_id: states.get(chat_id) or ChatState() for chat_id in chat_ids}
+
+        for chat_id, cs in states.items():
+            log.info("[%s] 加载状态: %d 条已处理消息, %d 人话术记录, 游标=%s",
+                     chat_id, len(cs.processed_ids), len(cs.used_praise),
+                     cs.cursor.ts if cs.cursor else "未设置")
+        return states
+
+    def _load_tables(self, states: dict):
+        conn = self.conn
+        for chat_id, msg_id, ts in conn.execute("SELECT chat_id, msg_id, ts FROM dedup"):
+            if chat_id in states:
+                states[chat_id].processed_ids.add(msg_id, ts)
+        for chat_id, person, used in conn.execute("SELECT chat_id, person, used FROM praise"):
+            if chat_id in states:
+                states[chat_id].used_praise[person] = json.loads(used)
+        for chat_id, open_id, name in conn.execute("SELECT chat_id, open_id, name FROM members"):
+            if chat_id in states:
+                states[chat_id].directory.add(name, open_id)
+        for chat_id, fetched_at, memo in conn.execute(
+            "SELECT chat_id, fetched_at, memo FROM member_meta"
+        ):
+            if chat_id in states:
+                states[chat_id].directory.fetched_at = fetched_at
+                states[chat_id].directory.memo = json.loads(memo)
+        for chat_id, person, *streak in conn.execute(
+            "SELECT chat_id, person, name, last_day, streak, best FROM deal_streaks"
+        ):
+            if chat_id in states:
+                states[chat_id].stats.streaks[person] = streak
+        for chat_id, intent, attempts in conn.execute("SELECT chat_id, intent, attempts FROM outbox"):
+            if chat_id in states:
+                states[chat_id].outbox.add(OutboxIntent(**json.loads(intent)), attempts)
+        for cs in states.values():
+            cs.mark_saved()
+
+    def _migrate_json(self) -> dict | None:
+        """数据库为空且存在旧版 state.json 时迁移过来，返回迁移后的状态。"""
+        if not self.legacy_path or not os.path.exists(self.legacy_path):
+            return None
+        if self.conn.execute("SELECT 1 FROM cursors LIMIT 1").fetchone():
+            return None
+        try:
+            with open(self.legacy_path, "r", encoding="utf-8") as f:
+                raw = json.load(f)
+        except (json.JSONDecodeError, IOError) as e:
+            log.warning("加载 %s 失败，使用空状态: %s", self.legacy_path, e)
+            return None
+
+        # 兼容更早的单群格式：顶层字段归入 CHAT_ID
+        chats = raw.get("chats")
+        if chats is None:
+            chats = {CHAT_ID: raw} if raw else {}
+        states = {chat_id: ChatState(data) for chat_id, data in chats.items()}
+        for chat_id in CHAT_IDS:
+            states.setdefault(chat_id, ChatState())
+        for chat_id, cs in states.items():
+            cs.directory._rewrite = True
+            self.save_chat(chat_id, cs)
+        os.replace(self.legacy_path, self.legacy_path + ".migrated")
+        log.info("已将 %s 迁移到 %s", self.legacy_path, self.path)
+        return states
+
+    def save_chat(self, chat_id: str, cs: ChatState):
+        """在一个事务内保存该群自上次保存以来的变化。
+
+        由处理该群的线程调用；不同群的保存互不阻塞读取，写入串行。
+        """
+        cs.processed_ids.evict()
+        added, dropped = cs.processed_ids.pending()
+        row_changes, rewrite = cs.directory.pending()
+        outbox_changes, outbox_removed = cs.outbox.pending()
+        directory = cs.directory
+        with self._lock, self.conn as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO cursors (chat_id, last_check_time, checkpoint, cursor)"
+                " VALUES (?, ?, ?, ?)",
+                (chat_id, cs.last_check_time,
+                 json.dumps(cs.checkpoint) if cs.checkpoint else None,
+                 json.dumps(cs.cursor.to_dict()) if cs.cursor else None),
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO dedup VALUES (?, ?, ?)",
+                [(chat_id, msg_id, ts) for msg_id, ts in added.items()],
+            )
+            conn.executemany(
+                "DELETE FROM dedup WHERE chat_id = ? AND msg_id = ?",
+                [(chat_id, msg_id) for msg_id in dropped],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO praise VALUES (?, ?, ?)",
+                [(chat_id, person, json.dumps(cs.used_praise.get(person, [])))
+                 for person in cs.praise_dirty],
+            )
+            if rewrite:
+                conn.execute("DELETE FROM members WHERE chat_id = ?", (chat_id,))
+                row_changes = directory.by_id
+            conn.executemany(
+                "INSERT OR REPLACE INTO members VALUES (?, ?, ?)",
+                [(chat_id, oid, name) for oid, name in row_changes.items() if name is not None],
+            )
+            conn.executemany(
+                "DELETE FROM members WHERE chat_id = ? AND open_id = ?",
+                [(chat_id, oid) for oid, name in row_changes.items() if name is None],
+            )
+            conn.execute(
+                "INSERT OR REPLACE INTO member_meta VALUES (?, ?, ?)",
+                (chat_id, directory.fetched_at, json.dumps(directory.memo, ensure_ascii=False)),
+            )
+            stats = cs.stats
+            conn.executemany(
+                """INSERT INTO deal_stats VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (chat_id, period, person) DO UPDATE SET
+                       name = excluded.name,
+                       deals = deals + excluded.deals,
+                       total = total + excluded.total,
+                       max_deal = MAX(max_deal, excluded.max_deal)""",
+                [(chat_id, period, person, *row) for (period, person), row in stats.pending.items()],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO deal_streaks VALUES (?, ?, ?, ?, ?, ?)",
+                [(chat_id, person, *stats.streaks[person]) for person in stats.streaks_dirty],
+            )
+            conn.executemany(
+                "INSERT OR REPLACE INTO outbox VALUES (?, ?, ?, ?)",
+                [(chat_id, intent.key, json.dumps(intent._asdict(), ensure_ascii=False), attempts)
+                 for intent, attempts in outbox_changes],
+            )
+            conn.executemany(
+                "DELETE FROM outbox WHERE chat_id = ? AND key = ?",
+                [(chat_id, key) for key in outbox_removed],
+            )
+        cs.mark_saved()
+        log.debug("[%s] 状态已保存: 去重 +%d/-%d, 话术 %d 人, 成员 %s",
+                  chat_id, len(added), len(dropped), len(cs.praise_dirty),
+                  "全量" if rewrite else len(row_changes))
+
+    def get_kv(self, key: str, default: str | None = None) -> str | None:
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_kv(self, key: str, value: str):
+        with self._lock, self.conn as conn:
+            conn.execute("INSERT OR REPLACE INTO kv VALUES (?, ?)", (key, value))
+
+    def leaderboard(self, chat_id: str, period: str, limit: int) -> tuple[list, tuple | None]:
+        """某周期的个人排行（按金额、单数降序）与团队合计 (deals, total, max_deal, 人数)。"""
+        with self._lock:
+            rows = self.conn.execute(
+                """SELECT s.person, s.name, s.deals, s.total, s.max_deal,
+                          COALESCE(k.streak, 0), COALESCE(k.last_day, '')
+                   FROM deal_stats s LEFT JOIN deal_streaks k
+                     ON k.chat_id = s.chat_id AND k.person = s.person
+                   WHERE s.chat_id = ? AND s.period = ? AND s.person != ?
+                   ORDER BY s.total DESC, s.deals DESC LIMIT ?""",
+                (chat_id, period, DealStats.TEAM, limit),
+            ).fetchall()
+            team = self.conn.execute(
+                """SELECT deals, total, max_deal,
+                          (SELECT COUNT(*) FROM deal_stats
+                           WHERE chat_id = ? AND period = ? AND person != ?)
+                   FROM deal_stats WHERE chat_id = ? AND period = ? AND person = ?""",
+                (chat_id, period, DealStats.TEAM, chat_id, period, DealStats.TEAM),
+            ).fetchone()
+        return rows, team
+
+    def prune_stats(self, keep_days: int = STATS_KEEP_DAYS):
+        """删除超过 keep_days 天的按日统计。"""
+        cutoff = (date.fromtimestamp(time.time()) - timedelta(days=keep_days)).isoformat()
+        with self._lock, self.conn as conn:
+            conn.execute("DELETE FROM deal_stats WHERE period LIKE 'd:%' AND period < ?", ("d:" + cutoff,))
+
+    def add_mentions(self, chat_id: str, at_messages: list[dict]) -> list[PendingMention]:
+        """登记一批待回复的 @消息，在一个事务内分配序号（自增主键，不复用）。"""
+        now = time.time()
+        mentions = []
+        with self._lock, self.conn as conn:
+            for m in at_messages:
+                row = (chat_id, m["msg_id"], m["sender_id"], m["sender_name"], m["content"], now)
+                cur = conn.execute(
+                    "INSERT INTO mentions (chat_id, msg_id, sender_id, sender_name, content, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", row,
+                )
+                mentions.append(PendingMention(cur.lastrowid, *row))
+        return mentions
+
+    def get_mention(self, seq: int) -> PendingMention | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT seq, chat_id, msg_id, sender_id, sender_name, content, created_at"
+                " FROM mentions WHERE seq = ?", (seq,),
+            ).fetchone()
+        return PendingMention(*row) if row else None
+
+    def prune_mentions(self, ttl: float = MENTION_TTL_SECONDS):
+        """删除已过期的待回复 @消息。"""
+        with self._lock, self.conn as conn:
+            conn.execute("DELETE FROM mentions WHERE created_at < ?", (time.time() - ttl,))
+
+
+class PendingMention(NamedTuple):
+    """@消息汇总里的一条：管理员回复序号 seq 时，回复到 chat_id 里的 msg_id。"""
+
+    seq: int
+    chat_id: str
+    msg_id: str
+    sender_id: str
+    sender_name: str
+    content: str
+    created_at: float
+
+
+class MentionIndex:
+    """@消息汇总序号 -> 原消息的索引，以及管理员单聊的位置与已读游标。
+
+    序号由 mentions 表的自增主键分配，写库先于汇总意图落盘，多实例共用状态库时也不会重复。
+    本进程登记的条目缓存在字典里（按序号即登记时间排序，过期的从头部淘汰），
+    其他实例或上次运行登记的按主键查库，查找都不随积压条数变慢。
+    """
+
+    def __init__(self, store: StateStore, ttl: float = MENTION_TTL_SECONDS):
+        self.store = store
+        self.ttl = ttl
+        self._by_seq = {}  # {seq: PendingMention}
+        self._lock = threading.Lock()
+
+    def register(self, chat_id: str, at_messages: list[dict]) -> list[int]:
+        """为一批 @消息分配序号，返回与 at_messages 一一对应的序号。"""
+        mentions = self.store.add_mentions(chat_id, at_messages)
+        cutoff = time.time() - self.ttl
+        with self._lock:
+            while self._by_seq:
+                oldest = next(iter(self._by_seq.values()))
+                if oldest.created_at >= cutoff:
+                    break
+                del self._by_seq[oldest.seq]
+            for m in mentions:
+                self._by_seq[m.seq] = m
+        return [m.seq for m in mentions]
+
+    def get(self, seq: int) -> PendingMention | None:
+        """按序号查找，不存在或已过期返回 None。"""
+        with self._lock:
+            mention = self._by_seq.get(seq)
+        if mention is None:
+            mention = self.store.get_mention(seq)
+        if mention is None or mention.created_at < time.time() - self.ttl:
+            return None
+        return mention
+
+    def admin_chat_id(self) -> str:
+        return ADMIN_CHAT_ID or self.store.get_kv("admin_chat_id", "")
+
+    def learn_admin_chat(self, chat_id: str):
+        """记下管理员单聊的 chat_id（发送汇总的响应、单聊事件里都有）。"""
+        if chat_id and chat_id != self.admin_chat_id():
+            self.store.set_kv("admin_chat_id", chat_id)
+            log.info("管理员单聊: %s", chat_id)
+
+    def reply_cursor(self) -> MessageCursor | None:
+        return MessageCursor.from_dict(json.loads(self.store.get_kv("admin_reply_cursor", "null")))
+
+    def save_reply_cursor(self, cursor: MessageCursor):
+        self.store.set_kv("admin_reply_cursor", json.dumps(cursor.to_dict()))
+
+
+# ---------------------------------------------------------------------------
+# 消息分发
+# ---------------------------------------------------------------------------
+class ParsedMessage:
+    """解析过一次 body.content 的消息，分发给各处理器共用。"""
+
+    __slots__ = ("raw", "msg_id", "msg_type", "sender_type", "sender_id", "content")
+
+    def __init__(self, raw: dict, content: dict):
+        sender = raw.get("sender", {})
+        self.raw = raw
+        self.msg_id = raw.get("message_id", "")
+        self.msg_type = raw.get("msg_type", "")
+        self.sender_type = sender.get("sender_type", "")
+        self.sender_id = sender.get("id", "")
+        self.content = content
+
+
+class DispatchContext:
+    """一批消息分发过程中处理器共享的上下文与结果。"""
+
+    def __init__(self, client: FeishuClient, chat_id: str, bot_open_id: str, cs: ChatState, persist=None,
+                 mentions: MentionIndex | None = None):
+        self.client = client
+        self.chat_id = chat_id
+        self.bot_open_id = bot_open_id
+        self.cs = cs
+        self.persist = persist  # 发送前落盘 outbox 的回调，为空时不落盘
+        self.mentions = mentions  # 为 @消息分配汇总序号，为空时汇总按 1..N 编号、不转发回复
+        self.praised = []
+        self.at_messages = []
+        self.deals = []  # [DealHit]，flush() 时合并发送
+        self.outgoing = []  # 本批待发送的 OutboxIntent，flush() 时先落盘再放入发送队列
+        self.sends = []  # [(Future, OutboxIntent)]
+
+    def send(self, intent: OutboxIntent):
+        """登记一条待发送消息：写入 outbox，源消息记为已处理（与意图同一次落盘）。"""
+        self.cs.outbox.add(intent)
+        for msg_id, ts in intent.ids:
+            self.cs.processed_ids.add(msg_id, ts)
+        self.outgoing.append(intent)
+
+    def submit(self, intent: OutboxIntent) -> Future:
+        """把 outbox 里的意图放入发送队列。"""
+        future = self.client.sender.submit(intent.body["receive_id"], intent.priority,
+                                           deliver_intent, self.client, intent)
+        if intent.kind in ("praise", "digest"):
+            future.add_done_callback(lambda f: observe_praise_lag(f, intent.ids, intent.kind))
+        self.sends.append((future, intent))
+        return future
+
+    def pending(self) -> bool:
+        return bool(self.deals or self.at_messages)
+
+    def flush(self):
+        """把本批收集到的成单与 @消息写入 outbox、落盘，再放入发送队列。"""
+        if self.deals:
+            queue_deals(self)
+        # @机器人 的消息汇总发送给管理员
+        if self.at_messages:
+            ids = [(m["msg_id"], m["create_ts"]) for m in self.at_messages]
+            if ADMIN_OPEN_ID:
+                seqs = self.mentions.register(self.chat_id, self.at_messages) if self.mentions else None
+                self.send(make_intent(self.chat_id, "at_summary", "open_id",
+                                      at_summary_message(self.at_messages, seqs),
+                                      f"@消息汇总已发送给管理员，共 {len(self.at_messages)} 条",
+                                      ids, priority=PRIORITY_SUMMARY))
+            else:
+                log.warning("未配置 ADMIN_OPEN_ID，无法发送 @消息汇总")
+                for msg_id, ts in ids:
+                    self.cs.processed_ids.add(msg_id, ts)
+        if not self.outgoing:
+            return
+        if self.persist:
+            self.persist()
+        for intent in self.outgoing:
+            self.submit(intent)
+        self.outgoing = []
+
+    def settle(self) -> int:
+        """等待本批发送完成：送达的意图移出 outbox 并计入成单统计，失败的（含飞书返回
+        code != 0）只记日志、留在 outbox 等重发，不计统计。返回失败条数。
+
+        不抛异常：一条消息发送失败不应中断整个群的拉取，重发由 outbox 负责。
+        """
+        failed = 0
+        for future, intent in self.sends:
+            try:
+                data = future.result()
+            except Exception as e:
+                failed += 1
+                metrics.inc("messages_send_failed_total", kind=intent.kind)
+                log.warning("[%s] %s 发送失败，留待重发: %s", self.chat_id, intent.kind, e)
+                self.cs.outbox.failed(intent.key)
+                continue
+            self.cs.outbox.delivered(intent.key)
+            if intent.kind == "at_summary" and self.mentions:
+                self.mentions.learn_admin_chat(data.get("data", {}).get("chat_id", ""))
+            for person, name, amount, ts in intent.hits:
+                self.cs.stats.record(person, name, amount, ts)
+        self.sends = []
+        return failed
+
+
+class MessageDispatcher:
+    """按 (msg_type, sender_type) 把消息路由给注册的处理器。
+
+    每条消息只遍历一次；没有处理器关心的消息不解析 content，
+    有处理器的消息只 json.loads 一次。
+    """
+
+    def __init__(self):
+        self.routes = defaultdict(list)
+
+    def route(self, msg_type: str, sender_type: str):
+        """装饰器：注册 handler(ctx, pm)。"""
+        def register(handler):
+            self.routes[(msg_type, sender_type)].append(handler)
+            return handler
+        return register
+
+    def dispatch(self, messages: list, ctx: DispatchContext):
+        processed_ids = ctx.cs.processed_ids
+        for msg in messages:
+            handlers = self.routes.get((msg.get("msg_type", ""), msg.get("sender", {}).get("sender_type", "")))
+            if not handlers or msg.get("message_id", "") in processed_ids:
+                continue
+            try:
+                content = json.loads(msg.get("body", {}).get("content", "{}"))
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(content, dict):
+                continue
+            pm = ParsedMessage(msg, content)
+            for handler in handlers:
+                handler(ctx, pm)
+
+
+dispatcher = MessageDispatcher()
+
+
+@dispatcher.route("text", "user")
+@dispatcher.route("post", "user")
+def handle_at_bot(ctx: DispatchContext, pm: ParsedMessage):
+    """收集 @机器人 的消息，整批处理完后汇总发给管理员。"""
+    if not ctx.bot_open_id:
+        return
+    at_msg = detect_at_bot_message(pm, ctx.bot_open_id, ctx.cs.directory)
+    if at_msg:
+        ctx.at_messages.append(at_msg)
+        metrics.inc("mentions_total")
+
+
+class DealHit(NamedTuple):
+    """已匹配到成员、等待发送夸奖的一张成单卡片。"""
+
+    msg_id: str
+    ts: int
+    clean_name: str
+    open_id: str | None
+    amount: float
+
+
+@dispatcher.route("interactive", "app")
+def handle_deal_card(ctx: DispatchContext, pm: ParsedMessage):
+    """检测成单卡片，收集到本批待夸奖列表。"""
+    deal = extract_deal(pm.content)
+    if deal is None:
+        return
+
+    client, chat_id, directory = ctx.client, ctx.chat_id, ctx.cs.directory
+    raw_name = deal.raw_name
+    clean_name, open_id = match_member(raw_name, directory)
+    if open_id is None and directory.age() > MEMBER_MISS_REFRESH_AGE:
+        # 可能是新进群的成员，补刷新一次
+        if directory.refresh(client, chat_id):
+            clean_name, open_id = match_member(raw_name, directory)
+    amount_text = format_amount(deal.amount)
+
+    log.info("检测到成单: %s (raw=%s), 金额=%s (%.0f元), 产品=%s, 规则=%s, open_id=%s",
+             clean_name, raw_name, amount_text, deal.amount, deal.product or "-",
+             deal.template, open_id)
+
+    ctx.deals.append(DealHit(pm.msg_id, message_ts(pm.raw), clean_name, open_id, deal.amount))
+    metrics.inc("deals_total", template=deal.template, matched=open_id is not None)
+    ctx.praised.append(pm.msg_id)
+
+
+def queue_deals(ctx: DispatchContext):
+    """合并本批成单、选话术并放入发送队列。
+
+    同一人的多张卡片合并为一条夸奖（MERGE_SAME_PERSON），金额相加；
+    合并后仍有 DIGEST_THRESHOLD 条以上时，整批合成一条汇总消息逐人 @，
+    高峰期一批只占一次发送配额。
+    """
+    groups = {}
+    for hit in ctx.deals:
+        key = (hit.open_id or hit.clean_name) if MERGE_SAME_PERSON else hit.msg_id
+        groups.setdefault(key, []).append(hit)
+
+    rows = []
+    for hits in groups.values():
+        clean_name, open_id = hits[0].clean_name, hits[0].open_id
+        total = sum(h.amount for h in hits)
+        amount_text = format_amount(total)
+        if len(hits) > 1:
+            amount_text = f"{amount_text}（{len(hits)} 单）" if total else f"{len(hits)} 单"
+        praise_text = pick_praise(clean_name, amount_text, ctx.cs.used_praise)
+        ctx.cs.praise_dirty.add(clean_name)
+        rows.append((clean_name, open_id, praise_text, hits))
+    ctx.deals = []
+
+    def sources(hits):
+        ids = [(h.msg_id, h.ts) for h in hits]
+        stats = [(h.open_id or f"name:{h.clean_name}", h.clean_name, h.amount, h.ts or time.time()) for h in hits]
+        return ids, stats
+
+    chat_id = ctx.chat_id
+    if DIGEST_THRESHOLD and len(rows) >= DIGEST_THRESHOLD:
+        log.info("[%s] 本批 %d 人成单，合并为一条汇总", chat_id, len(rows))
+        ids, stats = sources([h for row in rows for h in row[3]])
+        ctx.send(make_intent(chat_id, "digest", "chat_id", digest_message(chat_id, [row[:3] for row in rows]),
+                             f"[{chat_id}] 成单汇总已发送: {len(rows)} 人", ids, stats))
+        return
+    for clean_name, open_id, praise_text, hits in rows:
+        ids, stats = sources(hits)
+        ctx.send(make_intent(chat_id, "praise", "chat_id", praise_message(chat_id, clean_name, open_id, praise_text),
+                             f"[{chat_id}] 夸奖已发送: {clean_name} -> {praise_text[:40]}", ids, stats))
+
+
+def observe_praise_lag(future: Future, ids: list[tuple], kind: str):
+    """发送成功后记录每张成单卡片从 create_time 到夸奖发出的延迟（秒级精度）。"""
+    if future.cancelled() or future.exception() is not None:
+        metrics.inc("praise_failed_total", kind=kind)
+        return
+    now = time.time()
+    metrics.inc("praise_sent_total", kind=kind)
+    for _, ts in ids:
+        if ts:
+            metrics.observe("deal_praise_lag_seconds", max(0.0, now - ts))
+
+
+def process_messages(
+    client: FeishuClient, chat_id: str, messages: list, bot_open_id: str, cs: ChatState, persist=None,
+    mentions: MentionIndex | None = None,
+) -> DispatchContext:
+    """单次遍历分发消息，把要发送的消息写入 outbox 并放入发送队列，轮询模式与事件模式共用。
+
+    返回的上下文里有本批夸奖的 msg_id（praised）和 @消息（at_messages）；
+    调用方需 settle() 等待发送完成，送达的消息才移出 outbox。
+    """
+    ctx = DispatchContext(client, chat_id, bot_open_id, cs, persist, mentions)
+    with metrics.timer("detect"):
+        dispatcher.dispatch(messages, ctx)
+    ctx.flush()
+    return ctx
+
+
+# ---------------------------------------------------------------------------
+# 排行榜
+# ---------------------------------------------------------------------------
+def last_occurrence(entry: dict, now: float) -> datetime:
+    """排期项在 now 之前（含）最近一次的触发时间。"""
+    hour, minute = (int(x) for x in entry.get("at", "09:00").split(":"))
+    dt = datetime.fromtimestamp(now).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    period = entry["period"]
+    if period == "week":
+        dt -= timedelta(days=(dt.isoweekday() - entry.get("weekday", 1)) % 7)
+        if dt.timestamp() > now:
+            dt -= timedelta(days=7)
+    elif period == "month":
+        dt = dt.replace(day=entry.get("day", 1))
+        if dt.timestamp() > now:
+            dt = (dt.replace(day=1) - timedelta(days=1)).replace(day=entry.get("day", 1))
+    elif dt.timestamp() > now:
+        dt -= timedelta(days=1)
+    return dt
+
+
+def report_period(entry: dict, occurrence: datetime) -> tuple[str, str]:
+    """排期项在某次触发时要发的统计周期：(周期键, 榜单标题)。"""
+    current = entry.get("current", False)
+    day = occurrence.date()
+    if entry["period"] == "week":
+        day = day if current else day - timedelta(days=7)
+        year, week, _ = day.isocalendar()
+        return f"w:{year}-W{week:02d}", f"{'本周' if current else '上周'}成单榜（{year} 第 {week} 周）"
+    if entry["period"] == "month":
+        day = day if current else day.replace(day=1) - timedelta(days=1)
+        return f"m:{day:%Y-%m}", f"{'本月' if current else '上月'}成单榜（{day.year} 年 {day.month} 月）"
+    day = day if current else day - timedelta(days=1)
+    return f"d:{day.isoformat()}", f"{'今日' if current else '昨日'}成单榜（{day.isoformat()}）"
+
+
+def send_leaderboard(client: FeishuClient, chat_id: str, title: str, rows: list, team: tuple,
+                     today: date, uuid: str | None = None):
+    """发送排行榜富文本：前几名逐人 @，附最大单和连续开单天数，末尾团队合计。
+
+    uuid 由排期项和触发时间决定：发出后、记下发送记录前崩溃，下次运行重发时飞书会去重。
+    """
+    content = []
+    for i, (person, name, deals, total, max_deal, streak, last_day) in enumerate(rows):
+        rank = "🥇🥈🥉"[i] if i < 3 else f"{i + 1}."
+        line = [{"tag": "text", "text": f"{rank} "}]
+        if person.startswith("ou_"):
+            line.append({"tag": "at", "user_id": person})
+        else:
+            line.append({"tag": "text", "text": name})
+        detail = f" {deals} 单 · {format_money(total)}，最大单 {format_money(max_deal)}"
+        # 连续天数只在昨天或今天还开单时才算数
+        if streak >= 2 and last_day >= (today - timedelta(days=1)).isoformat():
+            detail += f"，连续 {streak} 天开单🔥"
+        line.append({"tag": "text", "text": detail})
+        content.append(line)
+    deals, total, max_deal, people = team
+    content.append([{"tag": "text", "text": (
+        f"团队合计 {deals} 单 · {format_money(total)}，{people} 人开单，最大单 {format_money(max_deal)}"
+    )}])
+    body = {
+        "receive_id": chat_id,
+        "msg_type": "post",
+        "content": json.dumps({"zh_cn": {"title": f"🏆 {title}", "content": content}}, ensure_ascii=False),
+    }
+    data = post_message(client, "chat_id", body, uuid)
+    if data.get("code") != 0:
+        log.error("发送排行榜失败: %s", data)
+        return False
+    log.info("[%s] 排行榜已发送: %s, %d 人", chat_id, title, len(rows))
+    return True
+
+
+def post_due_leaderboards(client: FeishuClient, store: StateStore, chat_ids: list[str]):
+    """发送到期的排行榜，每个排期项每次触发只发一次（发送记录存 kv 表）。"""
+    now = time.time()
+    for entry in LEADERBOARD_SCHEDULE:
+        occurrence = last_occurrence(entry, now)
+        if now - occurrence.timestamp() > LEADERBOARD_GRACE:
+            continue
+        period, title = report_period(entry, occurrence)
+        stamp = occurrence.isoformat()
+        for chat_id in chat_ids:
+            key = f"leaderboard:{chat_id}:{json.dumps(entry, sort_keys=True)}"
+            if store.get_kv(key) == stamp:
+                continue
+            rows, team = store.leaderboard(chat_id, period, LEADERBOARD_TOP)
+            if not team:
+                log.info("[%s] %s 无成单，跳过", chat_id, title)
+            elif not send_leaderboard(client, chat_id, title, rows, team, occurrence.date(),
+                                      hashlib.sha1(f"{key}:{stamp}".encode("utf-8")).hexdigest()[:32]):
+                continue
+            store.set_kv(key, stamp)
+
+
+# ---------------------------------------------------------------------------
+# 管理员回复转发
+# ---------------------------------------------------------------------------
+# 一行一条回复："12 内容"、"12. 内容"、"12：内容"；"3,5 内容" 多个序号共用一条内容
+ADMIN_REPLY_RE = re.compile(r"^\s*(\d+(?:\s*[,，、/]\s*\d+)*)(?:\s*[.．、:：)）](?!\d)\s*|\s+)(\S.*)$")
+
+
+def parse_admin_replies(text: str) -> list[tuple[list[int], str]]:
+    """解析管理员的批量回复，返回 [(序号列表, 内容)]；不以序号开头的行接在上一条内容后面。"""
+    replies = []
+    for line in text.splitlines():
+        m = ADMIN_REPLY_RE.match(line)
+        if m:
+            replies.append(([int(s) for s in re.findall(r"\d+", m.group(1))], m.group(2).strip()))
+        elif replies and line.strip():
+            seqs, content = replies[-1]
+            replies[-1] = (seqs, f"{content}\n{line.strip()}")
+    return replies
+
+
+def relay_admin_messages(client: FeishuClient, mentions: MentionIndex, messages: list) -> int:
+    """把管理员单聊里的消息按序号回复到原消息下，返回转发条数。
+
+    按时间顺序逐条处理并推进游标；某条消息的回复发送出错时停下，下次从它重试，
+    回复带 (管理员消息, 序号) 决定的 uuid，不会重复。找不到的序号汇总告知管理员。
+    """
+    cursor = mentions.reply_cursor() or MessageCursor()
+    relayed = 0
+    for msg in sorted(messages, key=lambda m: int(m.get("create_time", "0") or 0)):
+        if cursor.seen(msg):
+            continue
+        sender = msg.get("sender", {})
+        text = ""
+        if msg.get("msg_type") == "text" and sender.get("id") == ADMIN_OPEN_ID:
+            try:
+                text = json.loads(msg.get("body", {}).get("content", "{}")).get("text", "")
+            except (json.JSONDecodeError, AttributeError):
+                pass
+        sends, missing = [], []
+        for seqs, content in parse_admin_replies(text):
+            for seq in seqs:
+                mention = mentions.get(seq)
+                if mention is None:
+                    missing.append(seq)
+                    continue
+                uuid = hashlib.sha1(f"{msg['message_id']}:{seq}".encode("utf-8")).hexdigest()[:32]
+                future = client.sender.submit(mention.chat_id, PRIORITY_SUMMARY, reply_message,
+                                              client, mention.msg_id, content, uuid)
+                sends.append((future, mention))
+        try:
+            results = [(future.result(), mention) for future, mention in sends]
+        except Exception as e:
+            log.warning("转发管理员回复失败，下次再试: %s", e)
+            metrics.inc("admin_replies_total", result="error")
+            break
+        failed = []
+        for data, mention in results:
+            if data.get("code") == 0:
+                relayed += 1
+                metrics.inc("admin_replies_total", result="ok")
+                log.info("[%s] 已回复 %s 的 @消息 (序号 %d)", mention.chat_id, mention.sender_name, mention.seq)
+            else:
+                failed.append(mention.seq)
+                metrics.inc("admin_replies_total", result="failed")
+                log.error("回复序号 %d 失败: %s", mention.seq, data)
+        if missing or failed:
+            metrics.inc("admin_replies_total", len(missing), result="unknown")
+            notes = []
+            if missing:
+                notes.append(f"序号 {'、'.join(map(str, missing))} 不存在或已过期")
+            if failed:
+                notes.append(f"序号 {'、'.join(map(str, failed))} 回复失败（原消息可能已撤回）")
+            body = {"receive_id": ADMIN_OPEN_ID, "msg_type": "text",
+                    "content": json.dumps({"text": "⚠️ " + "；".join(notes)}, ensure_ascii=False)}
+            post_message(client, "open_id", body,
+                         hashlib.sha1(f"{msg['message_id']}:note".encode("utf-8")).hexdigest()[:32])
+        cursor.advance([msg])
+        mentions.save_reply_cursor(cursor)
+    return relayed
+
+
+def relay_admin_replies(client: FeishuClient, mentions: MentionIndex) -> int:
+    """拉取管理员单聊里上次之后的消息并转发其中的序号回复。"""
+    chat_id = mentions.admin_chat_id()
+    if not chat_id or not ADMIN_OPEN_ID:
+        return 0
+    now = int(time.time())
+    cursor = mentions.reply_cursor()
+    if cursor is None:
+        # 首次：从现在开始，之前按 1..N 编号的汇总的回复不转发
+        mentions.save_reply_cursor(MessageCursor(now * 1000))
+        return 0
+    start = max(cursor.start_time(), now - MAX_LOOKBACK_SECONDS)
+    messages = [m for items, _ in fetch_messages(client, chat_id, str(start), str(now)) for m in items]
+    relayed = relay_admin_messages(client, mentions, messages)
+    if relayed:
+        log.info("已转发管理员回复 %d 条", relayed)
+    return relayed
+
+
+# ---------------------------------------------------------------------------
+# 多实例协调
+# ---------------------------------------------------------------------------
+class LeaseLostError(RuntimeError):
+    """处理中的群的租约已被其他实例接管。"""
+
+
+class SQLiteLeaseStore:
+    """基于 SQLite 的租约存储，多个进程共用一个数据库文件（同机或共享盘）。
+
+    租约和实例心跳都是带过期时间的行；抢占用一条带条件的 upsert 完成，
+    只有租约空闲、已过期或本来就属于自己时才写入成功。
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS instances (
+            owner TEXT PRIMARY KEY,
+            expires_at REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path: str):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(self.SCHEMA)
+
+    def _execute(self, sql: str, args: tuple) -> int:
+        with self._lock:
+            return self.conn.execute(sql, args).rowcount
+
+    def acquire(self, name: str, owner: str, ttl: float) -> bool:
+        now = time.time()
+        return self._execute(
+            """INSERT INTO leases VALUES (?, ?, ?)
+               ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+               WHERE leases.owner = excluded.owner OR leases.expires_at <= ?""",
+            (name, owner, now + ttl, now),
+        ) == 1
+
+    def renew(self, name: str, owner: str, ttl: float) -> bool:
+        return self._execute("UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?",
+                             (time.time() + ttl, name, owner)) == 1
+
+    def release(self, name: str, owner: str):
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def heartbeat(self, owner: str, ttl: float):
+        self._execute("INSERT OR REPLACE INTO instances VALUES (?, ?)", (owner, time.time() + ttl))
+
+    def leave(self, owner: str):
+        self._execute("DELETE FROM instances WHERE owner = ?", (owner,))
+
+    def members(self) -> list[str]:
+        with self._lock:
+            rows = self.conn.execute("SELECT owner FROM instances WHERE expires_at > ?", (time.time(),))
+            return [owner for owner, in rows]
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+# 租约存储实现：LEASE_STORE 的 scheme -> 构造函数(路径)；其他后端（Redis、etcd 等）在此注册
+LEASE_BACKENDS = {"sqlite": SQLiteLeaseStore}
+
+
+def open_lease_store(url: str):
+    scheme, _, path = url.partition(":")
+    if scheme not in LEASE_BACKENDS:
+        raise ValueError(f"不支持的租约存储: {url}")
+    return LEASE_BACKENDS[scheme](path)
+
+
+def check_shared_state(lease_url: str, state_db: str) -> str | None:
+    """检查多实例运行时状态库是否与租约存储共享，不满足时返回错误说明。
+
+    默认的相对路径 state.db 只在本机可见；sqlite 租约存储还要求状态库和租约库在同一目录。
+    """
+    if not os.path.isabs(state_db):
+        return f"配置了 LEASE_STORE 时 STATE_DB 必须是共享目录下的绝对路径，当前为 {state_db}"
+    scheme, _, path = lease_url.partition(":")
+    if scheme == "sqlite":
+        lease_dir = os.path.dirname(os.path.realpath(path))
+        state_dir = os.path.dirname(os.path.realpath(state_db))
+        if lease_dir != state_dir:
+            return f"STATE_DB ({state_db}) 必须与租约存储 ({path}) 在同一共享目录"
+    return None
+
+
+class HashRing:
+    """一致性哈希环：每个实例 replicas 个虚拟节点，增减实例只迁移约 1/N 的群。"""
+
+    def __init__(self, members: list[str], replicas: int = 64):
+        self._ring = sorted(
+            (self._hash(f"{member}#{i}"), member) for member in members for i in range(replicas)
+        )
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.sha1(key.encode("utf-8")).digest()[:8], "big")
+
+    def owner(self, key: str) -> str | None:
+        if not self._ring:
+            return None
+        i = bisect.bisect(self._keys, self._hash(key)) % len(self._ring)
+        return self._ring[i][1]
+
+
+class ShardCoordinator:
+    """多实例分片：按一致性哈希把群分给存活实例，持有租约的实例才处理该群、写它的状态。
+
+    - claim()：登记心跳，取哈希到本实例的群并逐个抢租约；前任还没释放的群本轮跳过
+    - 后台线程每 1/3 租期续约并刷新心跳，续约失败的群视为丢失
+    - check()：落盘前确认租约仍在，丢失时抛出 LeaseLostError，不再发送与写状态
+    丢失租约前已落盘的 outbox 意图由新持有者按原幂等键重发，飞书按 uuid 去重。
+    """
+
+    def __init__(self, store, instance_id: str = INSTANCE_ID, ttl: float = LEASE_TTL_SECONDS):
+        self.store = store
+        self.instance_id = instance_id
+        self.ttl = ttl
+        self.held = {}  # {chat_id: 本地记录的租约到期时间}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def claim(self, chat_ids: list[str]) -> list[str]:
+        """返回本实例本轮负责的群。"""
+        self.store.heartbeat(self.instance_id, self.ttl)
+        if LEASE_JOIN_WAIT:
+            time.sleep(LEASE_JOIN_WAIT)
+        members = self.store.members()
+        ring = HashRing(members)
+        mine = [chat_id for chat_id in chat_ids if ring.owner(chat_id) == self.instance_id]
+        claimed = []
+        for chat_id in mine:
+            if self.store.acquire(f"chat:{chat_id}", self.instance_id, self.ttl):
+                claimed.append(chat_id)
+                with self._lock:
+                    self.held[chat_id] = time.time() + self.ttl
+            else:
+                log.info("[%s] 租约仍被其他实例持有，本轮跳过", chat_id)
+        log.info("实例 %s: 存活 %d 个实例, 分到 %d/%d 个群, 取得租约 %d 个",
+                 self.instance_id, len(members), len(mine), len(chat_ids), len(claimed))
+        if claimed and self._renewer is None:
+            self._renewer = threading.Thread(target=self._renew_loop, daemon=True)
+            self._renewer.start()
+        return claimed
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.ttl / 3):
+            self.store.heartbeat(self.instance_id, self.ttl)
+            with self._lock:
+                chat_ids = list(self.held)
+            for chat_id in chat_ids:
+                if self.store.renew(f"chat:{chat_id}", self.instance_id, self.ttl):
+                    with self._lock:
+                        if chat_id in self.held:
+                            self.held[chat_id] = time.time() + self.ttl
+                else:
+                    log.warning("[%s] 租约已丢失", chat_id)
+                    metrics.inc("lease_lost_total")
+                    with self._lock:
+                        self.held.pop(chat_id, None)
+
+    def holds(self, chat_id: str) -> bool:
+        with self._lock:
+            return self.held.get(chat_id, 0) > time.time()
+
+    @contextlib.contextmanager
+    def exclusive(self, name: str):
+        """只需一个实例做的事（如转发管理员回复）：抢到租约时产出 True，结束后释放。"""
+        acquired = self.store.acquire(name, self.instance_id, self.ttl)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                self.store.release(name, self.instance_id)
+
+    def check(self, chat_id: str):
+        if not self.holds(chat_id):
+            raise LeaseLostError(f"群 {chat_id} 的租约已丢失")
+
+    def release(self):
+        """停止续约，释放全部租约并注销实例。"""
+        self._stop.set()
+        if self._renewer:
+            self._renewer.join()
+        with self._lock:
+            chat_ids, self.held = list(self.held), {}
+        for chat_id in chat_ids:
+            self.store.release(f"chat:{chat_id}", self.instance_id)
+        self.store.leave(self.instance_id)
+        self.store.close()
+
+
+# ---------------------------------------------------------------------------
+# 主逻辑
+# ---------------------------------------------------------------------------
+def message_ts(msg: dict) -> int:
+    """消息 create_time（毫秒字符串）转为秒。"""
+    try:
+        return int(msg.get("create_time", "0")) // 1000
+    except ValueError:
+        return 0
+
+
+def resend_outbox(client: FeishuClient, chat_id: str, cs: ChatState, persist):
+    """重发上次运行没有确认送达的消息（发送前后崩溃、超时、发送失败），沿用原幂等键。
+
+    超出 uuid 去重窗口的意图不再重发，以免重复。
+    """
+    if cs.outbox.drop_expired(time.time() - OUTBOX_RESEND_WINDOW):
+        persist()
+    if not cs.outbox:
+        return
+    log.info("[%s] 重发 %d 条未确认送达的消息", chat_id, len(cs.outbox))
+    metrics.inc("outbox_resent_total", len(cs.outbox))
+    ctx = DispatchContext(client, chat_id, "", cs, persist)
+    for intent in cs.outbox:
+        ctx.submit(intent)
+    failed = ctx.settle()
+    if failed:
+        log.warning("[%s] %d 条重发失败，下次再试", chat_id, failed)
+    persist()
+
+
+def run_chat(
+    client: FeishuClient, bot_open_id: str, chat_id: str, cs: ChatState, persist,
+    mentions: MentionIndex | None = None,
+) -> tuple[int, int, int]:
+    """处理单个群：刷新成员、逐页拉取消息并即时检测发送。返回 (成单数, @消息数, 新消息数)。
+
+    新消息数不含机器人自己发的消息，供轮询模式判断群里是否活跃。
+
+    每处理完一页调用 persist() 保存断点，中断后下次运行从断点页继续。
+    窗口拉完才推进 cs.cursor；游标重叠窗口内已见过的消息不再分发。
+    """
+    resend_outbox(client, chat_id, cs, persist)
+
+    # 成员缓存过期才全量刷新
+    if cs.directory.stale():
+        cs.directory.refresh(client, chat_id)
+    else:
+        log.info("[%s] 使用群成员缓存 %d 人 (%.0f 分钟前)",
+                 chat_id, len(cs.directory), cs.directory.age() / 60)
+
+    now = int(time.time())
+    if cs.checkpoint and cs.checkpoint["last_ts"] < now - MAX_LOOKBACK_SECONDS:
+        log.warning("[%s] 断点超出最大回溯时间，放弃断点", chat_id)
+        cs.checkpoint = None
+    if cs.checkpoint:
+        # 上次运行中断，从断点继续
+        window = cs.checkpoint
+        log.info("[%s] 从断点继续: 已处理到 %s", chat_id,
+                 time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(window["last_ts"])))
+    else:
+        # 计算消息拉取起始时间
+        if cs.cursor:
+            # 从最新消息时间往前留重叠窗口开始，但不超过最大回溯时间。
+            # 起点只由游标（服务端消息时间）决定，不用本机时钟记下的 last_check_time，
+            # 否则本机时钟偏快时会跳过消息
+            start_ts = max(cs.cursor.start_time(), now - MAX_LOOKBACK_SECONDS)
+            log.info("[%s] 从消息游标开始: %s (距今 %.1f 分钟, 重叠 %d 秒)", chat_id,
+                     time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_ts)),
+                     (now - start_ts) / 60, CURSOR_OVERLAP_SECONDS)
+        elif cs.last_check_time:
+            # 从上次检查时间开始，但不超过最大回溯时间
+            start_ts = max(cs.last_check_time, now - MAX_LOOKBACK_SECONDS)
+            log.info("[%s] 从上次检查时间开始: %s (距今 %.1f 分钟)", chat_id,
+                     time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_ts)),
+                     (now - start_ts) / 60)
+        else:
+            # 首次运行，使用默认回溯时间
+            start_ts = now - DEFAULT_LOOKBACK_SECONDS
+            log.info("[%s] 首次运行，回溯 %.1f 小时", chat_id, DEFAULT_LOOKBACK_SECONDS / 3600)
+        window = {"start_time": start_ts, "end_time": now, "page_token": None, "last_ts": start_ts}
+    # 本窗口推进中的游标，随断点保存，拉完后才替换 cs.cursor
+    cursor = MessageCursor.from_dict(window.get("cursor")) or (cs.cursor.copy() if cs.cursor else MessageCursor())
+
+    def pages():
+        """逐页产出 (items, 续拉位置)，续拉位置是要写进断点的字段，最后一页为 None。"""
+        if (not window["page_token"] and BACKFILL_WORKERS > 1
+                and window["end_time"] - window["start_time"] > 2 * BACKFILL_SLICE_SECONDS):
+            for items, resume_ts in backfill_messages(client, chat_id, window["start_time"], window["end_time"]):
+                yield items, resume_ts and {"start_time": resume_ts, "page_token": None}
+            return
+
+        def sequential(page_token):
+            for items, next_token in fetch_messages(client, chat_id, str(window["start_time"]),
+                                                    str(window["end_time"]), page_token):
+                yield items, next_token and {"page_token": next_token}
+
+        try:
+            yield from sequential(window["page_token"])
+        except FeishuAPIError:
+            if not window["page_token"]:
+                raise
+            # 断点的 page_token 可能已过期，从最后处理到的消息时间重新拉取
+            log.warning("[%s] 断点 page_token 失效，从 last_ts 重新拉取", chat_id)
+            window["start_time"], window["page_token"] = window["last_ts"], None
+            yield from sequential(None)
+
+    praised_count = at_count = fresh_count = 0
+    batch = None  # 上一页的发送批次：拉取下一页期间在后台发送，发完再保存断点
+    try:
+        for items, resume in pages():
+            fresh = [m for m in items if not cursor.seen(m)]
+            if len(fresh) < len(items):
+                metrics.inc("messages_overlap_skipped_total", len(items) - len(fresh))
+            ctx = process_messages(client, chat_id, fresh, bot_open_id, cs, persist, mentions)
+            praised_count += len(ctx.praised)
+            at_count += len(ctx.at_messages)
+            fresh_count += sum(1 for m in fresh if m.get("sender", {}).get("id") != APP_ID)
+            prev, batch = batch, ctx
+            if prev:
+                prev.settle()
+                persist()
+            cursor.advance(fresh)
+            if not resume:
+                break
+            window.update(resume)
+            window["last_ts"] = max([window["last_ts"]] + [message_ts(m) for m in items])
+            window["cursor"] = cursor.to_dict()
+            cs.checkpoint = window
+    finally:
+        if batch:
+            batch.settle()
+
+    # 窗口拉完，下次从游标（没有消息时从窗口结束时间）开始
+    cs.checkpoint = None
+    cs.last_check_time = window["end_time"]
+    if cursor.ts:
+        cs.cursor = cursor
+    return praised_count, at_count, fresh_count
+
+
+def run(client: FeishuClient | None = None, store: StateStore | None = None) -> tuple[int, int, int]:
+    """执行一次拉取与处理，返回各群合计的 (成单数, @消息数, 新消息数)。
+
+    client / store 由调用方传入时（回放、基准、轮询）不重置也不输出指标，client 也不关闭。
+    配置了 LEASE_STORE 时只处理分到本实例且取得租约的群。
+    """
+    embedded = client is not None
+    if not embedded and (not APP_ID or not APP_SECRET):
+        log.error("缺少环境变量 FEISHU_APP_ID 或 FEISHU_APP_SECRET")
+        return 0, 0, 0
+
+    if not embedded:
+        metrics.reset()
+    run_start = time.perf_counter()
+
+    # 1. 多实例时先认领群，再加载这些群的状态（租约在手，状态不会被别的实例改写）
+    if LEASE_STORE and store is None:
+        problem = check_shared_state(LEASE_STORE, STATE_DB)
+        if problem:
+            log.error("%s", problem)
+            return 0, 0, 0
+    coordinator = ShardCoordinator(open_lease_store(LEASE_STORE)) if LEASE_STORE else None
+    chat_ids = coordinator.claim(CHAT_IDS) if coordinator else CHAT_IDS
+    if not chat_ids:
+        log.info("本实例没有需要处理的群")
+        if coordinator:
+            coordinator.release()
+        return 0, 0, 0
+    store = store or StateStore()
+    states = store.load(chat_ids if coordinator else None)
+    mentions = MentionIndex(store)
+
+    # 2. 获取 token 和机器人信息（优先使用缓存）
+    if not embedded:
+        session = RecordingSession(make_transport(), CASSETTE_RECORD, CHAT_IDS) if CASSETTE_RECORD else None
+        client = FeishuClient(session=session)
+    bot_open_id = client.creds.bot_info().get("open_id", "")
+    if not bot_open_id:
+        log.warning("无法获取机器人 open_id，跳过 @消息检测")
+
+    # 3. 各群并发处理，总耗时取决于最慢的群
+    def work(chat_id):
+        cs = states[chat_id]
+
+        def persist():
+            if coordinator:
+                coordinator.check(chat_id)
+            store.save_chat(chat_id, cs)
+
+        try:
+            return run_chat(client, bot_open_id, chat_id, cs, persist, mentions)
+        except LeaseLostError:
+            log.warning("[%s] 租约丢失，停止处理，交给新的持有者", chat_id)
+            return 0, 0, 0
+        except Exception:
+            log.exception("[%s] 处理失败，保留断点", chat_id)
+            return 0, 0, 0
+        finally:
+            # 4. 保存状态（失败时也保存已发送部分的去重记录）；租约丢失后不再写
+            if not coordinator or coordinator.holds(chat_id):
+                store.save_chat(chat_id, cs)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(CHAT_WORKERS, len(chat_ids)))) as pool:
+        results = list(pool.map(work, chat_ids))
+
+    # 5. 转发管理员在单聊里的序号回复；多实例时只由抢到租约的一个实例转发
+    with (coordinator.exclusive("relay:admin") if coordinator else contextlib.nullcontext(True)) as leader:
+        if leader:
+            try:
+                relay_admin_replies(client, mentions)
+                store.prune_mentions()
+            except Exception:
+                log.exception("转发管理员回复失败")
+
+    # 6. 到期的排行榜
+    try:
+        post_due_leaderboards(client, store, chat_ids)
+        store.prune_stats()
+    except Exception:
+        log.exception("发送排行榜失败")
+    store.close()
+    if coordinator:
+        coordinator.release()
+    log.info("状态已保存")
+
+    log.info("本次执行完毕: %d 个群, 成单 %d 条, @消息 %d 条",
+             len(chat_ids), sum(r[0] for r in results), sum(r[1] for r in results))
+    metrics.observe("stage_seconds", time.perf_counter() - run_start, stage="run")
+    if not embedded:
+        client.close()
+        metrics.write_summary()
+    return tuple(sum(r[i] for r in results) for i in range(3))
+
+
+# ---------------------------------------------------------------------------
+# 常驻模式：自适应轮询
+# ---------------------------------------------------------------------------
+def parse_quiet_hours(text: str) -> tuple[int, int] | None:
+    """"21:00-08:00" -> (开始, 结束) 的当日分钟数；为空返回 None。"""
+    if not text:
+        return None
+    start, end = (int(h) * 60 + int(m) for h, m in (part.split(":") for part in text.split("-")))
+    return start, end
+
+
+class PollScheduler:
+    """根据上一轮的结果决定下一轮拉取前等待多久。
+
+    - 有成单或 @消息：回到 POLL_MIN_INTERVAL，紧接着的成单能很快被夸
+    - 只有闲聊：间隔按 POLL_BACKOFF 的平方根缓慢放大；完全没有新消息：按 POLL_BACKOFF 放大，上限 POLL_MAX_INTERVAL
+    - 安静时段：每 POLL_QUIET_INTERVAL 一轮，时段结束时立即补拉并回到最短间隔
+    - 每日额度：扣掉安静时段的轮数后，其余额度只在非安静时段内均匀累积（另有 1/8 可提前用），用超时推迟下一轮
+    """
+
+    def __init__(self, min_interval: float = POLL_MIN_INTERVAL, max_interval: float = POLL_MAX_INTERVAL,
+                 backoff: float = POLL_BACKOFF, quiet_hours: str = POLL_QUIET_HOURS,
+                 quiet_interval: float = POLL_QUIET_INTERVAL, daily_budget: int = POLL_DAILY_BUDGET):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.quiet = parse_quiet_hours(quiet_hours)
+        self.quiet_interval = quiet_interval
+        self.daily_budget = daily_budget
+        quiet_seconds = self.quiet_before(24 * 60) * 60
+        self.active_seconds = 86400 - quiet_seconds
+        self.active_budget = max(1, daily_budget - math.ceil(quiet_seconds / quiet_interval))
+        self.interval = min_interval
+        self.day = None
+        self.used = 0  # 当天非安静时段已拉取的轮数
+        self.reason = ""
+
+    def quiet_before(self, minute: float) -> float:
+        """当天 [00:00, minute) 内属于安静时段的分钟数。"""
+        if not self.quiet:
+            return 0
+        start, end = self.quiet
+        if start <= end:
+            return min(max(minute, start), end) - start
+        return min(minute, end) + max(0, minute - start)
+
+    def quiet_remaining(self, minute: float) -> float:
+        """处于安静时段时返回距结束的秒数，否则 0。"""
+        if not self.quiet:
+            return 0
+        start, end = self.quiet
+        if start <= end:
+            inside = start <= minute < end
+        else:
+            inside = minute >= start or minute < end
+        if not inside:
+            return 0
+        return ((end - minute) % (24 * 60)) * 60
+
+    def budget_wait(self, minute: float) -> float:
+        """当天额度用完时还需等待的秒数（按非安静时段的时间折算）。"""
+        if not self.daily_budget:
+            return 0
+        active = (minute - self.quiet_before(minute)) * 60
+        allowance = self.active_budget * min(1, active / self.active_seconds + 1 / 8)
+        if self.used < allowance:
+            return 0
+        if self.used >= self.active_budget:
+            # 当天用完：等到安静时段开始或次日零点
+            start = self.quiet[0] if self.quiet and self.quiet[0] > minute else 24 * 60
+            return (start - minute) * 60
+        return (self.used + 1 - allowance) * self.active_seconds / self.active_budget
+
+    def next_delay(self, now: float, hits: int, messages: int) -> float:
+        """记录刚完成的一轮（now 时刻，成单 + @消息 hits 条，新消息 messages 条），返回下一轮前的等待秒数。"""
+        dt = datetime.fromtimestamp(now)
+        minute = dt.hour * 60 + dt.minute + dt.second / 60
+        if dt.date() != self.day:
+            self.day, self.used = dt.date(), 0
+
+        quiet_left = self.quiet_remaining(minute)
+        if quiet_left:
+            self.interval, self.reason = self.min_interval, "安静时段"
+            return min(self.quiet_interval, quiet_left)
+
+        self.used += 1
+        if hits:
+            self.interval, self.reason = self.min_interval, "有成单"
+        elif messages:
+            self.interval = min(self.max_interval, self.interval * math.sqrt(self.backoff))
+            self.reason = "有新消息"
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+            self.reason = "无新消息"
+        delay = self.interval
+        wait = self.budget_wait(minute)
+        if wait > delay:
+            delay, self.reason = wait, "当日额度"
+        return delay
+
+
+def poll():
+    """常驻轮询：复用一个客户端反复执行 run()，间隔由 PollScheduler 按活跃程度调整。"""
+    if not APP_ID or not APP_SECRET:
+        log.error("缺少环境变量 FEISHU_APP_ID 或 FEISHU_APP_SECRET")
+        return
+
+    client = FeishuClient()
+    scheduler = PollScheduler()
+    log.info("轮询模式已启动: 间隔 %d~%d 秒, 安静时段 %s, 每日 %s 轮", POLL_MIN_INTERVAL, POLL_MAX_INTERVAL,
+             POLL_QUIET_HOURS or "无", POLL_DAILY_BUDGET or "不限")
+    try:
+        while True:
+            try:
+                deals, mentions, messages = run(client)
+            except Exception:
+                log.exception("本轮处理失败")
+                deals = mentions = messages = 0
+            metrics.write_summary()
+            delay = scheduler.next_delay(time.time(), deals + mentions, messages)
+            metrics.observe("poll_interval_seconds", delay)
+            log.info("下一轮 %.0f 秒后 (%s, 今日第 %d 轮)", delay, scheduler.reason, scheduler.used)
+            time.sleep(delay)
+    except KeyboardInterrupt:
+        log.info("轮询已停止")
+    finally:
+        client.close()
+
+
+# ---------------------------------------------------------------------------
+# 常驻模式：事件订阅
+# ---------------------------------------------------------------------------
+def verify_event_signature(headers, body: bytes) -> bool:
+    """校验飞书事件签名：sha256(timestamp + nonce + encrypt_key + body)。"""
+    import hmac
+
+    timestamp = headers.get("X-Lark-Request-Timestamp", "")
+    nonce = headers.get("X-Lark-Request-Nonce", "")
+    signature = headers.get("X-Lark-Signature", "")
+    raw = (timestamp + nonce + EVENT_ENCRYPT_KEY).encode("utf-8") + body
+    expected = hashlib.sha256(raw).hexdigest()
+    return hmac.compare_digest(expected, signature)
+
+
+def decrypt_event(encrypt: str) -> dict:
+    """解密飞书加密事件（AES-256-CBC，key 为 sha256(encrypt_key)）。"""
+    try:
+        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    except ImportError as e:
+        raise RuntimeError("配置了 FEISHU_ENCRYPT_KEY 需要安装 cryptography") from e
+    import base64
+
+    buf = base64.b64decode(encrypt)
+    key = hashlib.sha256(EVENT_ENCRYPT_KEY.encode("utf-8")).digest()
+    decryptor = Cipher(algorithms.AES(key), modes.CBC(buf[:16])).decryptor()
+    plain = decryptor.update(buf[16:]) + decryptor.finalize()
+    plain = plain[: -plain[-1]]  # 去掉 PKCS#7 填充
+    return json.loads(plain.decode("utf-8"))
+
+
+def parse_event(headers, body: bytes) -> dict:
+    """校验并解析事件请求体，校验失败抛出 ValueError。
+
+    配置了 FEISHU_ENCRYPT_KEY 时，除（解密后的）URL 校验请求外，每个请求都必须带有效签名
+    和新鲜的时间戳，去掉签名头重放截获的加密事件会被拒绝。
+    """
+    import hmac
+
+    payload = json.loads(body.decode("utf-8"))
+    if "encrypt" in payload:
+        if not EVENT_ENCRYPT_KEY:
+            raise ValueError("收到加密事件但未配置 FEISHU_ENCRYPT_KEY")
+        payload = decrypt_event(payload["encrypt"])
+
+    signed = bool(headers.get("X-Lark-Signature"))
+    if EVENT_ENCRYPT_KEY and (signed or payload.get("type") != "url_verification"):
+        if not signed:
+            raise ValueError("缺少签名")
+        if not verify_event_signature(headers, body):
+            raise ValueError("签名校验失败")
+        try:
+            skew = abs(time.time() - int(headers.get("X-Lark-Request-Timestamp", "")))
+        except ValueError:
+            raise ValueError("请求时间戳无效") from None
+        if skew > EVENT_MAX_SKEW_SECONDS:
+            raise ValueError(f"请求时间戳过期 ({skew:.0f} 秒)")
+
+    # 2.0 事件 token 在 header 里，1.0 事件和 URL 校验在顶层
+    token = payload.get("header", {}).get("token") or payload.get("token", "")
+    if EVENT_VERIFICATION_TOKEN and not hmac.compare_digest(token, EVENT_VERIFICATION_TOKEN):
+        raise ValueError("Verification Token 不匹配")
+    return payload
+
+
+def event_to_message(event: dict) -> dict:
+    """将 im.message.receive_v1 事件转换为消息列表接口的格式。"""
+    message = event.get("message", {})
+    sender = event.get("sender", {})
+    return {
+        "message_id": message.get("message_id", ""),
+        "chat_id": message.get("chat_id", ""),
+        "msg_type": message.get("message_type", ""),
+        "create_time": message.get("create_time", ""),
+        "body": {"content": message.get("content", "{}")},
+        "mentions": [
+            {**m, "id": m.get("id", {}).get("open_id", "")}
+            for m in message.get("mentions", []) or []
+        ],
+        "sender": {
+            "id": sender.get("sender_id", {}).get("open_id", ""),
+            "id_type": "open_id",
+            "sender_type": sender.get("sender_type", ""),
+        },
+    }
+
+
+class EventDeduper:
+    """最近 N 个 event_id 的有界去重集合。"""
+
+    def __init__(self, size: int = EVENT_DEDUP_SIZE):
+        self.size = size
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def seen(self, event_id: str) -> bool:
+        """返回该事件是否已处理过，未处理过则记录下来。"""
+        with self._lock:
+            if event_id in self._seen:
+                return True
+            self._seen[event_id] = None
+            if len(self._seen) > self.size:
+                self._seen.popitem(last=False)
+            return False
+
+
+class EventProcessor:
+    """单线程消费事件队列，复用轮询模式的检测与发送逻辑。
+
+    消息按群攒批 COALESCE_WINDOW 秒后一起发送，突发的成单可以合并。
+    """
+
+    def __init__(self):
+        self.events = queue.Queue()
+        self.deduper = EventDeduper()
+        self.store = StateStore()
+        self.states = self.store.load()
+        self.mentions = MentionIndex(self.store)
+        self.client = FeishuClient()
+        self.client.creds.token()
+        self.bot_open_id = self.client.creds.bot_info().get("open_id", "")
+        self.client.creds.start_background_refresh()
+        # 攒批中的消息 {chat_id: (DispatchContext, 截止时间 monotonic, 开始时间, [消息])}
+        self.batches = {}
+        self.next_board_check = 0.0
+        self.next_outbox_check = time.monotonic() + OUTBOX_RETRY_INTERVAL
+
+    def submit(self, payload: dict) -> bool:
+        """入队一个已校验的事件，重复事件返回 False。"""
+        header = payload.get("header", {})
+        event_id = header.get("event_id") or payload.get("uuid", "")
+        if event_id and self.deduper.seen(event_id):
+            log.info("重复事件已忽略: %s", event_id)
+            return False
+        self.events.put(payload)
+        return True
+
+    def handle(self, payload: dict):
+        event_type = payload.get("header", {}).get("event_type", "")
+        if event_type in MEMBER_EVENT_TYPES:
+            self.handle_member_event(event_type, payload.get("event", {}))
+            return
+        if event_type != "im.message.receive_v1":
+            log.info("忽略事件: %s", event_type or payload.get("type"))
+            return
+        event = payload.get("event", {})
+        msg = event_to_message(event)
+        chat_id = msg["chat_id"]
+        if event.get("message", {}).get("chat_type") == "p2p" and msg["sender"]["id"] == ADMIN_OPEN_ID:
+            # 管理员单聊：序号回复即时转发
+            self.mentions.learn_admin_chat(chat_id)
+            relay_admin_messages(self.client, self.mentions, [msg])
+            return
+        if chat_id not in CHAT_IDS:
+            return
+        cs = self.states[chat_id]
+        if msg["message_id"] in cs.processed_ids:
+            return
+
+        batch = self.batches.get(chat_id)
+        ctx = batch[0] if batch else DispatchContext(self.client, chat_id, self.bot_open_id, cs,
+                                                     lambda: self.store.save_chat(chat_id, cs), self.mentions)
+        with metrics.timer("detect"):
+            dispatcher.dispatch([msg], ctx)
+        if batch:
+            batch[3].append(msg)
+            return
+        if ctx.pending():
+            self.batches[chat_id] = (ctx, time.monotonic() + COALESCE_WINDOW, int(time.time()), [msg])
+        else:
+            cs.last_check_time = int(time.time())
+            cs.cursor = cs.cursor or MessageCursor()
+            cs.cursor.advance([msg])
+            self.store.save_chat(chat_id, cs)
+
+    def flush_due(self):
+        """发送攒批到期的群并推进游标；发送失败的消息留在 outbox 由 retry_outbox 重发。"""
+        now = time.monotonic()
+        for chat_id, (ctx, deadline, opened_at, messages) in list(self.batches.items()):
+            if now < deadline:
+                continue
+            del self.batches[chat_id]
+            cs = self.states[chat_id]
+            try:
+                ctx.flush()
+                ctx.settle()
+                cs.last_check_time = opened_at
+                cs.cursor = cs.cursor or MessageCursor()
+                cs.cursor.advance(messages)
+            except Exception:
+                log.exception("[%s] 发送失败", chat_id)
+            self.store.save_chat(chat_id, cs)
+
+    def check_leaderboards(self):
+        """每分钟检查一次是否有到期的排行榜。"""
+        if not LEADERBOARD_SCHEDULE or time.monotonic() < self.next_board_check:
+            return
+        self.next_board_check = time.monotonic() + 60
+        post_due_leaderboards(self.client, self.store, CHAT_IDS)
+
+    def retry_outbox(self):
+        """定期重发未确认送达的意图；正在攒批的群等这批发完再说。"""
+        if time.monotonic() < self.next_outbox_check:
+            return
+        self.next_outbox_check = time.monotonic() + OUTBOX_RETRY_INTERVAL
+        for chat_id in CHAT_IDS:
+            cs = self.states[chat_id]
+            if cs.outbox and chat_id not in self.batches:
+                resend_outbox(self.client, chat_id, cs, lambda: self.store.save_chat(chat_id, cs))
+
+    def next_timeout(self) -> float | None:
+        deadlines = [b[1] for b in self.batches.values()]
+        if LEADERBOARD_SCHEDULE:
+            deadlines.append(self.next_board_check)
+        if any(self.states[chat_id].outbox for chat_id in CHAT_IDS):
+            deadlines.append(self.next_outbox_check)
+        if not deadlines:
+            return None
+        return max(0.0, min(deadlines) - time.monotonic())
+
+    def handle_member_event(self, event_type: str, event: dict):
+        """进群/退群事件增量更新成员目录，无需全量拉取。"""
+        chat_id = event.get("chat_id", "")
+        if chat_id not in CHAT_IDS:
+            return
+        directory = self.states[chat_id].directory
+        added = event_type == "im.chat.member.user.added_v1"
+        for user in event.get("users", []):
+            open_id = user.get("user_id", {}).get("open_id", "")
+            if not open_id:
+                continue
+            if added:
+                directory.add(user.get("name", ""), open_id)
+            else:
+                directory.remove(open_id)
+        log.info("[%s] 成员变更 %s: %d 人，当前 %d 人",
+                 chat_id, event_type, len(event.get("users", [])), len(directory))
+        self.store.save_chat(chat_id, self.states[chat_id])
+
+    def loop(self):
+        while True:
+            try:
+                payload = self.events.get(timeout=self.next_timeout())
+            except queue.Empty:
+                payload = None
+            try:
+                if payload is not None:
+                    self.handle(payload)
+                self.flush_due()
+                self.check_leaderboards()
+                self.retry_outbox()
+            except Exception:
+                log.exception("处理事件失败")
+
+
+def make_event_handler(processor: EventProcessor):
+    from http.server import BaseHTTPRequestHandler
+
+    class EventHandler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, obj: dict):
+            data = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/healthz":
+                self._reply(200, {"ok": True})
+            elif self.path == "/metrics":
+                data = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != EVENT_PATH:
+                self._reply(404, {"error": "not found"})
+                return
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                payload = parse_event(self.headers, body)
+            except (ValueError, json.JSONDecodeError) as e:
+                log.warning("拒绝事件请求: %s", e)
+                self._reply(400, {"error": str(e)})
+                return
+            if payload.get("type") == "url_verification":
+                self._reply(200, {"challenge": payload.get("challenge", "")})
+                return
+            # 先应答再处理，避免超过 3 秒被飞书判定失败而重推
+            processor.submit(payload)
+            self._reply(200, {})
+
+        def log_message(self, format, *args):
+            log.debug("HTTP %s", format % args)
+
+    return EventHandler
+
+
+def serve():
+    """常驻模式：先补拉一次停机期间的消息，再接收事件推送。"""
+    if not APP_ID or not APP_SECRET:
+        log.error("缺少环境变量 FEISHU_APP_ID 或 FEISHU_APP_SECRET")
+        return
+
+    if not EVENT_VERIFICATION_TOKEN and not EVENT_ENCRYPT_KEY:
+        log.error("未配置 FEISHU_VERIFICATION_TOKEN 或 FEISHU_ENCRYPT_KEY，无法校验事件来源，拒绝启动")
+        return
+
+    from http.server import ThreadingHTTPServer
+
+    run()
+    processor = EventProcessor()
+    threading.Thread(target=processor.loop, daemon=True).start()
+
+    server = ThreadingHTTPServer((SERVE_HOST, SERVE_PORT), make_event_handler(processor))
+    log.info("事件服务已启动: http://%s:%d%s", SERVE_HOST, SERVE_PORT, EVENT_PATH)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("事件服务已停止")
+    finally:
+        server.server_close()
+
+
+def profiled(mode: str | None, fn):
+    """按 mode 在 cProfile（cpu）或 tracemalloc（mem）下执行 fn，结束时输出前 25 项。"""
+    if mode == "cpu":
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.runcall(fn)
+        finally:
+            profiler.dump_stats("profile.pstats")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+            log.info("CPU profile 已写入 profile.pstats")
+    elif mode == "mem":
+        import tracemalloc
+
+        tracemalloc.start(25)
+        try:
+            fn()
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            for stat in snapshot.statistics("lineno")[:25]:
+                log.info("%s", stat)
+            log.info("内存: 当前 %.1f MB, 峰值 %.1f MB", current / 2**20, peak / 2**20)
+    else:
+        fn()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="飞书成单夸奖机器人")
+    parser.add_argument("--profile", choices=["cpu", "mem"],
+                        help="性能分析：cpu 用 cProfile，mem 用 tracemalloc")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("run", help="拉取一次消息并处理（默认）")
+    sub.add_parser("serve", help="常驻模式，接收飞书事件订阅")
+    sub.add_parser("poll", help="常驻模式，按活跃程度自适应间隔轮询")
+    p = sub.add_parser("replay", help="离线回放 CASSETTE_RECORD 录制的 cassette")
+    p.add_argument("cassette")
+    p.add_argument("--workdir", help="回放状态目录（默认临时目录）")
+    args = parser.parse_args()
+
+    if args.command == "serve":
+        profiled(args.profile, serve)
+    elif args.command == "poll":
+        profiled(args.profile, poll)
+    elif args.command == "replay":
+        profiled(args.profile, lambda: replay(args.cassette, args.workdir))
+    else:
+        profiled(args.profile, run)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+本地模拟飞书事件推送，用于调试 `python bot.py serve`。
+
+示例：
+    python tools/fake_event_sender.py deal --name 张三 --amount 25000
+    python tools/fake_event_sender.py at --text "你好" --bot-open-id ou_xxx
+    python tools/fake_event_sender.py member --name 新同学 --open-id ou_new
+    python tools/fake_event_sender.py member --open-id ou_new --removed
+    python tools/fake_event_sender.py challenge
+
+默认对同一事件推送两次，用于验证重复事件去重。
+签名与 Verification Token 读取和 bot.py 相同的环境变量。
+"""
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+CHAT_ID = os.environ.get("CHAT_ID", "oc_dddb60097be21816a6cdaafbc5d9da59")
+VERIFICATION_TOKEN = os.environ.get("FEISHU_VERIFICATION_TOKEN", "")
+ENCRYPT_KEY = os.environ.get("FEISHU_ENCRYPT_KEY", "")
+
+
+def build_message_event(message: dict, sender_id: str, sender_type: str) -> dict:
+    now_ms = str(int(time.time() * 1000))
+    return {
+        "schema": "2.0",
+        "header": {
+            "event_id": uuid.uuid4().hex,
+            "event_type": "im.message.receive_v1",
+            "create_time": now_ms,
+            "token": VERIFICATION_TOKEN,
+            "app_id": "cli_fake",
+            "tenant_key": "fake",
+        },
+        "event": {
+            "sender": {
+                "sender_id": {"open_id": sender_id},
+                "sender_type": sender_type,
+                "tenant_key": "fake",
+            },
+            "message": {
+                "message_id": "om_" + uuid.uuid4().hex,
+                "create_time": now_ms,
+                "chat_id": CHAT_ID,
+                "chat_type": "group",
+                **message,
+            },
+        },
+    }
+
+
+def member_event(name: str, open_id: str, removed: bool) -> dict:
+    event_type = "im.chat.member.user.deleted_v1" if removed else "im.chat.member.user.added_v1"
+    return {
+        "schema": "2.0",
+        "header": {
+            "event_id": uuid.uuid4().hex,
+            "event_type": event_type,
+            "create_time": str(int(time.time() * 1000)),
+            "token": VERIFICATION_TOKEN,
+            "app_id": "cli_fake",
+            "tenant_key": "fake",
+        },
+        "event": {
+            "chat_id": CHAT_ID,
+            "users": [{"name": name, "tenant_key": "fake", "user_id": {"open_id": open_id}}],
+        },
+    }
+
+
+def deal_event(name: str, amount: int) -> dict:
+    card = {
+        "title": f"恭喜{name}成单",
+        "elements": [[{"tag": "text", "text": f"成交金额：{amount}元"}]],
+    }
+    message = {"message_type": "interactive", "content": json.dumps(card, ensure_ascii=False)}
+    return build_message_event(message, "cli_fake_crm", "app")
+
+
+def at_event(text: str, bot_open_id: str, sender_id: str) -> dict:
+    message = {
+        "message_type": "text",
+        "content": json.dumps({"text": f"@_user_1 {text}"}, ensure_ascii=False),
+        "mentions": [{"key": "@_user_1", "id": {"open_id": bot_open_id}, "name": "夸夸机器人"}],
+    }
+    return build_message_event(message, sender_id, "user")
+
+
+def post(url: str, payload: dict) -> tuple[int, str]:
+    body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if ENCRYPT_KEY:
+        timestamp, nonce = str(int(time.time())), uuid.uuid4().hex
+        raw = (timestamp + nonce + ENCRYPT_KEY).encode("utf-8") + body
+        headers.update({
+            "X-Lark-Request-Timestamp": timestamp,
+            "X-Lark-Request-Nonce": nonce,
+            "X-Lark-Signature": hashlib.sha256(raw).hexdigest(),
+        })
+    req = urllib.request.Request(url, data=body, headers=headers, method="POST")
+    try:
+        with urllib.request.urlopen(req, timeout=10) as resp:
+            return resp.status, resp.read().decode("utf-8")
+    except urllib.error.HTTPError as e:
+        return e.code, e.read().decode("utf-8")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="模拟飞书事件推送")
+    parser.add_argument("--url", default="http://127.0.0.1:8000/feishu/events")
+    parser.add_argument("--repeat", type=int, default=2, help="同一事件推送次数")
+    sub = parser.add_subparsers(dest="kind", required=True)
+
+    p = sub.add_parser("deal", help="成单卡片")
+    p.add_argument("--name", default="张三")
+    p.add_argument("--amount", type=int, default=25000)
+
+    p = sub.add_parser("at", help="@机器人 文本消息")
+    p.add_argument("--text", default="你好")
+    p.add_argument("--bot-open-id", required=True)
+    p.add_argument("--sender-id", default="ou_fake_sender")
+
+    p = sub.add_parser("member", help="成员进群/退群")
+    p.add_argument("--name", default="新同学")
+    p.add_argument("--open-id", required=True)
+    p.add_argument("--removed", action="store_true")
+
+    sub.add_parser("challenge", help="URL 校验请求")
+    args = parser.parse_args()
+
+    if args.kind == "deal":
+        payload = deal_event(args.name, args.amount)
+    elif args.kind == "member":
+        payload = member_event(args.name, args.open_id, args.removed)
+    elif args.kind == "at":
+        payload = at_event(args.text, args.bot_open_id, args.sender_id)
+    else:
+        payload = {"challenge": uuid.uuid4().hex, "token": VERIFICATION_TOKEN, "type": "url_verification"}
+
+    for _ in range(max(1, args.repeat)):
+        status, text = post(args.url, payload)
+        print(status, text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+"""
+本地飞书开放平台模拟服务，离线运行和压测 bot.py。
+
+    python tools/feishu_simulator.py --port 9999 --members 500 --messages 200
+    FEISHU_BASE_URL=http://127.0.0.1:9999/open-apis FEISHU_APP_ID=sim FEISHU_APP_SECRET=sim python bot.py
+
+实现 bot.py 用到的接口：tenant_access_token、bot/v3/info、群成员（分页）、
+消息列表（分页）、发送消息与回复消息。发给用户（open_id）的消息落在 oc_p2p_ 开头的单聊里，单聊没有消息。每次按时间窗口拉消息时生成 --messages 条合成消息，
+按比例混入成单卡片和 @机器人 消息；同一窗口重复拉取（翻页、断点续拉）内容不变。
+
+可注入延迟、429 频控和 5xx 错误。调用统计：GET /_stats，清零：POST /_reset。
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import random
+import threading
+import time
+from collections import Counter, OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+BOT_OPEN_ID = "ou_sim_bot"
+SURNAMES = "王李张刘陈杨黄赵吴周徐孙马朱胡郭何高林罗郑梁谢宋唐许韩冯邓曹彭曾肖田董袁潘于蒋蔡余杜叶程苏魏吕丁"
+GIVEN = "伟芳娜敏静丽强磊军洋勇艳杰娟涛明超秀霞平刚桂英华玉萍红鹏飞辉宇浩然子涵欣怡梓轩一诺思远嘉豪雨桐晨阳"
+
+
+class SimConfig:
+    def __init__(
+        self,
+        members: int = 200,
+        messages: int = 100,
+        deal_ratio: float = 0.2,
+        mention_ratio: float = 0.05,
+        page_size: int = 50,
+        latency_ms: float = 0,
+        rate_429: float = 0,
+        rate_5xx: float = 0,
+        seed: int = 1,
+    ):
+        self.members = members
+        self.messages = messages
+        self.deal_ratio = deal_ratio
+        self.mention_ratio = mention_ratio
+        self.page_size = page_size
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.seed = seed
+
+
+class Simulator:
+    """合成数据与调用统计，供请求处理器共用。"""
+
+    def __init__(self, config: SimConfig):
+        self.config = config
+        self.rng = random.Random(config.seed)
+        self.lock = threading.Lock()
+        self.stats = Counter()
+        self._members = {}  # {chat_id: [{"name", "member_id"}]}
+        self._windows = OrderedDict()  # {(chat_id, start, end): [message]}，最近的若干窗口
+
+    def members(self, chat_id: str) -> list[dict]:
+        with self.lock:
+            if chat_id not in self._members:
+                rng = random.Random(f"{self.config.seed}:{chat_id}")
+                names = set()
+                while len(names) < self.config.members:
+                    names.add(rng.choice(SURNAMES) + "".join(rng.choice(GIVEN) for _ in range(rng.choice((1, 2)))))
+                self._members[chat_id] = [
+                    {"name": name, "member_id": f"ou_sim{i:06d}", "member_id_type": "open_id"}
+                    for i, name in enumerate(sorted(names))
+                ]
+            return self._members[chat_id]
+
+    def window(self, chat_id: str, start: int, end: int) -> list[dict]:
+        if chat_id.startswith("oc_p2p_"):
+            return []
+        key = (chat_id, start, end)
+        with self.lock:
+            if key in self._windows:
+                return self._windows[key]
+        members = self.members(chat_id)
+        cfg = self.config
+        rng = random.Random(f"{cfg.seed}:{chat_id}:{start}:{end}")
+        span = max(0, end - start)
+        items = []
+        for i in range(cfg.messages):
+            ts = start + span * i // max(1, cfg.messages)
+            member = rng.choice(members)
+            msg = {
+                "message_id": f"om_sim_{start}_{end}_{i}",
+                "create_time": str(ts * 1000),
+                "chat_id": chat_id,
+                "sender": {"id": member["member_id"], "id_type": "open_id", "sender_type": "user"},
+            }
+            roll = rng.random()
+            if roll < cfg.deal_ratio:
+                name = member["name"] + (str(rng.randint(1, 9)) if rng.random() < 0.3 else "")
+                card = {
+                    "title": f"恭喜{name}成单",
+                    "elements": [
+                        [{"tag": "text", "text": f"客户：模拟客户{rng.randint(1, 999)}"}],
+                        [{"tag": "text", "text": f"成交金额：{rng.randint(1, 80) * 1000}元"}],
+                    ],
+                }
+                msg.update(msg_type="interactive", body={"content": json.dumps(card, ensure_ascii=False)})
+                msg["sender"] = {"id": "cli_sim_crm", "id_type": "app_id", "sender_type": "app"}
+            elif roll < cfg.deal_ratio + cfg.mention_ratio:
+                msg.update(
+                    msg_type="text",
+                    body={"content": json.dumps({"text": f"@_user_1 请帮忙看下 {i}"}, ensure_ascii=False)},
+                    mentions=[{"key": "@_user_1", "id": BOT_OPEN_ID, "id_type": "open_id", "name": "夸夸"}],
+                )
+            else:
+                msg.update(msg_type="text", body={"content": json.dumps({"text": f"普通消息 {i}"}, ensure_ascii=False)})
+            items.append(msg)
+        with self.lock:
+            self._windows[key] = items
+            while len(self._windows) > 64:
+                self._windows.popitem(last=False)
+        return items
+
+    def fault(self) -> int | None:
+        """按配置的比例返回要注入的错误状态码。"""
+        with self.lock:
+            roll = self.rng.random()
+        if roll < self.config.rate_429:
+            return 429
+        if roll < self.config.rate_429 + self.config.rate_5xx:
+            return 503
+        return None
+
+    def count(self, key: str, n: int = 1):
+        with self.lock:
+            self.stats[key] += n
+
+    def snapshot(self) -> dict:
+        with self.lock:
+            return dict(self.stats)
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+
+def page(items: list, page_token: str | None, size: int) -> dict:
+    offset = int(page_token or 0)
+    more = offset + size < len(items)
+    return {"items": items[offset:offset + size], "has_more": more, "page_token": str(offset + size) if more else ""}
+
+
+def make_handler(sim: Simulator):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status: int, obj: dict, headers: dict | None = None):
+            data = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def _api(self, method: str) -> tuple | None:
+            """通用处理：统计、延迟、错误注入。返回 (path, query)，已回复时返回 None。"""
+            url = urlparse(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            path = url.path.removeprefix("/open-apis")
+            parts = path.split("/")
+            if len(parts) > 4 and parts[3] in ("chats", "messages"):
+                parts[4] = ":id"
+            sim.count("api_calls")
+            sim.count(f"{method} {'/'.join(parts)}")
+            if sim.config.latency_ms:
+                time.sleep(sim.config.latency_ms / 1000)
+            status = sim.fault()
+            if status == 429:
+                sim.count("injected_429")
+                self._reply(429, {"code": 99991400, "msg": "request trigger frequency limit"},
+                            {"x-ogw-ratelimit-reset": "0"})
+                return None
+            if status:
+                sim.count("injected_5xx")
+                self._reply(status, {"code": -1, "msg": "simulated server error"})
+                return None
+            return path, query
+
+        def do_GET(self):
+            if self.path == "/_stats":
+                return self._reply(200, sim.snapshot())
+            routed = self._api("GET")
+            if routed is None:
+                return
+            path, query = routed
+            if path == "/bot/v3/info":
+                return self._reply(200, {"code": 0, "bot": {"open_id": BOT_OPEN_ID, "app_name": "夸夸"}})
+            if path.startswith("/im/v1/chats/") and path.endswith("/members"):
+                members = sim.members(path.split("/")[4])
+                data = page(members, query.get("page_token"), int(query.get("page_size", 100)))
+                return self._reply(200, {"code": 0, "data": data})
+            if path == "/im/v1/messages":
+                items = sim.window(query.get("container_id", ""), int(query.get("start_time", 0)),
+                                   int(query.get("end_time", 0)))
+                data = page(items, query.get("page_token"), min(sim.config.page_size,
+                                                               int(query.get("page_size", 50))))
+                sim.count("messages_listed", len(data["items"]))
+                return self._reply(200, {"code": 0, "data": data})
+            self._reply(404, {"code": 404, "msg": "not found"})
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+            if self.path == "/_reset":
+                sim.reset()
+                return self._reply(200, {})
+            routed = self._api("POST")
+            if routed is None:
+                return
+            path, query = routed
+            if path == "/auth/v3/tenant_access_token/internal":
+                return self._reply(200, {"code": 0, "tenant_access_token": "t-sim", "expire": 7200})
+            if path == "/im/v1/messages":
+                payload = json.loads(body or b"{}")
+                sim.count("messages_sent")
+                chat_id = payload.get("receive_id", "")
+                if query.get("receive_id_type") == "open_id":
+                    chat_id = f"oc_p2p_{chat_id}"
+                return self._reply(200, {"code": 0, "data": {
+                    "message_id": f"om_sent_{time.time_ns()}", "chat_id": chat_id,
+                }})
+            if path.startswith("/im/v1/messages/") and path.endswith("/reply"):
+                sim.count("messages_replied")
+                return self._reply(200, {"code": 0, "data": {"message_id": f"om_sent_{time.time_ns()}"}})
+            self._reply(404, {"code": 404, "msg": "not found"})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def make_server(config: SimConfig, host: str = "127.0.0.1", port: int = 0) -> tuple[ThreadingHTTPServer, Simulator]:
+    """创建模拟服务（port=0 时随机端口），调用方负责 serve_forever()。"""
+    sim = Simulator(config)
+    server = ThreadingHTTPServer((host, port), make_handler(sim))
+    server.daemon_threads = True
+    return server, sim
+
+
+def add_config_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--members", type=int, default=200, help="每个群的成员数")
+    parser.add_argument("--messages", type=int, default=100, help="每个拉取窗口生成的消息数")
+    parser.add_argument("--deal-ratio", type=float, default=0.2, help="成单卡片占比")
+    parser.add_argument("--mention-ratio", type=float, default=0.05, help="@机器人 消息占比")
+    parser.add_argument("--page-size", type=int, default=50, help="消息列表每页条数上限")
+    parser.add_argument("--latency-ms", type=float, default=0, help="每个请求的注入延迟")
+    parser.add_argument("--rate-429", type=float, default=0, help="返回 429 的请求比例")
+    parser.add_argument("--rate-5xx", type=float, default=0, help="返回 503 的请求比例")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def config_from_args(args) -> SimConfig:
+    return SimConfig(
+        members=args.members, messages=args.messages, deal_ratio=args.deal_ratio,
+        mention_ratio=args.mention_ratio, page_size=args.page_size, latency_ms=args.latency_ms,
+        rate_429=args.rate_429, rate_5xx=args.rate_5xx, seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地飞书接口模拟服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    add_config_args(parser)
+    args = parser.parse_args()
+
+    server, _ = make_server(config_from_args(args), args.host, args.port)
+    print(f"模拟服务已启动: http://{args.host}:{server.server_port}/open-apis")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()